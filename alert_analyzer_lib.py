@@ -1,35 +1,95 @@
 import requests
 import json
 import csv
+import hashlib
 import io
-from datetime import datetime
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+import alert_model
+import alert_projection as projection
 
-# The New Relic GraphQL API endpoint
-NR_GRAPHQL_URL = "https://api.newrelic.com/graphql"
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The New Relic GraphQL API endpoint. NEW_RELIC_GRAPHQL_URL overrides it, e.g. for the
+# EU region or a local fake server (see fake_nerdgraph.py).
+NR_GRAPHQL_URL = os.environ.get("NEW_RELIC_GRAPHQL_URL", "https://api.newrelic.com/graphql")
 
 # --- GraphQL Queries ---
-POLICIES_QUERY = """
-query($accountId: Int!, $cursor: String) {
-  actor {
-    account(id: $accountId) {
-      alerts {
-        policiesSearch(cursor: $cursor) {
-          policies { id name }
+# Selection sets are generated from field lists (see alert_projection.py), so a query only
+# asks for the fields the reports need plus any extra fields chosen with set_extra_fields().
+
+def _search_query(search, entity_key, fields):
+    return f"""
+query($accountId: Int!, $cursor: String) {{
+  actor {{
+    account(id: $accountId) {{
+      alerts {{
+        {search}(cursor: $cursor) {{
+          {entity_key} {{ {projection.selection_set(fields)} }}
           nextCursor
-        }}}}}
+        }}}}}}}}}}
 """
 
-CONDITIONS_QUERY = """
-query($accountId: Int!, $cursor: String) {
-  actor {
-    account(id: $accountId) {
-      alerts {
-        nrqlConditionsSearch(cursor: $cursor) {
-          nrqlConditions { policyId id name updatedAt }
-          nextCursor
-        }}}}}
+def _entity_query(entity_key, fields):
+    return f"""
+query($accountId: Int!, $id: ID!) {{
+  actor {{
+    account(id: $accountId) {{
+      alerts {{
+        {entity_key}(id: $id) {{ {projection.selection_set(fields)} }}
+        }}}}}}}}
 """
 
+POLICIES_QUERY = _search_query("policiesSearch", "policies", projection.POLICY_FIELDS)
+POLICY_QUERY = _entity_query("policy", projection.POLICY_FIELDS)
+# The condition queries with the default fields; conditions_query() and condition_query() add the extra fields.
+CONDITIONS_QUERY = _search_query("nrqlConditionsSearch", "nrqlConditions", projection.CONDITION_FIELDS)
+CONDITION_QUERY = _entity_query("nrqlCondition", projection.CONDITION_FIELDS)
+
+_extra_fields = {'conditions': (), 'audit_events': ()}
+
+def set_extra_fields(condition_fields=(), audit_fields=()):
+    """Adds extra condition fields (dotted GraphQL paths) and NrAuditEvent attributes to every fetch and report.
+
+    Applies process-wide, so call it before fetching. Fields that the reports already
+    include are ignored.
+    """
+    _extra_fields['conditions'] = tuple(f for f in condition_fields if f not in projection.CONDITION_FIELDS)
+    _extra_fields['audit_events'] = tuple(f for f in audit_fields if f not in projection.AUDIT_FIELDS)
+
+def extra_condition_fields():
+    return _extra_fields['conditions']
+
+def extra_audit_fields():
+    return _extra_fields['audit_events']
+
+def conditions_query(extra_fields=None):
+    """Returns the conditions search query with the default fields plus `extra_fields` (the configured extra fields by default)."""
+    if extra_fields is None:
+        extra_fields = extra_condition_fields()
+    fields = projection.CONDITION_FIELDS + tuple(f for f in extra_fields if f not in projection.CONDITION_FIELDS)
+    return _search_query("nrqlConditionsSearch", "nrqlConditions", fields)
+
+def condition_query():
+    return _entity_query("nrqlCondition", projection.CONDITION_FIELDS + extra_condition_fields())
+
+def audit_events_nrql(window_clause):
+    """Returns the NrAuditEvent query for a SINCE/UNTIL clause, selecting only the reported attributes."""
+    attributes = projection.nrql_select(projection.AUDIT_FIELDS + extra_audit_fields())
+    return f"FROM NrAuditEvent SELECT {attributes} WHERE actionIdentifier LIKE 'alerts%' {window_clause}"
+
 NRQL_QUERY = """
 query($accountId: Int!, $nrqlQuery: Nrql!) {
     actor {
@@ -42,109 +102,882 @@ query($accountId: Int!, $nrqlQuery: Nrql!) {
 }
 """
 
+# --- Concurrency Settings ---
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_REQUESTS_PER_SECOND = 5.0
+# A limiter unused for this long has no pending slots left, so it is forgotten.
+RATE_LIMITER_IDLE_SECONDS = 600
+
+class RateLimiter:
+    """Thread-safe limiter that spaces out requests made with one API key."""
+
+    def __init__(self, requests_per_second, burst=1):
+        self.interval = 1.0 / requests_per_second
+        self.burst = max(1, int(burst))
+        self._next_slot = time.monotonic()
+        self.last_used = self._next_slot
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until the caller is allowed to send its next request."""
+        with self._lock:
+            now = time.monotonic()
+            self.last_used = now
+            slot = max(self._next_slot, now - (self.burst - 1) * self.interval)
+            self._next_slot = slot + self.interval
+        wait = slot - now
+        if wait > 0:
+            time.sleep(wait)
+
+def key_digest(api_key):
+    """Returns a SHA-256 digest of an API key, for keying shared state without keeping the key itself."""
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+# Keyed by key_digest(api_key).
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(api_key, requests_per_second=DEFAULT_REQUESTS_PER_SECOND):
+    """Returns the rate limiter shared by every request made with the given API key.
+
+    Limiters left idle for RATE_LIMITER_IDLE_SECONDS are dropped, so the registry only
+    holds the keys in recent use.
+    """
+    digest = key_digest(api_key)
+    with _rate_limiters_lock:
+        now = time.monotonic()
+        for idle in [d for d, limiter in _rate_limiters.items() if now - limiter.last_used > RATE_LIMITER_IDLE_SECONDS]:
+            del _rate_limiters[idle]
+        limiter = _rate_limiters.get(digest)
+        if limiter is None:
+            limiter = RateLimiter(requests_per_second)
+            _rate_limiters[digest] = limiter
+        else:
+            limiter.interval = 1.0 / requests_per_second
+            limiter.last_used = now
+        return limiter
+
+FETCH_LABELS = {'policies': 'policies', 'conditions': 'conditions', 'audit_events': 'audit events'}
+
+class FetchError(Exception):
+    """Raised when one or more concurrent fetches fail.
+
+    `errors` maps each failed fetch name to its message and `results` holds the
+    data of the fetches that did succeed.
+    """
+
+    def __init__(self, errors, results):
+        super().__init__(" ".join(errors[name] for name in FETCH_LABELS if name in errors))
+        self.errors = errors
+        self.results = results
+
+class FetchCancelled(Exception):
+    """Raised from a progress callback to abandon a fetch that is no longer wanted."""
+
+def parse_account_ids(text):
+    """Parses a comma/whitespace separated list of account IDs, ignoring '#' comments."""
+    account_ids = []
+    for line in text.splitlines():
+        line = line.split('#', 1)[0]
+        for token in re.split(r'[,\s]+', line.strip()):
+            if not token:
+                continue
+            account_id = int(token)
+            if account_id not in account_ids:
+                account_ids.append(account_id)
+    return account_ids
+
+# --- HTTP Client ---
+
+MAX_RETRIES = 5
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30.0
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+POOL_MAX_SIZE = 32
+
+_session = None
+_session_lock = threading.Lock()
+
+# Upper bounds (ms) of the request latency histogram buckets; slower requests land in '+Inf'.
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+_client_stats = {}
+_client_stats_lock = threading.Lock()
+
+def reset_client_stats():
+    """Resets the request counters kept by post_graphql."""
+    with _client_stats_lock:
+        _client_stats.clear()
+        _client_stats.update(requests=0, retries=0, failures=0, bytes_received=0,
+                             total_seconds=0.0, max_seconds=0.0, status_codes={}, operations={})
+
+reset_client_stats()
+
+def get_client_stats():
+    """Returns a snapshot of the request counters kept by post_graphql.
+
+    `operations` breaks requests down by operation (e.g. 'policies', 'nrqlConditions',
+    'nrql'), each with its request count, bytes, total seconds and latency histogram.
+    """
+    with _client_stats_lock:
+        stats = dict(_client_stats, status_codes=dict(_client_stats['status_codes']),
+                     operations={name: dict(op, histogram=dict(op['histogram']))
+                                 for name, op in _client_stats['operations'].items()})
+    stats['avg_seconds'] = stats['total_seconds'] / stats['requests'] if stats['requests'] else 0.0
+    return stats
+
+def _latency_bucket(elapsed):
+    elapsed_ms = elapsed * 1000
+    for bound in LATENCY_BUCKETS_MS:
+        if elapsed_ms <= bound:
+            return f"<={bound}ms"
+    return "+Inf"
+
+def _record_request(elapsed, status_code=None, bytes_received=0, operation='graphql'):
+    bucket = _latency_bucket(elapsed)
+    with _client_stats_lock:
+        _client_stats['requests'] += 1
+        _client_stats['total_seconds'] += elapsed
+        _client_stats['max_seconds'] = max(_client_stats['max_seconds'], elapsed)
+        _client_stats['bytes_received'] += bytes_received
+        key = str(status_code) if status_code else 'network_error'
+        _client_stats['status_codes'][key] = _client_stats['status_codes'].get(key, 0) + 1
+        op = _client_stats['operations'].setdefault(
+            operation, {'requests': 0, 'bytes_received': 0, 'total_seconds': 0.0, 'histogram': {}}
+        )
+        op['requests'] += 1
+        op['bytes_received'] += bytes_received
+        op['total_seconds'] += elapsed
+        op['histogram'][bucket] = op['histogram'].get(bucket, 0) + 1
+
+def _record_outcome(counter):
+    with _client_stats_lock:
+        _client_stats[counter] += 1
+
+def get_session():
+    """Returns the shared keep-alive session used for every GraphQL call."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_MAX_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({"Content-Type": "application/json", "Accept-Encoding": "gzip, deflate"})
+            _session = session
+        return _session
+
+def decode_json(payload):
+    """Decodes a JSON document (bytes or str), using orjson when it is installed."""
+    return orjson.loads(payload) if orjson else json.loads(payload)
+
+def _retry_delay(attempt, response=None):
+    """Returns how long to wait before retrying: Retry-After if the server sent one, else jittered backoff."""
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            return min(max(float(retry_after), 0.0), BACKOFF_MAX_SECONDS)
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(retry_after)
+                return min(max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0), BACKOFF_MAX_SECONDS)
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+def post_graphql(api_key, query, variables, timeout=15, rate_limiter=None, operation='graphql'):
+    """Sends a GraphQL request through the shared session and returns the decoded response.
+
+    429s, 5xx responses, timeouts and connection errors are retried up to MAX_RETRIES times
+    with exponential backoff. Raises requests.exceptions.RequestException once retries are
+    exhausted, for any other HTTP error, or if the body is not JSON (e.g. a proxy's HTML
+    login page). `operation` labels the request in the client stats.
+    """
+    session = get_session()
+    headers = {"API-Key": api_key}
+    body = json.dumps({"query": query, "variables": variables})
+    for attempt in range(MAX_RETRIES + 1):
+        if rate_limiter:
+            rate_limiter.acquire()
+        started = time.perf_counter()
+        try:
+            response = session.post(NR_GRAPHQL_URL, headers=headers, data=body, timeout=timeout)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            _record_request(time.perf_counter() - started, operation=operation)
+            if attempt == MAX_RETRIES:
+                _record_outcome('failures')
+                raise
+            reason = type(e).__name__
+            delay = _retry_delay(attempt)
+        else:
+            _record_request(time.perf_counter() - started, response.status_code, len(response.content), operation)
+            if response.status_code not in RETRYABLE_STATUS_CODES or attempt == MAX_RETRIES:
+                if not response.ok:
+                    _record_outcome('failures')
+                response.raise_for_status()
+                try:
+                    return decode_json(response.content)
+                except ValueError as e:
+                    # Raised as a RequestException, like response.json() does, so callers' handlers apply.
+                    _record_outcome('failures')
+                    raise requests.exceptions.InvalidJSONError(f"Response is not valid JSON: {e}", response=response) from None
+            reason = f"HTTP {response.status_code}"
+            delay = _retry_delay(attempt, response)
+        _record_outcome('retries')
+        print(f"API request failed ({reason}), retrying in {delay:.1f}s (attempt {attempt + 1} of {MAX_RETRIES})...")
+        time.sleep(delay)
+
+# --- Phase Timing ---
+
+_phase_stats = {}
+_phase_stats_lock = threading.Lock()
+
+def reset_phase_stats():
+    """Resets the per-phase timers kept by phase_timer."""
+    with _phase_stats_lock:
+        _phase_stats.clear()
+
+def get_phase_stats():
+    """Returns {phase: {calls, total_seconds, max_seconds, entities}} for every phase timed so far."""
+    with _phase_stats_lock:
+        return {name: dict(stats) for name, stats in _phase_stats.items()}
+
+@contextmanager
+def phase_timer(name):
+    """Times a block as one call of phase `name`.
+
+    Yields a dict; setting its 'entities' key records how many items the phase handled.
+    Phases running on several threads at once each add their own wall time.
+    """
+    record = {'entities': 0}
+    started = time.perf_counter()
+    try:
+        yield record
+    finally:
+        elapsed = time.perf_counter() - started
+        with _phase_stats_lock:
+            stats = _phase_stats.setdefault(name, {'calls': 0, 'total_seconds': 0.0, 'max_seconds': 0.0, 'entities': 0})
+            stats['calls'] += 1
+            stats['total_seconds'] += elapsed
+            stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+            stats['entities'] += record['entities']
+
+def _timed_fetch(phase, task):
+    with phase_timer(phase) as timing:
+        data = task()
+        timing['entities'] = len(data) if data is not None else 0
+    return data
+
 # --- Data Fetching Functions ---
 
-def fetch_all_data(api_key, account_id, query, data_path, entity_key):
-    """Generic function to fetch all paginated data from the New Relic GraphQL API."""
-    headers = {"Content-Type": "application/json", "API-Key": api_key}
-    all_entities = []
+class GraphQLError(Exception):
+    """Raised when NerdGraph answers with a GraphQL `errors` payload."""
+
+def iter_all_data(api_key, account_id, query, data_path, entity_key, rate_limiter=None):
+    """Yields each page of a paginated New Relic GraphQL search as soon as it arrives.
+
+    Entities with a type in alert_model.RECORD_TYPES are converted to compact records,
+    and the decoded response is released before the page is yielded, so only one page
+    is held at a time. Raises requests.exceptions.RequestException or GraphQLError if a
+    page cannot be fetched.
+    """
+    path_parts = data_path.split('.')
+    record_type = alert_model.RECORD_TYPES.get(entity_key)
     cursor = None
-    has_next_page = True
-    while has_next_page:
+    while True:
         variables = {"accountId": account_id, "cursor": cursor}
-        payload = {"query": query, "variables": variables}
-        try:
-            response = requests.post(NR_GRAPHQL_URL, headers=headers, data=json.dumps(payload), timeout=15)
-            response.raise_for_status()
-            data = response.json()
-            if "errors" in data:
-                print(f"GraphQL Error: {data['errors']}")
-                return None
-            path_parts = data_path.split('.')
-            result_data = data["data"]["actor"]["account"]
-            for part in path_parts:
-                result_data = result_data.get(part, {})
-            entities_page = result_data.get(entity_key, [])
+        data = post_graphql(api_key, query, variables, timeout=15, rate_limiter=rate_limiter, operation=entity_key)
+        if "errors" in data:
+            raise GraphQLError(data['errors'])
+        result_data = data["data"]["actor"]["account"]
+        for part in path_parts:
+            result_data = result_data.get(part, {})
+        cursor = result_data.get("nextCursor")
+        entities = result_data.get(entity_key, [])
+        if record_type:
+            entities = alert_model.to_records(record_type, entities)
+        del data, result_data
+        yield entities
+        if not cursor:
+            return
+
+def fetch_all_data(api_key, account_id, query, data_path, entity_key, rate_limiter=None, on_page=None):
+    """Generic function to fetch all paginated data from the New Relic GraphQL API.
+
+    If given, `on_page(page_count, entity_count)` is called after every page.
+    """
+    all_entities = []
+    try:
+        for page_count, entities_page in enumerate(iter_all_data(api_key, account_id, query, data_path, entity_key, rate_limiter), 1):
             all_entities.extend(entities_page)
-            cursor = result_data.get("nextCursor")
-            if not cursor:
-                has_next_page = False
-        except requests.exceptions.RequestException as e:
-            print(f"Error making API request: {e}")
-            return None
+            if on_page:
+                on_page(page_count, len(all_entities))
+    except GraphQLError as e:
+        print(f"GraphQL Error: {e}")
+        return None
+    except requests.exceptions.RequestException as e:
+        print(f"Error making API request: {e}")
+        return None
     return all_entities
 
-def fetch_audit_events(api_key, account_id, start_date_str, end_date_str):
+def fetch_audit_events(api_key, account_id, start_date_str, end_date_str, rate_limiter=None):
     """Fetches alert-related audit events using an NRQL query."""
-    nrql_query = f"FROM NrAuditEvent SELECT * WHERE actionIdentifier LIKE 'alerts%' SINCE '{start_date_str} 00:00:00' UNTIL '{end_date_str} 23:59:59'"
-    headers = {"Content-Type": "application/json", "API-Key": api_key}
+    nrql_query = audit_events_nrql(f"SINCE '{start_date_str} 00:00:00' UNTIL '{end_date_str} 23:59:59'")
     variables = {"accountId": account_id, "nrqlQuery": nrql_query}
-    payload = {"query": NRQL_QUERY, "variables": variables}
     try:
-        response = requests.post(NR_GRAPHQL_URL, headers=headers, data=json.dumps(payload), timeout=30)
-        response.raise_for_status()
-        data = response.json()
+        data = post_graphql(api_key, NRQL_QUERY, variables, timeout=30, rate_limiter=rate_limiter, operation='nrql')
         if "errors" in data:
             print(f"GraphQL Error on Audit Query: {data['errors']}")
             return None
-        return data.get("data", {}).get("actor", {}).get("account", {}).get("nrql", {}).get("results", [])
+        return _audit_event_records(data)
     except requests.exceptions.RequestException as e:
         print(f"Error making API request for audit events: {e}")
         return None
 
+def _audit_event_records(data):
+    """Converts the rows of a decoded NRQL response into AuditEvent records."""
+    rows = data.get("data", {}).get("actor", {}).get("account", {}).get("nrql", {}).get("results", [])
+    return alert_model.to_records(alert_model.AuditEvent, rows)
+
+def fetch_entity(api_key, account_id, query, entity_key, entity_id, rate_limiter=None):
+    """Fetches a single policy or condition by ID.
+
+    Returns the entity, an empty dict if it no longer exists, or None on error.
+    """
+    variables = {"accountId": account_id, "id": str(entity_id)}
+    try:
+        data = post_graphql(api_key, query, variables, timeout=15, rate_limiter=rate_limiter, operation=entity_key)
+    except requests.exceptions.RequestException as e:
+        print(f"Error making API request for {entity_key} {entity_id}: {e}")
+        return None
+    entity = ((((data.get("data") or {}).get("actor") or {}).get("account") or {}).get("alerts") or {}).get(entity_key)
+    if entity:
+        record_type = alert_model.RECORD_TYPES.get(entity_key)
+        return record_type(entity) if record_type else entity
+    errors = data.get("errors") or []
+    if all((error.get("extensions") or {}).get("errorClass") == "NOT_FOUND" for error in errors):
+        return {}
+    print(f"GraphQL Error fetching {entity_key} {entity_id}: {errors}")
+    return None
+
+# --- Time-Sliced Audit Extraction ---
+
+# NRQL never returns more than this many rows per query, even with LIMIT MAX.
+NRQL_RESULT_CAP = 5000
+DEFAULT_AUDIT_SLICE_HOURS = 24
+DEFAULT_AUDIT_SLICE_WORKERS = 4
+MIN_AUDIT_SLICE_MS = 1000
+
+def date_range_to_epoch_ms(start_date_str, end_date_str):
+    """Converts an inclusive YYYY-MM-DD date range into a [since, until) window in epoch milliseconds (UTC)."""
+    date_format = '%Y-%m-%d'
+    start_dt = datetime.strptime(start_date_str, date_format).replace(tzinfo=timezone.utc)
+    end_dt = datetime.strptime(end_date_str, date_format).replace(tzinfo=timezone.utc) + timedelta(days=1)
+    return int(start_dt.timestamp() * 1000), int(end_dt.timestamp() * 1000)
+
+def fetch_audit_events_window(api_key, account_id, since_ms, until_ms, rate_limiter=None):
+    """Fetches up to NRQL_RESULT_CAP alert-related audit events between two epoch-millisecond timestamps."""
+    nrql_query = audit_events_nrql(f"SINCE {since_ms} UNTIL {until_ms} LIMIT MAX")
+    variables = {"accountId": account_id, "nrqlQuery": nrql_query}
+    try:
+        data = post_graphql(api_key, NRQL_QUERY, variables, timeout=130, rate_limiter=rate_limiter, operation='nrql')
+        if "errors" in data:
+            print(f"GraphQL Error on Audit Query: {data['errors']}")
+            return None
+        return _audit_event_records(data)
+    except requests.exceptions.RequestException as e:
+        print(f"Error making API request for audit events: {e}")
+        return None
+
+def audit_event_key(event):
+    """Identity of an audit event, used to drop rows returned by two overlapping windows.
+
+    Only the reported fields count, so the key doesn't change with the extra fields selected.
+    """
+    return json.dumps([event.get(field) for field in projection.AUDIT_FIELDS], default=str)
+
+def merge_audit_events(*event_lists):
+    """De-duplicates audit events from several queries and returns them sorted by timestamp."""
+    merged = {}
+    for events in event_lists:
+        for event in events:
+            merged.setdefault(audit_event_key(event), event)
+    return sorted(merged.values(), key=lambda e: e.get('timestamp', 0))
+
+def fetch_audit_events_sliced(api_key, account_id, start_date_str, end_date_str,
+                              slice_hours=DEFAULT_AUDIT_SLICE_HOURS, max_workers=DEFAULT_AUDIT_SLICE_WORKERS,
+                              rate_limiter=None, on_window=None):
+    """Fetches alert-related audit events by splitting the date range into time windows.
+
+    A single NRQL query silently stops at NRQL_RESULT_CAP rows, so the range is cut into
+    `slice_hours` windows that are queried concurrently. Any window that comes back full
+    is split in half and both halves are queried again, until every window fits under the
+    cap. `on_window(windows_done, windows_total, row_count)` is called as windows finish.
+    Returns the de-duplicated events in timestamp order, or None if any window fails.
+    """
+    try:
+        since_ms, until_ms = date_range_to_epoch_ms(start_date_str, end_date_str)
+    except ValueError as e:
+        print(f"Error: Invalid date format. Please use YYYY-MM-DD. Details: {e}")
+        return None
+    return fetch_audit_events_between(api_key, account_id, since_ms, until_ms, slice_hours=slice_hours,
+                                      max_workers=max_workers, rate_limiter=rate_limiter, on_window=on_window)
+
+def fetch_audit_events_between(api_key, account_id, since_ms, until_ms,
+                               slice_hours=DEFAULT_AUDIT_SLICE_HOURS, max_workers=DEFAULT_AUDIT_SLICE_WORKERS,
+                               rate_limiter=None, on_window=None):
+    """Time-sliced audit event extraction over an epoch-millisecond window; see fetch_audit_events_sliced.
+
+    With `slice_hours=None` the window starts out split evenly across the workers.
+    """
+    if slice_hours is None:
+        slice_ms = max(-(-(until_ms - since_ms) // max_workers), MIN_AUDIT_SLICE_MS)
+    else:
+        slice_ms = max(int(slice_hours * 3600 * 1000), MIN_AUDIT_SLICE_MS)
+    windows = [(start, min(start + slice_ms, until_ms)) for start in range(since_ms, until_ms, slice_ms)]
+    fetched = []
+    windows_done, windows_total = 0, len(windows)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {
+            executor.submit(fetch_audit_events_window, api_key, account_id, start, end, rate_limiter): (start, end)
+            for start, end in windows
+        }
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    start, end = pending.pop(future)
+                    rows = future.result()
+                    if rows is None:
+                        for other in pending:
+                            other.cancel()
+                        return None
+                    if len(rows) >= NRQL_RESULT_CAP and end - start > MIN_AUDIT_SLICE_MS:
+                        middle = (start + end) // 2
+                        for half in ((start, middle), (middle, end)):
+                            pending[executor.submit(fetch_audit_events_window, api_key, account_id, half[0], half[1], rate_limiter)] = half
+                        windows_total += 1
+                        continue
+                    if len(rows) >= NRQL_RESULT_CAP:
+                        print(f"Warning: {NRQL_RESULT_CAP}+ audit events within {MIN_AUDIT_SLICE_MS} ms at {start}; some rows may be missing.")
+                    fetched.append(rows)
+                    windows_done += 1
+                    if on_window:
+                        on_window(windows_done, windows_total, sum(len(r) for r in fetched))
+        except BaseException:
+            # Don't leave queued windows running after a cancellation or unexpected error.
+            for future in pending:
+                future.cancel()
+            raise
+    return merge_audit_events(*fetched)
+
+# --- Fetch Memoization ---
+
+DEFAULT_MEMO_TTL_SECONDS = 300
+DEFAULT_MEMO_MAX_BYTES = 64 * 1024 * 1024
+# How often a caller waiting on another caller's fetch calls its on_wait() again.
+MEMO_WAIT_POLL_SECONDS = 1
+
+class FetchMemo:
+    """Remembers fetch results for `ttl_seconds` and coalesces identical in-flight fetches.
+
+    The first caller for a key runs the loader; callers arriving while it is still running
+    wait for and share its result instead of issuing the same API requests again. Failed
+    fetches (None or an exception) are shared with the waiters but not remembered.
+    Remembered results are limited to `max_bytes` (estimated with `size_of`); the least
+    recently used ones are forgotten first, and a result larger than that is not kept.
+    """
+
+    def __init__(self, ttl_seconds=DEFAULT_MEMO_TTL_SECONDS, max_bytes=DEFAULT_MEMO_MAX_BYTES,
+                 size_of=alert_model.estimated_bytes):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'evictions': 0}
+
+    def get_or_fetch(self, key, loader, on_wait=None):
+        """Returns the remembered value for `key`, or runs `loader()` once to produce it.
+
+        `on_wait()` is called if this caller attaches to a fetch already in flight, and again
+        every MEMO_WAIT_POLL_SECONDS while it waits; raising FetchCancelled from it stops
+        waiting, leaving the fetch running for the others.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.monotonic() - entry[0] <= self.ttl_seconds:
+                self._stats['hits'] += 1
+                self._entries.move_to_end(key)
+                return entry[1]
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                self._stats['misses'] += 1
+                future = Future()
+                self._inflight[key] = future
+            else:
+                self._stats['coalesced'] += 1
+        if not leader:
+            if on_wait:
+                on_wait()
+                while not wait((future,), MEMO_WAIT_POLL_SECONDS).done:
+                    on_wait()
+            try:
+                return future.result()
+            except FetchCancelled:
+                # The caller that ran the fetch gave up on it; run it for ourselves instead.
+                return self.get_or_fetch(key, loader, on_wait)
+
+        try:
+            value = loader()
+        except BaseException as e:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+        size = self.size_of(value) if value is not None else 0
+        with self._lock:
+            del self._inflight[key]
+            self._forget(key)
+            if value is not None and size <= self.max_bytes:
+                self._entries[key] = (time.monotonic(), value, size)
+                self._bytes += size
+            self._evict_expired()
+            while self._bytes > self.max_bytes:
+                self._forget(next(iter(self._entries)))
+                self._stats['evictions'] += 1
+        future.set_result(value)
+        return value
+
+    def _forget(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._bytes -= entry[2]
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        for key in [key for key, (stored_at, _, _) in self._entries.items() if now - stored_at > self.ttl_seconds]:
+            self._forget(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def metrics(self):
+        with self._lock:
+            self._evict_expired()
+            return dict(self._stats, entries=len(self._entries), bytes=self._bytes, max_bytes=self.max_bytes,
+                        inflight=len(self._inflight), ttl_seconds=self.ttl_seconds)
+
+# Shared by every caller that passes `memoize=True`.
+fetch_memo = FetchMemo()
+
+def memo_key(api_key, account_id, fetch_name, *window):
+    """Builds a memo key; the API key is hashed so it is not kept in the memo."""
+    return (key_digest(api_key), account_id, fetch_name) + window
+
+def fetch_account_data_concurrently(api_key, account_id, start_date_str, end_date_str, rate_limiter=None, on_progress=None,
+                                    sliced_audit=False, memoize=False):
+    """Fetches policies, conditions and audit events for one account at the same time.
+
+    The three fetches are independent, so they run on their own threads and the wall-clock
+    time is that of the slowest one. `on_progress(fetch_name, message, details)` is called
+    as each fetch advances; `details` holds the fetch's `state` ('fetching', 'waiting',
+    'done' or 'failed') and its `entities`, `pages` or `windows_done`/`windows_total` so
+    far. Returns (policies, conditions, audit_events) or raises FetchError naming every
+    fetch that failed. With `sliced_audit` the audit events are fetched with
+    fetch_audit_events_sliced instead of a single NRQL query. With `memoize` the fetches
+    go through `fetch_memo`, keyed by account (plus the date window for audit events).
+    """
+    def report(name, message, state='fetching', **details):
+        if on_progress:
+            on_progress(name, message, dict(details, state=state))
+
+    def page_reporter(name):
+        return lambda page_count, entity_count: report(
+            name, f"{entity_count} fetched ({page_count} pages)...", pages=page_count, entities=entity_count
+        )
+
+    tasks = {
+        'policies': lambda: fetch_all_data(api_key, account_id, POLICIES_QUERY, "alerts.policiesSearch", "policies",
+                                           rate_limiter=rate_limiter, on_page=page_reporter('policies')),
+        'conditions': lambda: fetch_all_data(api_key, account_id, conditions_query(), "alerts.nrqlConditionsSearch", "nrqlConditions",
+                                             rate_limiter=rate_limiter, on_page=page_reporter('conditions')),
+        'audit_events': lambda: fetch_audit_events(api_key, account_id, start_date_str, end_date_str, rate_limiter=rate_limiter),
+    }
+    if sliced_audit:
+        tasks['audit_events'] = lambda: fetch_audit_events_sliced(
+            api_key, account_id, start_date_str, end_date_str, rate_limiter=rate_limiter,
+            on_window=lambda done, total, rows: report('audit_events', f"{rows} fetched ({done}/{total} windows)...",
+                                                       windows_done=done, windows_total=total, entities=rows)
+        )
+    if memoize:
+        windows = {'conditions': extra_condition_fields(),
+                   'audit_events': (start_date_str, end_date_str, sliced_audit) + extra_audit_fields()}
+        tasks = {
+            name: (lambda name=name, loader=loader: fetch_memo.get_or_fetch(
+                memo_key(api_key, account_id, name, *windows.get(name, ())), loader,
+                on_wait=lambda: report(name, "waiting for an identical fetch already in progress...", state='waiting')
+            ))
+            for name, loader in tasks.items()
+        }
+    results, errors = {}, {}
+    with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+        futures = {}
+        for name, task in tasks.items():
+            report(name, "fetching...")
+            futures[executor.submit(_timed_fetch, f"fetch_{name}", task)] = name
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                data = future.result()
+            except FetchCancelled:
+                raise
+            except Exception as e:
+                data = None
+                errors[name] = f"Unexpected error fetching {FETCH_LABELS[name]}: {e}."
+            if data is None:
+                errors.setdefault(name, f"Failed to fetch {FETCH_LABELS[name]}.")
+                report(name, "failed", state='failed')
+            else:
+                results[name] = data
+                report(name, f"done, {len(data)} fetched", state='done', entities=len(data))
+    if errors:
+        raise FetchError(errors, results)
+    return results['policies'], results['conditions'], results['audit_events']
+
 # --- Data Processing & CSV Generation ---
 
-def filter_conditions_by_date(conditions, start_date_str, end_date_str):
-    """Filters a list of conditions based on their 'updatedAt' timestamp."""
-    start_ms, end_ms = None, None
+def build_dataset(policies, conditions, audit_events=None):
+    """Builds the indexed alert_model.AlertDataset for one account's fetched data."""
+    with phase_timer('build_index') as timing:
+        dataset = alert_model.AlertDataset(policies, conditions, audit_events)
+        timing['entities'] = len(conditions) + len(dataset.audit_events)
+    return dataset
+
+def local_date_range_ms(start_date_str, end_date_str):
+    """Converts an inclusive YYYY-MM-DD range into [start, end] epoch ms in local time, as used to filter conditions."""
     date_format = '%Y-%m-%d'
+    start_ms = datetime.strptime(start_date_str, date_format).timestamp() * 1000
+    end_ms = datetime.strptime(end_date_str, date_format).replace(hour=23, minute=59, second=59).timestamp() * 1000
+    return start_ms, end_ms
+
+def refilter_dataset(dataset, start_date_str, end_date_str, policy_pattern=None, actors=None, actions=None,
+                     filter_events_by_date=True):
+    """Re-applies a date range and optional filters to an already fetched dataset, without any API calls.
+
+    Returns (filtered_conditions, audit_events); see alert_model.AlertDataset.select for the
+    filters. Audit events are only cut to the date range when `filter_events_by_date` is set,
+    i.e. when the range is narrower than the one they were fetched for. Raises ValueError
+    for malformed dates.
+    """
+    with phase_timer('refilter') as timing:
+        events_window = date_range_to_epoch_ms(start_date_str, end_date_str) if filter_events_by_date else None
+        conditions, events = dataset.select(*local_date_range_ms(start_date_str, end_date_str), events_window=events_window,
+                                            policy_pattern=policy_pattern, actors=actors, actions=actions)
+        timing['entities'] = len(conditions) + len(events)
+    return conditions, events
+
+def filter_conditions_by_date(conditions, start_date_str, end_date_str, dataset=None):
+    """Filters a list of conditions based on their 'updatedAt' timestamp.
+
+    If `dataset` (built from the same conditions) is given, its sorted index is used
+    instead of scanning the list.
+    """
     try:
-        start_dt = datetime.strptime(start_date_str, date_format)
-        start_ms = start_dt.timestamp() * 1000
-        end_dt = datetime.strptime(end_date_str, date_format).replace(hour=23, minute=59, second=59)
-        end_ms = end_dt.timestamp() * 1000
+        start_ms, end_ms = local_date_range_ms(start_date_str, end_date_str)
     except ValueError as e:
         print(f"Error: Invalid date format. Please use YYYY-MM-DD. Details: {e}")
         return []
     
-    filtered = [
-        cond for cond in conditions if cond.get('updatedAt') and
-        start_ms <= cond['updatedAt'] <= end_ms
-    ]
+    with phase_timer('filter_conditions') as timing:
+        if dataset is not None:
+            filtered = dataset.conditions_updated_between(start_ms, end_ms)
+        else:
+            filtered = [
+                cond for cond in conditions if cond.get('updatedAt') and
+                start_ms <= cond['updatedAt'] <= end_ms
+            ]
+        timing['entities'] = len(filtered)
     return filtered
 
-def generate_alerts_csv_data(policies, conditions, account_id):
-    """Processes alert data and returns it as a CSV string."""
-    if not conditions:
-        return None
-    
-    output = io.StringIO()
-    writer = csv.writer(output)
-    
-    header = [
-        'condition_name', 'condition_id', 'policy_name', 'policy_id',
-        'condition_last_update', 'policy_last_update', 'condition_url', 'policy_url'
-    ]
-    writer.writerow(header)
+ALERTS_CSV_HEADER = [
+    'condition_name', 'condition_id', 'policy_name', 'policy_id',
+    'condition_last_update', 'policy_last_update', 'condition_url', 'policy_url',
+    'changed_by', 'change_count'
+]
+
+AUDIT_CSV_FIELDS = list(projection.AUDIT_FIELDS)
+
+def alerts_csv_header():
+    """Returns the alerts report columns: ALERTS_CSV_HEADER followed by the extra condition fields."""
+    return ALERTS_CSV_HEADER + list(extra_condition_fields())
+
+def audit_csv_fields():
+    """Returns the audit report columns: AUDIT_CSV_FIELDS followed by the extra audit fields."""
+    return AUDIT_CSV_FIELDS + list(extra_audit_fields())
+
+def condition_url(policy_id, condition_id, account_id):
+    return f"https://one.newrelic.com/alerts-ai/policy/{policy_id}/condition/{condition_id}?account={account_id}"
+
+def policy_url(policy_id, account_id):
+    return f"https://one.newrelic.com/alerts-ai/policy/{policy_id}?account={account_id}"
+
+def _alert_rows(policies, conditions, account_id, dataset=None):
+    """Yields one alerts CSV row per condition, sorted by condition name.
+
+    Who changed each condition, and how often, comes from the audit events joined in
+    `dataset`; without one those columns are left empty.
+    """
+    if dataset is None:
+        dataset = alert_model.AlertDataset(policies, ())
+    extra_fields = extra_condition_fields()
 
-    policy_map = {int(p['id']): p['name'] for p in policies}
-    
     for condition in sorted(conditions, key=lambda c: c.get('name', '').lower()):
         policy_id = int(condition['policyId'])
         condition_id = int(condition['id'])
         cond_updated_at = condition.get('updatedAt')
         cond_update_str = datetime.fromtimestamp(cond_updated_at / 1000).strftime('%Y-%m-%d %H:%M:%S') if cond_updated_at else 'N/A'
-        
-        writer.writerow([
+        changes = dataset.condition_changes(condition_id)
+
+        yield [
             condition.get('name', 'N/A'),
             condition_id,
-            policy_map.get(policy_id, 'Policy Not Found'),
+            dataset.policy_name(policy_id),
             policy_id,
             cond_update_str,
             cond_update_str, # In this simplified model, policy update is the same as the condition
-            f"https://one.newrelic.com/alerts-ai/policy/{policy_id}/condition/{condition_id}?account={account_id}",
-            f"https://one.newrelic.com/alerts-ai/policy/{policy_id}?account={account_id}"
-        ])
+            condition_url(policy_id, condition_id, account_id),
+            policy_url(policy_id, account_id),
+            "; ".join(changes['changed_by']),
+            changes['change_count']
+        ] + [projection.format_value(projection.field_value(condition, field)) for field in extra_fields]
+
+def _format_audit_event(event):
+    """Returns a copy of an audit event with its timestamp and JSON fields rendered for CSV; the event is not modified."""
+    row = alert_model.as_dict(event)
+    if 'timestamp' in row:
+        row['timestamp'] = datetime.fromtimestamp(row['timestamp'] / 1000).strftime('%Y-%m-%d %H:%M:%S')
+    for field in ['description', 'changes']:
+        if field in row and isinstance(row[field], (dict, list)):
+            row[field] = json.dumps(row[field])
+    for field in extra_audit_fields():
+        row[field] = projection.format_value(row.get(field))
+    return row
+
+CSV_CHUNK_ROWS = 1000
+
+def iter_csv(rows, fieldnames, dict_rows=False, chunk_rows=CSV_CHUNK_ROWS, stats=None, header=True):
+    """Renders rows as CSV text, yielding it in chunks of `chunk_rows` rows.
+
+    Rows are lists in `fieldnames` order, or dicts when `dict_rows` is set. If `stats`
+    is given, stats['rows'] is set to the number of data rows rendered so far. The
+    header row is left out when `header` is false, e.g. when appending to a report.
+    """
+    buffer = io.StringIO()
+    if dict_rows:
+        writer = csv.DictWriter(buffer, fieldnames=fieldnames, extrasaction='ignore')
+        if header:
+            writer.writeheader()
+    else:
+        writer = csv.writer(buffer)
+        if header:
+            writer.writerow(fieldnames)
+    row_count = 0
+    for row in rows:
+        writer.writerow(row)
+        row_count += 1
+        if stats is not None:
+            stats['rows'] = row_count
+        if row_count % chunk_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if stats is not None:
+        stats['rows'] = row_count
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def iter_alerts_csv(policies, conditions, account_id, stats=None, dataset=None, header=True):
+    """Yields the alerts report as CSV text chunks."""
+    return iter_csv(_alert_rows(policies, conditions, account_id, dataset), alerts_csv_header(), stats=stats, header=header)
+
+def iter_audit_csv(events, stats=None, header=True):
+    """Yields the audit report as CSV text chunks."""
+    return iter_csv((_format_audit_event(event) for event in events), audit_csv_fields(), dict_rows=True, stats=stats,
+                    header=header)
+
+def _multi_account_alert_rows(account_results):
+    for result in account_results:
+        if result['error']:
+            continue
+        account_id = result['account_id']
+        for row in _alert_rows(result['policies'], result['filtered_conditions'], account_id, result.get('dataset')):
+            yield [account_id] + row
+
+def _multi_account_audit_rows(account_results):
+    for result in account_results:
+        if result['error']:
+            continue
+        for event in result['audit_events']:
+            row = _format_audit_event(event)
+            row['account_id'] = result['account_id']
+            yield row
+
+def iter_multi_account_alerts_csv(account_results, stats=None, header=True):
+    """Yields the merged alerts report of several accounts, with an account_id column, as CSV text chunks."""
+    return iter_csv(_multi_account_alert_rows(account_results), ['account_id'] + alerts_csv_header(), stats=stats,
+                    header=header)
+
+def iter_multi_account_audit_csv(account_results, stats=None, header=True):
+    """Yields the merged audit report of several accounts, with an account_id column, as CSV text chunks."""
+    return iter_csv(_multi_account_audit_rows(account_results), ['account_id'] + audit_csv_fields(), dict_rows=True,
+                    stats=stats, header=header)
+
+def write_alerts_csv(output, policies, conditions, account_id, dataset=None, header=True):
+    """Streams the alerts report to a file object. Returns the number of data rows."""
+    stats = {'rows': 0}
+    with phase_timer('csv_alerts') as timing:
+        output.writelines(iter_alerts_csv(policies, conditions, account_id, stats=stats, dataset=dataset, header=header))
+        timing['entities'] = stats['rows']
+    return stats['rows']
+
+def write_audit_csv(output, events, header=True):
+    """Streams the audit report to a file object. Returns the number of data rows."""
+    stats = {'rows': 0}
+    with phase_timer('csv_audit') as timing:
+        output.writelines(iter_audit_csv(events, stats=stats, header=header))
+        timing['entities'] = stats['rows']
+    return stats['rows']
+
+def write_multi_account_alerts_csv(output, account_results, header=True):
+    """Streams the merged alerts report of several accounts to a file object. Returns the number of data rows."""
+    stats = {'rows': 0}
+    with phase_timer('csv_alerts') as timing:
+        output.writelines(iter_multi_account_alerts_csv(account_results, stats=stats, header=header))
+        timing['entities'] = stats['rows']
+    return stats['rows']
+
+def write_multi_account_audit_csv(output, account_results, header=True):
+    """Streams the merged audit report of several accounts to a file object. Returns the number of data rows."""
+    stats = {'rows': 0}
+    with phase_timer('csv_audit') as timing:
+        output.writelines(iter_multi_account_audit_csv(account_results, stats=stats, header=header))
+        timing['entities'] = stats['rows']
+    return stats['rows']
+
+def generate_alerts_csv_data(policies, conditions, account_id, dataset=None):
+    """Processes alert data and returns it as a CSV string."""
+    if not conditions:
+        return None
+    
+    output = io.StringIO()
+    write_alerts_csv(output, policies, conditions, account_id, dataset)
     return output.getvalue()
 
 def generate_audit_csv_data(events):
@@ -153,18 +986,93 @@ def generate_audit_csv_data(events):
         return None
         
     output = io.StringIO()
-    fieldnames = [
-        'timestamp', 'actionIdentifier', 'actorEmail', 'actorId',
-        'targetId', 'targetType', 'targetName', 'description', 'changes'
-    ]
-    writer = csv.DictWriter(output, fieldnames=fieldnames, extrasaction='ignore')
-    writer.writeheader()
-
-    for event in events:
-        if 'timestamp' in event:
-            event['timestamp'] = datetime.fromtimestamp(event['timestamp'] / 1000).strftime('%Y-%m-%d %H:%M:%S')
-        for field in ['description', 'changes']:
-            if field in event and isinstance(event[field], (dict, list)):
-                event[field] = json.dumps(event[field])
-        writer.writerow(event)
+    write_audit_csv(output, events)
     return output.getvalue()
+
+def generate_multi_account_alerts_csv_data(account_results):
+    """Merges the filtered conditions of several accounts into one CSV string with an account_id column."""
+    output = io.StringIO()
+    row_count = write_multi_account_alerts_csv(output, account_results)
+    return output.getvalue() if row_count else None
+
+def generate_multi_account_audit_csv_data(account_results):
+    """Merges the audit events of several accounts into one CSV string with an account_id column."""
+    output = io.StringIO()
+    row_count = write_multi_account_audit_csv(output, account_results)
+    return output.getvalue() if row_count else None
+
+# --- Multi-Account Audit ---
+
+def run_account_audit(api_key, account_id, start_date_str, end_date_str, rate_limiter=None, sliced_audit=False, memoize=False,
+                      on_progress=None):
+    """Runs the full fetch-and-filter pipeline for a single account.
+
+    Returns a dict with the fetched data and its indexed 'dataset' (an alert_model.AlertDataset);
+    'error' is set instead when a fetch fails. `on_progress` is passed to
+    fetch_account_data_concurrently.
+    """
+    result = {'account_id': account_id, 'error': None}
+    try:
+        policies, conditions, audit_events = fetch_account_data_concurrently(
+            api_key, account_id, start_date_str, end_date_str, rate_limiter=rate_limiter, on_progress=on_progress,
+            sliced_audit=sliced_audit, memoize=memoize
+        )
+    except FetchError as e:
+        result['error'] = str(e)
+        return result
+
+    dataset = build_dataset(policies, conditions, audit_events)
+    result['policies'] = policies
+    result['conditions'] = conditions
+    result['filtered_conditions'] = filter_conditions_by_date(conditions, start_date_str, end_date_str, dataset)
+    result['audit_events'] = audit_events
+    result['dataset'] = dataset
+    return result
+
+def run_multi_account_audit(api_key, account_ids, start_date_str, end_date_str,
+                            max_workers=DEFAULT_MAX_WORKERS, requests_per_second=DEFAULT_REQUESTS_PER_SECOND,
+                            on_account_done=None, sliced_audit=False, account_pipeline=None, memoize=False,
+                            on_progress=None):
+    """Runs the per-account pipeline for many accounts in parallel.
+
+    At most `max_workers` accounts are processed at once and all of them share one rate
+    limiter for the API key. `on_account_done(result, done_count, total)` is called as each
+    account finishes and may raise FetchCancelled to stop the run. Results are returned in
+    the same order as `account_ids`. `account_pipeline(api_key, account_id, start_date_str, end_date_str, rate_limiter)` may
+    replace run_account_audit; it must return a result dict of the same shape. Otherwise
+    `on_progress(account_id, fetch_name, message, details)` is called as each account's
+    fetches advance (see fetch_account_data_concurrently); raising FetchCancelled from it
+    stops the accounts being audited between pages as well.
+    """
+    if account_pipeline is None:
+        def account_pipeline(api_key, account_id, *args):
+            account_progress = (lambda *details: on_progress(account_id, *details)) if on_progress else None
+            return run_account_audit(api_key, account_id, *args, sliced_audit=sliced_audit, memoize=memoize,
+                                     on_progress=account_progress)
+    rate_limiter = get_rate_limiter(api_key, requests_per_second)
+    results_by_account = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(account_pipeline, api_key, account_id, start_date_str, end_date_str, rate_limiter): account_id
+            for account_id in account_ids
+        }
+        for future in as_completed(futures):
+            account_id = futures[future]
+            try:
+                result = future.result()
+            except FetchCancelled:
+                for other in futures:
+                    other.cancel()
+                raise
+            except Exception as e:
+                result = {'account_id': account_id, 'error': f"Unexpected error: {e}"}
+            results_by_account[account_id] = result
+            if on_account_done:
+                try:
+                    on_account_done(result, len(results_by_account), len(account_ids))
+                except FetchCancelled:
+                    # Accounts already being audited finish; the rest are never started.
+                    for other in futures:
+                        other.cancel()
+                    raise
+    return [results_by_account[account_id] for account_id in account_ids]
@@ -1,15 +1,104 @@
 import os
 import argparse
+import cProfile
+import pstats
 from datetime import datetime, timedelta
 import alert_analyzer_lib as analyzer
+import alert_projection
+import alert_snapshot
+import alert_store
+import alert_watch
+import columnar_export
+
+# Number of functions listed after a --cprofile run.
+CPROFILE_TOP_FUNCTIONS = 20
+
+ALERTS_REPORT = "new_relic_alerts"
+AUDIT_REPORT = "nr_audit_event"
+DIFF_REPORT = "nr_alert_diff"
+
+CSV_WRITERS = {
+    'alerts': analyzer.write_alerts_csv,
+    'audit': analyzer.write_audit_csv,
+    'multi_account_alerts': analyzer.write_multi_account_alerts_csv,
+    'multi_account_audit': analyzer.write_multi_account_audit_csv,
+}
+COLUMNAR_WRITERS = {
+    'alerts': columnar_export.write_alerts,
+    'audit': columnar_export.write_audit,
+    'multi_account_alerts': columnar_export.write_multi_account_alerts,
+    'multi_account_audit': columnar_export.write_multi_account_audit,
+}
 
 def main():
     """Main function to run the command-line program."""
     parser = argparse.ArgumentParser(description="Fetch New Relic alert policies, conditions, and audit events.")
     parser.add_argument('--start', dest='update_range_start', required=False, help="The start of the date range (YYYY-MM-DD).")
     parser.add_argument('--end', dest='update_range_end', required=False, help="The end of the date range (YYYY-MM-DD).")
+    parser.add_argument('--accounts', required=False, help="Comma-separated list of account IDs to audit in parallel.")
+    parser.add_argument('--accounts-file', required=False, help="File with one account ID per line to audit in parallel.")
+    parser.add_argument('--concurrency', type=int, default=analyzer.DEFAULT_MAX_WORKERS, help=f"Maximum number of accounts audited at once (default: {analyzer.DEFAULT_MAX_WORKERS}).")
+    parser.add_argument('--rate-limit', type=float, default=analyzer.DEFAULT_REQUESTS_PER_SECOND, help=f"Maximum API requests per second for the API key (default: {analyzer.DEFAULT_REQUESTS_PER_SECOND}).")
+    parser.add_argument('--sliced-audit', action='store_true', help="Fetch audit events in adaptive, concurrent time windows so busy accounts are not cut off by the NRQL result cap.")
+    parser.add_argument('--incremental', action='store_true', help="Keep a local snapshot store and only fetch audit events (and the conditions they touched) since the last sync.")
+    parser.add_argument('--full-sync', action='store_true', help="With --incremental, refetch everything and rebuild the snapshot store.")
+    parser.add_argument('--store', default=alert_store.DEFAULT_STORE_PATH, help=f"Path of the SQLite snapshot store used by --incremental (default: {alert_store.DEFAULT_STORE_PATH}).")
+    parser.add_argument('--watch', action='store_true', help="Keep running after the first sync: poll for new audit events every --interval seconds, append them and the conditions they changed to the CSV reports, and send change notifications. Implies --incremental.")
+    parser.add_argument('--interval', type=float, default=alert_watch.DEFAULT_WATCH_INTERVAL_SECONDS, help=f"Seconds between polls in --watch mode (default: {alert_watch.DEFAULT_WATCH_INTERVAL_SECONDS}).")
+    parser.add_argument('--notify-file', help="In --watch mode, append a JSON line describing each account's changes to this file.")
+    parser.add_argument('--notify-url', help="In --watch mode, POST a JSON notification describing each account's changes to this webhook URL.")
+    parser.add_argument('--format', dest='file_format', choices=('csv',) + columnar_export.FORMATS, default='csv', help="Report format: csv (default), parquet, or arrow (Arrow IPC stream). Parquet and Arrow need pyarrow.")
+    parser.add_argument('--condition-fields', help="Comma-separated extra NRQL condition fields to fetch and add as alerts report columns, as dotted GraphQL paths (e.g. enabled,nrql.query,terms.threshold).")
+    parser.add_argument('--audit-fields', help="Comma-separated extra NrAuditEvent attributes to fetch and add as audit report columns (e.g. actorType,actorIpAddress).")
+    parser.add_argument('--snapshot', metavar='PATH', help="Instead of writing the reports, save the policies and NRQL condition configuration of the account(s) to a snapshot file at PATH, for --diff.")
+    parser.add_argument('--diff', nargs=2, metavar=('OLD', 'NEW'), help="Compare two snapshot files and write the added, removed and modified conditions to a CSV diff report. Needs no API key.")
+    parser.add_argument('--diff-by', choices=alert_snapshot.DIFF_BY, default='auto', help="How --diff matches conditions: id (same condition over time), name (policy and condition name, e.g. staging vs production), or auto (id if both snapshots cover the same accounts, default).")
+    parser.add_argument('--profile', action='store_true', help="Print per-phase timings and request latency histograms at the end of the run.")
+    parser.add_argument('--cprofile', metavar='PATH', help="Run under cProfile and write the stats to PATH (open with pstats or snakeviz).")
     args = parser.parse_args()
 
+    if args.cprofile:
+        profiler = cProfile.Profile()
+        profiler.runcall(run_audit, args, parser)
+        profiler.dump_stats(args.cprofile)
+        print(f"\ncProfile stats written to {args.cprofile}. Top functions by cumulative time:")
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(CPROFILE_TOP_FUNCTIONS)
+    else:
+        run_audit(args, parser)
+    if args.profile:
+        print_profile_report()
+
+def run_audit(args, parser):
+    """Runs the audit described by the parsed command-line arguments."""
+    if args.file_format != 'csv' and not columnar_export.is_available():
+        print(f"\n❌ Error: --format {args.file_format} requires pyarrow. Install it with 'pip install pyarrow'.")
+        return
+    if args.concurrency < 1:
+        print("\n❌ Error: --concurrency must be at least 1.")
+        return
+    if args.rate_limit <= 0:
+        print("\n❌ Error: --rate-limit must be greater than 0.")
+        return
+    if args.watch:
+        if args.file_format != 'csv':
+            print("\n❌ Error: --watch appends to the reports, which is only supported with --format csv.")
+            return
+        if args.interval < alert_watch.MIN_WATCH_INTERVAL_SECONDS:
+            print(f"\n❌ Error: --interval must be at least {alert_watch.MIN_WATCH_INTERVAL_SECONDS} seconds.")
+            return
+        args.incremental = True
+    try:
+        analyzer.set_extra_fields(
+            alert_projection.parse_fields(args.condition_fields, alert_projection.CONDITION_FIELDS),
+            alert_projection.parse_fields(args.audit_fields, alert_projection.AUDIT_FIELDS, nrql=True)
+        )
+    except ValueError as e:
+        print(f"\n❌ Error: {e}")
+        return
+    if args.diff:
+        run_diff(args.diff[0], args.diff[1], args.diff_by)
+        return
+
     # --- Date handling logic ---
     start_date_str = args.update_range_start
     end_date_str = args.update_range_end
@@ -20,7 +109,8 @@ def main():
         return
 
     if not start_date_str and not end_date_str:
-        print("\nNOTICE: No date range specified. The script will default to the last 30 days.")
+        if not args.snapshot:
+            print("\nNOTICE: No date range specified. The script will default to the last 30 days.")
         end_dt = datetime.now()
         start_dt = end_dt - timedelta(days=30)
         start_date_str = start_dt.strftime('%Y-%m-%d')
@@ -29,45 +119,239 @@ def main():
     # --- Get Credentials ---
     api_key = os.getenv("NEW_RELIC_API_KEY")
     account_id_str = os.getenv("NEW_RELIC_ACCOUNT_ID")
+    if args.accounts or args.accounts_file:
+        account_id_str = args.accounts or ""
+        if args.accounts_file:
+            try:
+                with open(args.accounts_file) as f:
+                    account_id_str += "\n" + f.read()
+            except OSError as e:
+                print(f"Error: Could not read accounts file. Details: {e}")
+                return
     if not api_key or not account_id_str:
         print("Error: Please set environment variables 'NEW_RELIC_API_KEY' and 'NEW_RELIC_ACCOUNT_ID'")
         return
     try:
-        account_id = int(account_id_str)
+        account_ids = analyzer.parse_account_ids(account_id_str)
     except ValueError:
-        print("Error: 'NEW_RELIC_ACCOUNT_ID' must be an integer.")
+        print("Error: Account IDs must be integers.")
         return
+    if not account_ids:
+        print("Error: No account IDs provided.")
+        return
+    if args.snapshot:
+        run_snapshot(args.snapshot, api_key, account_ids, args.concurrency, args.rate_limit)
+        return
+    store = alert_store.AlertStore(args.store) if args.incremental else None
+    if len(account_ids) > 1:
+        run_multi_account(api_key, account_ids, start_date_str, end_date_str, args.concurrency, args.rate_limit,
+                          args.sliced_audit, store, args.full_sync, args.file_format)
+        if args.watch:
+            run_watch(args, store, api_key, account_ids)
+        return
+    account_id = account_ids[0]
+    rate_limiter = analyzer.get_rate_limiter(api_key, args.rate_limit)
 
-    # --- Section 1: Fetch Policies and Conditions ---
-    print("\nFetching policies...")
-    policies = analyzer.fetch_all_data(api_key, account_id, analyzer.POLICIES_QUERY, "alerts.policiesSearch", "policies")
-    if policies is None: return
-    
-    print("Fetching NRQL conditions...")
-    conditions = analyzer.fetch_all_data(api_key, account_id, analyzer.CONDITIONS_QUERY, "alerts.nrqlConditionsSearch", "nrqlConditions")
-    if conditions is None: return
-    
+    # --- Section 1: Fetch Policies, Conditions and Audit Events concurrently ---
+    if store:
+        print(f"\nSyncing account {account_id} with snapshot store {args.store}...")
+        result = alert_store.sync_account(store, api_key, account_id, start_date_str, end_date_str,
+                                          rate_limiter=rate_limiter, full=args.full_sync)
+        if result['error']:
+            print(f"\n❌ Error: {result['error']}")
+            return
+        print(f"  Sync: {result['sync']}")
+        policies, conditions, audit_events = result['policies'], result['conditions'], result['audit_events']
+        # sync_account already indexed and filtered what it read back from the store.
+        dataset, filtered_conditions = result['dataset'], result['filtered_conditions']
+    else:
+        policies, conditions, audit_events = fetch_account_data(api_key, account_id, start_date_str, end_date_str,
+                                                                args.sliced_audit, rate_limiter)
+        if policies is None:
+            return
+        dataset = analyzer.build_dataset(policies, conditions, audit_events)
+        filtered_conditions = analyzer.filter_conditions_by_date(conditions, start_date_str, end_date_str, dataset)
+
+    # --- Section 2: Alerts Report ---
     print(f"Successfully fetched {len(policies)} policies and {len(conditions)} conditions.")
-    filtered_conditions = analyzer.filter_conditions_by_date(conditions, start_date_str, end_date_str)
-    alerts_csv_data = analyzer.generate_alerts_csv_data(policies, filtered_conditions, account_id)
-    
-    if alerts_csv_data:
-        with open("new_relic_alerts.csv", "w") as f:
-            f.write(alerts_csv_data)
-        print(f"\n✅ Successfully wrote filtered alert conditions to new_relic_alerts.csv")
+    if filtered_conditions:
+        alerts_path = columnar_export.report_path(ALERTS_REPORT, args.file_format)
+        write_report(alerts_path, 'alerts', args.file_format, policies, filtered_conditions, account_id, dataset)
+        print(f"\n✅ Successfully wrote filtered alert conditions to {alerts_path}")
     else:
         print("\nNo conditions found to write to CSV after filtering.")
 
-    # --- Section 2: Fetch Audit Events ---
-    print("\nFetching alert-related audit events...")
-    audit_events = analyzer.fetch_audit_events(api_key, account_id, start_date_str, end_date_str)
+    # --- Section 3: Audit Events Report ---
     if audit_events:
-        audit_csv_data = analyzer.generate_audit_csv_data(audit_events)
-        with open("nr_audit_event.csv", "w") as f:
-            f.write(audit_csv_data)
-        print(f"✅ Successfully wrote {len(audit_events)} audit events to nr_audit_event.csv")
+        audit_path = columnar_export.report_path(AUDIT_REPORT, args.file_format)
+        write_report(audit_path, 'audit', args.file_format, audit_events)
+        print(f"✅ Successfully wrote {len(audit_events)} audit events to {audit_path}")
     else:
         print("\nNo audit events found to write to CSV.")
+    print_request_stats()
+    if args.watch:
+        run_watch(args, store, api_key, account_ids)
+
+def run_watch(args, store, api_key, account_ids):
+    """Runs watch mode after the initial sync, until interrupted with Ctrl+C."""
+    sinks = []
+    if args.notify_file:
+        sinks.append(alert_watch.file_sink(args.notify_file))
+    if args.notify_url:
+        sinks.append(alert_watch.webhook_sink(args.notify_url))
+    print(f"\nWatching {len(account_ids)} account(s) for changes every {args.interval:g} seconds. Press Ctrl+C to stop.")
+    totals = alert_watch.watch(
+        store, api_key, account_ids, args.interval, sinks,
+        alerts_path=columnar_export.report_path(ALERTS_REPORT, 'csv'), audit_path=columnar_export.report_path(AUDIT_REPORT, 'csv'),
+        rate_limit=args.rate_limit, concurrency=args.concurrency
+    )
+    print(f"Watch stopped after {totals['polls']} polls: {totals['audit_events']} new audit events, "
+          f"{totals['conditions']} condition changes, {totals['notifications']} notifications sent, {totals['errors']} failed polls.")
+    print_request_stats()
+
+def run_snapshot(path, api_key, account_ids, concurrency, rate_limit):
+    """Saves the alert configuration of the accounts to a snapshot file."""
+    print(f"\nSnapshotting the alert configuration of {len(account_ids)} account(s)...")
+    snapshot, failed = alert_snapshot.take_snapshot(api_key, account_ids, concurrency, rate_limit)
+    for account_id, error in failed.items():
+        print(f"  ❌ Account {account_id}: {error}")
+    if not snapshot['accounts']:
+        print("\n❌ Error: No account could be snapshotted.")
+        return
+    try:
+        alert_snapshot.write_snapshot(path, snapshot)
+    except OSError as e:
+        print(f"\n❌ Error: Could not write snapshot. Details: {e}")
+        return
+    print(f"\n✅ Saved snapshot of {alert_snapshot.snapshot_summary(snapshot)} to {path}")
+    print_request_stats()
+
+def run_diff(old_path, new_path, by):
+    """Compares two snapshot files and writes the diff report."""
+    snapshots = []
+    for path in (old_path, new_path):
+        try:
+            snapshots.append(alert_snapshot.read_snapshot(path))
+        except (OSError, ValueError) as e:
+            print(f"\n❌ Error: Could not read snapshot {path}. Details: {e}")
+            return
+    print(f"\nOld: {alert_snapshot.snapshot_summary(snapshots[0])}")
+    print(f"New: {alert_snapshot.snapshot_summary(snapshots[1])}")
+    try:
+        diff = alert_snapshot.diff_snapshots(*snapshots, by=by)
+    except ValueError as e:
+        print(f"\n❌ Error: {e}")
+        return
+    counts = alert_snapshot.diff_counts(diff)
+    print(f"\nMatched conditions by {diff['by']}: {counts['added']} added, {counts['removed']} removed, "
+          f"{counts['modified']} modified, {diff['unchanged']} unchanged.")
+    if not any(counts.values()):
+        print("No differences found.")
+        return
+    diff_path = columnar_export.report_path(DIFF_REPORT, 'csv')
+    with open(diff_path, "w", newline="") as f:
+        alert_snapshot.write_diff_csv(f, diff)
+    print(f"✅ Successfully wrote the diff report to {diff_path}")
+
+def fetch_account_data(api_key, account_id, start_date_str, end_date_str, sliced_audit=False, rate_limiter=None):
+    """Fetches one account's data concurrently, printing progress. Returns (None, None, None) on failure."""
+    print("\nFetching policies, NRQL conditions and alert-related audit events...")
+
+    def on_progress(name, message, details):
+        if details['state'] in ('done', 'failed'):
+            print(f"  {analyzer.FETCH_LABELS[name].capitalize()}: {message}")
+
+    try:
+        return analyzer.fetch_account_data_concurrently(
+            api_key, account_id, start_date_str, end_date_str, rate_limiter=rate_limiter, on_progress=on_progress,
+            sliced_audit=sliced_audit
+        )
+    except analyzer.FetchError as e:
+        if 'policies' in e.errors or 'conditions' in e.errors:
+            print(f"\n❌ Error: {e}")
+            return None, None, None
+        # The alerts report can still be written without the audit events.
+        return e.results['policies'], e.results['conditions'], None
+
+def write_report(path, report, file_format, *args):
+    """Streams a report ('alerts', 'audit', 'multi_account_alerts' or 'multi_account_audit') to disk.
+
+    CSV reports use the analyzer's CSV writers, Parquet and Arrow ones columnar_export.
+    Returns the number of rows written; the file is removed again if there were none.
+    """
+    if file_format == 'csv':
+        with open(path, "w", newline="") as f:
+            row_count = CSV_WRITERS[report](f, *args)
+    else:
+        row_count = COLUMNAR_WRITERS[report](path, *args, file_format=file_format)
+    if not row_count:
+        os.remove(path)
+    return row_count
+
+def print_request_stats():
+    """Prints the API request counters collected during the run."""
+    stats = analyzer.get_client_stats()
+    print(f"\nAPI requests: {stats['requests']} ({stats['retries']} retried, {stats['failures']} failed), "
+          f"avg {stats['avg_seconds'] * 1000:.0f} ms, max {stats['max_seconds'] * 1000:.0f} ms, "
+          f"{stats['bytes_received'] / 1024:.0f} KiB received.")
+
+def print_profile_report():
+    """Prints where the run spent its time: each phase, then each request type's latency histogram."""
+    phases = analyzer.get_phase_stats()
+    print("\nPhase timings:")
+    print(f"  {'phase':<20} {'calls':>6} {'total s':>9} {'max s':>8} {'entities':>10}")
+    for name, stats in sorted(phases.items(), key=lambda item: -item[1]['total_seconds']):
+        print(f"  {name:<20} {stats['calls']:>6} {stats['total_seconds']:>9.3f} {stats['max_seconds']:>8.3f} {stats['entities']:>10}")
+
+    buckets = [f"<={bound}ms" for bound in analyzer.LATENCY_BUCKETS_MS] + ["+Inf"]
+    print("\nRequest latency by operation:")
+    for name, op in sorted(analyzer.get_client_stats()['operations'].items()):
+        avg_ms = op['total_seconds'] / op['requests'] * 1000 if op['requests'] else 0.0
+        histogram = ", ".join(f"{bucket} {op['histogram'][bucket]}" for bucket in buckets if bucket in op['histogram'])
+        print(f"  {name}: {op['requests']} requests, avg {avg_ms:.0f} ms, {op['bytes_received'] / 1024:.0f} KiB [{histogram}]")
+
+def run_multi_account(api_key, account_ids, start_date_str, end_date_str, concurrency, rate_limit, sliced_audit=False,
+                      store=None, full_sync=False, file_format='csv'):
+    """Audits several accounts in parallel and writes combined CSV files."""
+    print(f"\nAuditing {len(account_ids)} accounts with up to {concurrency} in parallel...")
+
+    def on_account_done(result, done_count, total):
+        if result['error']:
+            print(f"[{done_count}/{total}] ❌ Account {result['account_id']}: {result['error']}")
+        else:
+            sync_note = f" Sync: {result['sync']}." if 'sync' in result else ""
+            print(f"[{done_count}/{total}] Account {result['account_id']}: {len(result['policies'])} policies, "
+                  f"{len(result['conditions'])} conditions, {len(result['audit_events'])} audit events.{sync_note}")
+
+    account_pipeline = None
+    if store:
+        def account_pipeline(api_key, account_id, start_date_str, end_date_str, rate_limiter):
+            return alert_store.sync_account(store, api_key, account_id, start_date_str, end_date_str,
+                                            rate_limiter=rate_limiter, full=full_sync)
+
+    results = analyzer.run_multi_account_audit(
+        api_key, account_ids, start_date_str, end_date_str,
+        max_workers=concurrency, requests_per_second=rate_limit, on_account_done=on_account_done,
+        sliced_audit=sliced_audit, account_pipeline=account_pipeline
+    )
+
+    alerts_path = columnar_export.report_path(ALERTS_REPORT, file_format)
+    if write_report(alerts_path, 'multi_account_alerts', file_format, results):
+        print(f"\n✅ Successfully wrote filtered alert conditions to {alerts_path}")
+    else:
+        print("\nNo conditions found to write to CSV after filtering.")
+
+    audit_path = columnar_export.report_path(AUDIT_REPORT, file_format)
+    audit_row_count = write_report(audit_path, 'multi_account_audit', file_format, results)
+    if audit_row_count:
+        print(f"✅ Successfully wrote {audit_row_count} audit events to {audit_path}")
+    else:
+        print("\nNo audit events found to write to CSV.")
+
+    failed = [r['account_id'] for r in results if r['error']]
+    if failed:
+        print(f"\n❌ {len(failed)} account(s) failed: {', '.join(str(a) for a in failed)}")
+    print_request_stats()
 
 if __name__ == "__main__":
     main()
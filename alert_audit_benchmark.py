@@ -0,0 +1,189 @@
+import argparse
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+import fake_nerdgraph
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak memory is then measured with tracemalloc instead.
+    resource = None
+
+# Benchmarks the CLI pipeline and the web UI job path against a local fake NerdGraph
+# server. Each pipeline runs in its own child process so its wall time and peak RSS
+# are measured on their own; the fake server runs in this (parent) process. Where the
+# resource module is missing (Windows), the peak of Python allocations traced with
+# tracemalloc is reported instead of peak RSS; tracing also slows the pipelines down.
+
+PIPELINES = ('cli', 'ui')
+BENCHMARK_API_KEY = "benchmark-key"
+UI_POLL_SECONDS = 0.05
+
+PEAK_MEMORY_LABEL = "Peak RSS" if resource else "Peak traced"
+
+def peak_memory_mb():
+    """Returns this process's peak resident set size in MiB, or its peak traced allocations without `resource`."""
+    if resource is None:
+        return tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB everywhere else.
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def count_csv_rows(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path, newline="") as f:
+        return max(0, sum(1 for _ in f) - 1)
+
+# --- Pipelines (run in the child process) ---
+
+def run_cli_pipeline(args):
+    """Runs alert_audit.main() in a temp directory and returns its measurements."""
+    import alert_analyzer_lib as analyzer
+    import alert_audit
+
+    argv = ['alert_audit.py', '--start', args.start, '--end', args.end, '--rate-limit', str(args.rate_limit)]
+    if args.sliced_audit:
+        argv.append('--sliced-audit')
+    os.environ['NEW_RELIC_API_KEY'] = BENCHMARK_API_KEY
+    os.environ['NEW_RELIC_ACCOUNT_ID'] = ",".join(str(1 + i) for i in range(args.accounts))
+    with tempfile.TemporaryDirectory(prefix="nr_alert_benchmark_") as work_dir:
+        os.chdir(work_dir)
+        sys.argv = argv
+        started = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            alert_audit.main()
+        wall_seconds = time.perf_counter() - started
+        rows = {'alerts': count_csv_rows("new_relic_alerts.csv"), 'audit': count_csv_rows("nr_audit_event.csv")}
+    return {'wall_seconds': wall_seconds, 'rows': rows, 'client': analyzer.get_client_stats()}
+
+def run_ui_pipeline(args):
+    """Submits a job through the Flask test client, waits for it and downloads both reports."""
+    import alert_analyzer_lib as analyzer
+    # Read by alert_audit_ui at import time; matches the CLI's --rate-limit.
+    os.environ['NR_AUDIT_RATE_LIMIT'] = str(args.rate_limit)
+    import alert_audit_ui
+
+    client = alert_audit_ui.app.test_client()
+    form = {'api_key': BENCHMARK_API_KEY, 'account_id': ",".join(str(1 + i) for i in range(args.accounts)),
+            'start_date': args.start, 'end_date': args.end}
+    if args.sliced_audit:
+        form['sliced_audit'] = '1'
+    started = time.perf_counter()
+    response = client.post('/run', data=form)
+    job_id = response.headers['Location'].rstrip('/').split('/')[-1]
+    while True:
+        status = client.get(f'/status/{job_id}').get_json()
+        if status.get('phase') in alert_audit_ui.FINAL_PHASES:
+            break
+        time.sleep(UI_POLL_SECONDS)
+    rows = {}
+    for file_type in ('alerts', 'audit'):
+        report = client.get(f'/download/{file_type}/{job_id}')
+        rows[file_type] = max(0, report.get_data().count(b"\n") - 1) if report.status_code == 200 else 0
+    wall_seconds = time.perf_counter() - started
+    result = {'wall_seconds': wall_seconds, 'rows': rows, 'client': analyzer.get_client_stats()}
+    if status['phase'] != 'complete':
+        result['error'] = status.get('status')
+    return result
+
+def run_child(args):
+    pipeline = run_cli_pipeline if args.child == 'cli' else run_ui_pipeline
+    if resource is None:
+        tracemalloc.start()
+    result = pipeline(args)
+    result['peak_memory_mb'] = peak_memory_mb()
+    print(json.dumps(result))
+
+# --- Benchmark driver ---
+
+def run_pipeline_in_child(args, pipeline, url):
+    """Runs one pipeline in a fresh interpreter pointed at the fake server and returns its result dict."""
+    command = [sys.executable, os.path.abspath(__file__), '--child', pipeline, '--start', args.start, '--end', args.end,
+               '--accounts', str(args.accounts), '--rate-limit', str(args.rate_limit)]
+    if args.sliced_audit:
+        command.append('--sliced-audit')
+    env = dict(os.environ, NEW_RELIC_GRAPHQL_URL=url)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)), env.get('PYTHONPATH')]))
+    completed = subprocess.run(command, env=env, capture_output=True, text=True)
+    if completed.returncode != 0:
+        return {'error': completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else "child process failed"}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def print_result(pipeline, result, server_stats):
+    print(f"\n== {pipeline} ==")
+    if 'wall_seconds' not in result:
+        print(f"  ❌ Error: {result['error']}")
+        return
+    rows = result['rows']
+    client = result['client']
+    total_rows = rows['alerts'] + rows['audit']
+    print(f"  Wall time:      {result['wall_seconds']:.2f} s")
+    print(f"  Rows written:   {rows['alerts']} alert rows, {rows['audit']} audit rows "
+          f"({total_rows / result['wall_seconds']:.0f} rows/s)")
+    print(f"  {PEAK_MEMORY_LABEL + ':':<16}{result['peak_memory_mb']:.1f} MiB")
+    print(f"  API requests:   {client['requests']} ({client['retries']} retried, {client['failures']} failed), "
+          f"avg {client['avg_seconds'] * 1000:.1f} ms, {client['bytes_received'] / (1024 * 1024):.1f} MiB received")
+    print(f"  Server:         {server_stats['requests']} requests, {server_stats['throttled']} throttled")
+    if result.get('error'):
+        print(f"  ❌ Job ended with: {result['error']}")
+
+def main():
+    """Runs the benchmark and prints (or writes as JSON) one result per pipeline."""
+    default_end = datetime.now()
+    parser = argparse.ArgumentParser(description="Benchmark the audit pipelines against a local fake NerdGraph server.")
+    parser.add_argument('--pipeline', choices=PIPELINES + ('all',), default='all', help="Which pipeline to benchmark (default: all).")
+    parser.add_argument('--start', default=(default_end - timedelta(days=30)).strftime('%Y-%m-%d'), help="Start of the audited range (YYYY-MM-DD).")
+    parser.add_argument('--end', default=default_end.strftime('%Y-%m-%d'), help="End of the audited range (YYYY-MM-DD).")
+    parser.add_argument('--policies', type=int, default=fake_nerdgraph.DEFAULT_POLICIES)
+    parser.add_argument('--conditions', type=int, default=fake_nerdgraph.DEFAULT_CONDITIONS)
+    parser.add_argument('--audit-events', type=int, default=fake_nerdgraph.DEFAULT_AUDIT_EVENTS)
+    parser.add_argument('--page-size', type=int, default=fake_nerdgraph.DEFAULT_PAGE_SIZE, help="Entities per policies/conditions page.")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds the fake server adds to every response.")
+    parser.add_argument('--throttle-every', type=int, default=0, help="Answer every Nth request with 429 Too Many Requests.")
+    parser.add_argument('--accounts', type=int, default=1, help="Number of accounts to audit (they all serve the same data).")
+    parser.add_argument('--rate-limit', type=float, default=1000.0, help="Client-side requests per second in multi-account runs, for both pipelines.")
+    parser.add_argument('--sliced-audit', action='store_true', help="Use time-sliced audit extraction (needed to fetch more than 100 audit events).")
+    parser.add_argument('--json', dest='json_path', help="Also write the results to this JSON file.")
+    parser.add_argument('--child', choices=PIPELINES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+
+    since_ms, until_ms = fake_nerdgraph.date_range_to_ms(args.start, args.end)
+    data = fake_nerdgraph.FakeDataSet(args.policies, args.conditions, args.audit_events, since_ms, until_ms)
+    fake = fake_nerdgraph.FakeNerdGraph(data, args.page_size, args.latency, args.throttle_every)
+    server = fake_nerdgraph.make_server(fake)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/graphql"
+    print(f"Fake NerdGraph at {url}: {args.policies} policies, {args.conditions} conditions, "
+          f"{args.audit_events} audit events, page size {args.page_size}, latency {args.latency * 1000:.0f} ms, "
+          f"429 every {args.throttle_every or 'never'}.")
+
+    results = {}
+    for pipeline in (PIPELINES if args.pipeline == 'all' else (args.pipeline,)):
+        fake.reset_stats()
+        result = run_pipeline_in_child(args, pipeline, url)
+        result['server'] = fake.stats()
+        results[pipeline] = result
+        print_result(pipeline, result, result['server'])
+    server.shutdown()
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({'parameters': {k: v for k, v in vars(args).items() if k not in ('child', 'json_path')},
+                       'results': results}, f, indent=2)
+        print(f"\nResults written to {args.json_path}")
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,85 @@
-from flask import Flask, request, render_template_string, make_response, redirect, url_for, jsonify
+from flask import Flask, Response, request, render_template_string, redirect, url_for, jsonify, send_file, stream_with_context
 import alert_analyzer_lib as analyzer
+import alert_model
+import alert_snapshot
+import job_scheduler
+import result_cache
+import os
+import io
+import gzip
+import json
+import shutil
 import uuid
 import threading
+from itertools import islice
 from datetime import datetime, timedelta
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 app = Flask(__name__)
 
-# Simple in-memory cache to store job status and results temporarily
-results_cache = {}
+# Requests larger than this (in practice, snapshot uploads to /diff) are rejected with 413,
+# and an uploaded snapshot may not decompress to more than NR_AUDIT_MAX_SNAPSHOT_MB.
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv("NR_AUDIT_MAX_UPLOAD_MB", 64)) * 1024 * 1024
+MAX_SNAPSHOT_BYTES = int(os.getenv("NR_AUDIT_MAX_SNAPSHOT_MB", alert_snapshot.MAX_SNAPSHOT_BYTES // (1024 * 1024))) * 1024 * 1024
+
+# Bounded cache of job status and generated reports. Small reports stay in memory,
+# large ones are spilled to temp files; idle jobs expire. Sizes are configurable in MB.
+results_cache = result_cache.ResultCache(
+    memory_budget=int(os.getenv("NR_AUDIT_CACHE_MEMORY_MB", 256)) * 1024 * 1024,
+    disk_budget=int(os.getenv("NR_AUDIT_CACHE_DISK_MB", 4096)) * 1024 * 1024,
+    spill_threshold=int(os.getenv("NR_AUDIT_CACHE_SPILL_MB", 8)) * 1024 * 1024,
+    ttl_seconds=int(os.getenv("NR_AUDIT_CACHE_TTL_SECONDS", result_cache.DEFAULT_TTL_SECONDS)),
+)
+
+# Fetch results are shared between jobs for this many seconds, up to an estimated size in MB.
+analyzer.fetch_memo.ttl_seconds = int(os.getenv("NR_AUDIT_MEMO_TTL_SECONDS", analyzer.DEFAULT_MEMO_TTL_SECONDS))
+analyzer.fetch_memo.max_bytes = int(os.getenv("NR_AUDIT_MEMO_MEMORY_MB", analyzer.DEFAULT_MEMO_MAX_BYTES // (1024 * 1024))) * 1024 * 1024
+
+# Jobs run on a fixed pool of workers from a FIFO queue, with a cap on concurrent jobs per API key.
+scheduler = job_scheduler.JobScheduler(
+    num_workers=int(os.getenv("NR_AUDIT_WORKERS", job_scheduler.DEFAULT_WORKERS)),
+    jobs_per_key=int(os.getenv("NR_AUDIT_JOBS_PER_KEY", job_scheduler.DEFAULT_JOBS_PER_KEY)),
+    max_queue=int(os.getenv("NR_AUDIT_MAX_QUEUE", job_scheduler.DEFAULT_MAX_QUEUE)),
+)
+
+# Multi-account jobs audit up to this many accounts at once, sharing a client-side limit
+# of this many API requests per second per API key.
+ACCOUNT_CONCURRENCY = int(os.getenv("NR_AUDIT_ACCOUNT_CONCURRENCY", analyzer.DEFAULT_MAX_WORKERS))
+ACCOUNT_RATE_LIMIT = float(os.getenv("NR_AUDIT_RATE_LIMIT", analyzer.DEFAULT_REQUESTS_PER_SECOND))
+if ACCOUNT_CONCURRENCY < 1:
+    raise ValueError("NR_AUDIT_ACCOUNT_CONCURRENCY must be at least 1.")
+if ACCOUNT_RATE_LIMIT <= 0:
+    raise ValueError("NR_AUDIT_RATE_LIMIT must be greater than 0.")
+
+# Jobs queued or running, keyed by what they were asked to do, so identical submissions share one job.
+active_jobs = {}
+active_jobs_lock = threading.Lock()
+
+# Job phases after which nothing else will change.
+FINAL_PHASES = ('complete', 'error', 'cancelled')
+
+# How long an /events stream waits for a change before re-checking the queue position
+# (while queued) or sending a keep-alive comment (otherwise).
+EVENTS_QUEUED_POLL_SECONDS = 1
+EVENTS_KEEPALIVE_SECONDS = 15
+
+# Content encodings offered for downloads, in order of preference when the client accepts several.
+DOWNLOAD_ENCODINGS = ('zstd', 'gzip') if zstandard else ('gzip',)
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 10
+
+EMPTY_REPORT_MESSAGES = {
+    'alerts': "No alert data found for the selected range.",
+    'audit': "No audit event data found for the selected range.",
+    'diff': "No differences found between the snapshots.",
+}
+
+# Number of changes listed on the diff page; the downloadable report has all of them.
+DIFF_PREVIEW_ROWS = 200
 
 # --- HTML Templates ---
 
@@ -29,6 +101,8 @@ HTML_TEMPLATE = """
         .btn { display: block; width: 100%; padding: 12px; background-color: #1877f2; color: #fff; border: none; border-radius: 6px; font-size: 16px; font-weight: bold; cursor: pointer; text-align: center; text-decoration: none; }
         .btn:hover { background-color: #166fe5; }
         .notice { background-color: #fffbe2; border: 1px solid #ffe8a5; padding: 15px; border-radius: 6px; margin-top: 20px; color: #7d6608; }
+        .link { text-align: center; margin-top: 20px; }
+        .link a { color: #1877f2; }
     </style>
 </head>
 <body>
@@ -40,7 +114,7 @@ HTML_TEMPLATE = """
                 <input type="password" id="api_key" name="api_key" required>
             </div>
             <div class="form-group">
-                <label for="account_id">New Relic Account ID:</label>
+                <label for="account_id">New Relic Account ID(s):</label>
                 <input type="text" id="account_id" name="account_id" required>
             </div>
             <div class="form-group">
@@ -51,11 +125,15 @@ HTML_TEMPLATE = """
                 <label for="end_date">End Date:</label>
                 <input type="date" id="end_date" name="end_date">
             </div>
+            <div class="form-group">
+                <label><input type="checkbox" name="sliced_audit" value="1"> Time-sliced audit extraction (for accounts with more than 5,000 audit events)</label>
+            </div>
             <button type="submit" class="btn">Generate Reports</button>
         </form>
         <div class="notice">
-            <strong>Note:</strong> If no date range is provided, the analysis will default to the last 30 days. If you provide one date, you must provide the other.
+            <strong>Note:</strong> If no date range is provided, the analysis will default to the last 30 days. If you provide one date, you must provide the other. Enter several comma-separated account IDs to audit them in parallel into one combined report.
         </div>
+        <p class="link"><a href="{{ url_for('compare_snapshots') }}">Compare two alert configuration snapshots</a></p>
     </div>
 </body>
 </html>
@@ -74,6 +152,9 @@ PROGRESS_TEMPLATE = """
         .container { max-width: 600px; margin: 40px auto; padding: 40px; background-color: #fff; border-radius: 8px; box-shadow: 0 4px 12px rgba(0,0,0,0.1); text-align: center; }
         h1 { color: #1d2129; }
         #status { color: #4b4f56; font-size: 18px; margin-top: 10px; font-weight: 500; }
+        #detail { color: #606770; font-size: 14px; }
+        #queue { color: #7d6608; margin-top: 10px; }
+        .cancel-btn { margin-top: 20px; padding: 8px 20px; background-color: #fff; color: #d93025; border: 1px solid #d93025; border-radius: 6px; font-weight: bold; cursor: pointer; }
         .spinner { border: 4px solid #f3f3f3; border-top: 4px solid #1877f2; border-radius: 50%; width: 40px; height: 40px; animation: spin 1s linear infinite; margin: 20px auto; }
         @keyframes spin { 0% { transform: rotate(0deg); } 100% { transform: rotate(360deg); } }
     </style>
@@ -83,21 +164,64 @@ PROGRESS_TEMPLATE = """
         <h1>Processing Your Request</h1>
         <div class="spinner"></div>
         <p id="status">Initializing...</p>
+        <p id="detail"></p>
+        <p id="queue"></p>
+        <button id="cancel" class="cancel-btn">Cancel</button>
     </div>
     <script>
         const jobId = "{{ job_id }}";
         const statusElement = document.getElementById('status');
+        const detailElement = document.getElementById('detail');
+        const queueElement = document.getElementById('queue');
+        const cancelButton = document.getElementById('cancel');
+
+        cancelButton.addEventListener('click', () => {
+            cancelButton.disabled = true;
+            fetch(`/cancel/${jobId}`, { method: 'POST' });
+        });
         
+        function formatDetail(data) {
+            if (data.accounts) {
+                return `${data.accounts.done} of ${data.accounts.total} accounts audited`;
+            }
+            if (!data.fetches) {
+                return '';
+            }
+            return Object.entries(data.fetches).map(([name, fetch]) => {
+                const label = name.replace('_', ' ');
+                if (fetch.windows_total) {
+                    return `${label}: ${fetch.windows_done}/${fetch.windows_total} windows`;
+                }
+                if (fetch.entities !== undefined) {
+                    return `${label}: ${fetch.entities} (${fetch.pages} pages)`;
+                }
+                return `${label}: ${fetch.state}`;
+            }).join(' · ');
+        }
+
+        // Returns true once the job has reached a final phase.
+        function showProgress(data) {
+            statusElement.textContent = data.status || '...';
+            detailElement.textContent = formatDetail(data);
+            queueElement.textContent = data.queue_position ? `Position in queue: ${data.queue_position}` : '';
+            if (data.phase === 'complete') {
+                window.location.href = `/results/${jobId}`;
+                return true;
+            }
+            if (data.phase === 'error' || data.phase === 'cancelled') {
+                statusElement.style.color = 'red';
+                cancelButton.style.display = 'none';
+                return true;
+            }
+            return false;
+        }
+
+        // Fallback for browsers or proxies that cannot keep an event stream open.
         function checkStatus() {
             fetch(`/status/${jobId}`)
                 .then(response => response.json())
                 .then(data => {
-                    statusElement.textContent = data.status || '...';
-                    if (data.status === 'complete') {
-                        window.location.href = `/results/${jobId}`;
-                    } else if (data.status.startsWith('Error:')) {
-                        statusElement.style.color = 'red';
-                    } else {
+                    if (!showProgress(data)) {
                         setTimeout(checkStatus, 1500); // Poll every 1.5 seconds
                     }
                 })
@@ -106,9 +230,25 @@ PROGRESS_TEMPLATE = """
                     statusElement.style.color = 'red';
                 });
         }
-        
-        // Start checking after a brief delay
-        setTimeout(checkStatus, 500);
+
+        if (window.EventSource) {
+            const events = new EventSource(`/events/${jobId}`);
+            let finished = false;
+            events.onmessage = (event) => {
+                finished = showProgress(JSON.parse(event.data));
+                if (finished) {
+                    events.close();
+                }
+            };
+            events.onerror = () => {
+                events.close();
+                if (!finished) {
+                    checkStatus();
+                }
+            };
+        } else {
+            setTimeout(checkStatus, 500);
+        }
     </script>
 </body>
 </html>
@@ -132,65 +272,375 @@ RESULTS_TEMPLATE = """
         .btn { display: inline-block; width: 45%; padding: 12px; background-color: #42b72a; color: #fff; border: none; border-radius: 6px; font-size: 16px; font-weight: bold; cursor: pointer; text-align: center; text-decoration: none; }
         .btn:hover { background-color: #36a420; }
         .download-links { display: flex; gap: 15px; margin-top: 20px; justify-content: center; }
+        .refilter { margin-top: 30px; padding-top: 20px; border-top: 1px solid #dddfe2; text-align: left; }
+        .refilter h2 { font-size: 18px; color: #1d2129; }
+        .refilter label { display: block; font-weight: 600; margin: 10px 0 5px; color: #4b4f56; }
+        .refilter input { width: 100%; padding: 8px; border: 1px solid #dddfe2; border-radius: 6px; box-sizing: border-box; }
+        .refilter .hint { color: #606770; font-size: 13px; }
+        .refilter .btn { width: 100%; margin-top: 15px; background-color: #1877f2; }
     </style>
 </head>
 <body>
     <div class="container">
         <h1>✅ Reports Generated</h1>
         <div class="summary">
+            {% if counts.accounts %}
+            <p><strong>Accounts Audited:</strong> {{ counts.accounts }} ({{ counts.accounts_failed }} Failed)</p>
+            {% endif %}
             <p><strong>Policies Found:</strong> {{ counts.policies }} ({{ counts.policies_changed }} Changed)</p>
             <p><strong>Conditions Found:</strong> {{ counts.conditions }} ({{ counts.conditions_changed }} Changed)</p>
             <p><strong>Audit Events Found:</strong> {{ counts.audit_events }}</p>
+            <p><strong>Date Range:</strong> {{ shown_window[0] }} to {{ shown_window[1] }}</p>
+            {% if filters.policy_pattern or filters.actors or filters.actions %}
+            <p><strong>Filters:</strong>
+                {% if filters.policy_pattern %}policy "{{ filters.policy_pattern }}" {% endif %}
+                {% if filters.actors %}actors {{ filters.actors|join(', ') }} {% endif %}
+                {% if filters.actions %}actions {{ filters.actions|join(', ') }}{% endif %}
+            </p>
+            {% endif %}
         </div>
         <p>Your analysis is complete. Download your CSV files below.</p>
         <div class="download-links">
             <a href="{{ url_for('download_file', job_id=job_id, file_type='alerts') }}" class="btn">Download Alerts CSV</a>
             <a href="{{ url_for('download_file', job_id=job_id, file_type='audit') }}" class="btn">Download Audit CSV</a>
         </div>
+        <form class="refilter" action="{{ url_for('refilter_results', job_id=job_id) }}" method="post">
+            <h2>Refine these reports</h2>
+            <p class="hint">Data was fetched for {{ window[0] }} to {{ window[1] }}. Ranges inside it are re-filtered instantly; wider ranges fetch the missing data.</p>
+            <label for="start_date">Start Date:</label>
+            <input type="date" id="start_date" name="start_date" value="{{ shown_window[0] }}">
+            <label for="end_date">End Date:</label>
+            <input type="date" id="end_date" name="end_date" value="{{ shown_window[1] }}">
+            <label for="policy_pattern">Policy name (wildcards allowed, e.g. <code>*prod*</code>):</label>
+            <input type="text" id="policy_pattern" name="policy_pattern" value="{{ filters.policy_pattern or '' }}">
+            <label for="actors">Changed by (comma-separated e-mails):</label>
+            <input type="text" id="actors" name="actors" value="{{ (filters.actors or [])|join(', ') }}">
+            <label for="actions">Actions (comma-separated, e.g. <code>alerts_nrql_condition.*</code>):</label>
+            <input type="text" id="actions" name="actions" value="{{ (filters.actions or [])|join(', ') }}">
+            <label for="api_key">New Relic User API Key (only needed for ranges outside the fetched data):</label>
+            <input type="password" id="api_key" name="api_key" autocomplete="off">
+            <button type="submit" class="btn">Apply</button>
+        </form>
+    </div>
+</body>
+</html>
+"""
+
+# Template for the snapshot upload form
+DIFF_FORM_TEMPLATE = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Compare Snapshots</title>
+    <style>
+        body { font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, Helvetica, Arial, sans-serif; margin: 0; background-color: #f0f2f5; display: flex; align-items: center; justify-content: center; min-height: 100vh; }
+        .container { max-width: 600px; width: 100%; margin: 20px; padding: 30px; background-color: #fff; border-radius: 8px; box-shadow: 0 4px 12px rgba(0,0,0,0.1); }
+        h1 { color: #1d2129; text-align: center; margin-bottom: 20px; }
+        .form-group { margin-bottom: 15px; }
+        label { display: block; font-weight: 600; margin-bottom: 5px; color: #4b4f56; }
+        input[type="file"], select { width: 100%; padding: 10px; border: 1px solid #dddfe2; border-radius: 6px; box-sizing: border-box; }
+        .btn { display: block; width: 100%; padding: 12px; background-color: #1877f2; color: #fff; border: none; border-radius: 6px; font-size: 16px; font-weight: bold; cursor: pointer; text-align: center; text-decoration: none; }
+        .btn:hover { background-color: #166fe5; }
+        .notice { background-color: #fffbe2; border: 1px solid #ffe8a5; padding: 15px; border-radius: 6px; margin-top: 20px; color: #7d6608; }
+        .error { background-color: #ffebe9; border: 1px solid #ffc1c0; padding: 15px; border-radius: 6px; margin-bottom: 20px; color: #a4262c; }
+    </style>
+</head>
+<body>
+    <div class="container">
+        <h1>Compare Snapshots</h1>
+        {% if error %}<div class="error">{{ error }}</div>{% endif %}
+        <form action="{{ url_for('compare_snapshots') }}" method="post" enctype="multipart/form-data">
+            <div class="form-group">
+                <label for="old_snapshot">Old snapshot (e.g. last week, or staging):</label>
+                <input type="file" id="old_snapshot" name="old_snapshot" required>
+            </div>
+            <div class="form-group">
+                <label for="new_snapshot">New snapshot (e.g. today, or production):</label>
+                <input type="file" id="new_snapshot" name="new_snapshot" required>
+            </div>
+            <div class="form-group">
+                <label for="diff_by">Match conditions by:</label>
+                <select id="diff_by" name="diff_by">
+                    <option value="auto">Automatic</option>
+                    <option value="id">Condition ID (same account over time)</option>
+                    <option value="name">Policy and condition name (one account against another)</option>
+                </select>
+            </div>
+            <button type="submit" class="btn">Compare</button>
+        </form>
+        <div class="notice">
+            <strong>Note:</strong> Create snapshots with <code>python alert_audit.py --snapshot PATH</code>. Automatic matching uses condition IDs when both snapshots cover the same accounts, and names otherwise.
+        </div>
     </div>
 </body>
 </html>
 """
 
-def _run_analysis_background(job_id, api_key, account_id, start_date, end_date):
+# Template for the diff summary and download page
+DIFF_RESULTS_TEMPLATE = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Snapshot Diff</title>
+    <style>
+        body { font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, Helvetica, Arial, sans-serif; margin: 0; background-color: #f0f2f5; }
+        .container { max-width: 1000px; margin: 40px auto; padding: 30px; background-color: #fff; border-radius: 8px; box-shadow: 0 4px 12px rgba(0,0,0,0.1); }
+        h1 { color: #1d2129; text-align: center; }
+        .summary { background-color: #f0f2f5; border-radius: 6px; padding: 15px; margin: 20px 0; }
+        .summary p { color: #4b4f56; font-size: 16px; margin: 5px 0; }
+        .summary strong { color: #1d2129; }
+        .btn { display: inline-block; padding: 12px 30px; background-color: #42b72a; color: #fff; border: none; border-radius: 6px; font-size: 16px; font-weight: bold; text-decoration: none; }
+        .btn:hover { background-color: #36a420; }
+        .download-links { text-align: center; margin: 20px 0; }
+        table { width: 100%; border-collapse: collapse; font-size: 13px; }
+        th, td { text-align: left; padding: 6px 8px; border-bottom: 1px solid #dddfe2; vertical-align: top; }
+        th { background-color: #f0f2f5; color: #1d2129; }
+        td code { white-space: pre-wrap; word-break: break-all; }
+        .added { color: #36a420; } .removed { color: #a4262c; } .modified { color: #7d6608; }
+        .hint { color: #606770; font-size: 13px; }
+    </style>
+</head>
+<body>
+    <div class="container">
+        <h1>Snapshot Diff</h1>
+        <div class="summary">
+            <p><strong>Old:</strong> {{ diff.old }}</p>
+            <p><strong>New:</strong> {{ diff.new }}</p>
+            <p><strong>Matched By:</strong> {{ 'condition ID' if diff.by == 'id' else 'policy and condition name' }} ({{ diff.fields }} fields compared)</p>
+            <p><strong>Conditions:</strong> {{ diff.counts.added }} added, {{ diff.counts.removed }} removed, {{ diff.counts.modified }} modified, {{ diff.unchanged }} unchanged</p>
+        </div>
+        {% if diff.preview %}
+        <div class="download-links">
+            <a href="{{ url_for('download_file', job_id=job_id, file_type='diff') }}" class="btn">Download Diff CSV</a>
+        </div>
+        {% if diff.total > diff.preview|length %}<p class="hint">Showing the first {{ diff.preview|length }} of {{ diff.total }} changes; the CSV has all of them.</p>{% endif %}
+        <table>
+            <tr><th>Change</th><th>Policy</th><th>Condition</th><th>Changed Fields</th><th>Before</th><th>After</th></tr>
+            {% for change in diff.preview %}
+            <tr>
+                <td class="{{ change.change }}">{{ change.change }}</td>
+                <td>{{ change.policy_name }}</td>
+                <td>{{ change.condition_name }}</td>
+                <td>{{ change.changed_fields|join(', ') }}</td>
+                <td>{% for field, value in (change.before or {}).items() %}<code>{{ field }}: {{ value|tojson }}</code><br>{% endfor %}</td>
+                <td>{% for field, value in (change.after or {}).items() %}<code>{{ field }}: {{ value|tojson }}</code><br>{% endfor %}</td>
+            </tr>
+            {% endfor %}
+        </table>
+        {% else %}
+        <p style="text-align: center;">No differences found.</p>
+        {% endif %}
+        <p class="hint" style="text-align: center;"><a href="{{ url_for('compare_snapshots') }}">Compare other snapshots</a></p>
+    </div>
+</body>
+</html>
+"""
+
+def _write_report(job_id, file_type, writer, *args):
+    """Streams one report straight to a temp file and hands it to the results cache."""
+    path = results_cache.new_report_path(job_id, file_type)
+    with open(path, "w", newline="") as f:
+        if not writer(f, *args):
+            f.seek(0)
+            f.truncate()
+            f.write(EMPTY_REPORT_MESSAGES[file_type])
+    results_cache.put_report_file(job_id, file_type, path)
+
+def _compress_report(job_id, file_type, encoding):
+    """Writes a compressed copy of a job's report and hands it to the results cache."""
+    data, source_path = results_cache.get_report(job_id, file_type)
+    if data is None and source_path is None:
+        return
+    variant = f"{file_type}.{encoding}"
+    path = results_cache.new_report_path(job_id, variant, suffix=f".csv.{encoding}")
+    with (io.BytesIO(data) if data is not None else open(source_path, "rb")) as source, open(path, "wb") as f:
+        if encoding == 'zstd':
+            zstandard.ZstdCompressor(level=ZSTD_LEVEL).copy_stream(source, f)
+        else:
+            with gzip.GzipFile(fileobj=f, mode="wb", compresslevel=GZIP_LEVEL, mtime=0) as gz:
+                shutil.copyfileobj(source, gz)
+    results_cache.put_report_file(job_id, variant, path)
+
+def _report_variant(job_id, report_sources, file_type, encoding):
+    """Returns (data, path) for a report in the given encoding, generating and compressing it on first use.
+
+    Once the cache has dropped the job's data (`report_sources` is None), only a report
+    generated before then can be returned.
+    """
+    if report_sources is not None:
+        writer, *args = report_sources[file_type]
+        data, path = results_cache.get_or_build_report(job_id, file_type,
+                                                       lambda: _write_report(job_id, file_type, writer, *args))
+    else:
+        data, path = results_cache.get_report(job_id, file_type)
+    if encoding == 'identity' or (data is None and path is None):
+        return data, path
+    return results_cache.get_or_build_report(job_id, f"{file_type}.{encoding}",
+                                             lambda: _compress_report(job_id, file_type, encoding))
+
+def _negotiate_encoding():
+    """Picks the download encoding from the request's Accept-Encoding header."""
+    if 'Accept-Encoding' not in request.headers:
+        return 'identity'
+    return request.accept_encodings.best_match(DOWNLOAD_ENCODINGS + ('identity',), default='identity')
+
+def _publish_reports(job_id, job, datasets, start_date, end_date, owner_id=None):
+    """Filters a job's fetched datasets to a date range and its filters, then records its counts and report sources.
+
+    The datasets and report sources are kept in the results cache as the job's data.
+    The job that fetched the datasets is charged for them; a refilter passes that job as
+    `owner_id` and is only charged for the filtered datasets it builds. Under memory
+    pressure the cache drops the data again (a refilter's along with its owner's); the job
+    can then no longer be refiltered locally or generate new reports.
+
+    Audit events are only cut to the date range when it is narrower than the window they
+    were fetched for. No API calls are made.
+    """
+    filters = job['filters']
+    narrowed = (start_date, end_date) != job['window']
+    results = []
+    size = 0 if owner_id else sum(dataset.estimated_bytes() for dataset in datasets.values())
+    for account_id, dataset in datasets.items():
+        conditions, events = analyzer.refilter_dataset(dataset, start_date, end_date, filter_events_by_date=narrowed, **filters)
+        if narrowed or any(filters.values()):
+            # Join against the selected events only, so changed_by/change_count describe this view.
+            dataset = alert_model.AlertDataset(dataset.policies, conditions, events)
+            size += dataset.estimated_bytes()
+        results.append({'account_id': account_id, 'error': None, 'policies': dataset.policies,
+                        'conditions': datasets[account_id].conditions, 'filtered_conditions': conditions,
+                        'audit_events': events, 'dataset': dataset})
+
+    counts = {
+        'policies': sum(len(r['policies']) for r in results),
+        'policies_changed': sum(len(r['dataset'].changed_policy_ids(r['filtered_conditions'])) for r in results),
+        'conditions': sum(len(r['conditions']) for r in results),
+        'conditions_changed': sum(len(r['filtered_conditions']) for r in results),
+        'audit_events': sum(len(r['audit_events']) for r in results),
+    }
+    # The CSV files themselves are only generated when first downloaded (see _report_variant).
+    if job['multi_account']:
+        failed = job['counts'].get('accounts_failed', 0)
+        counts.update(accounts=len(results) + failed, accounts_failed=failed)
+        report_sources = {
+            'alerts': (analyzer.write_multi_account_alerts_csv, results),
+            'audit': (analyzer.write_multi_account_audit_csv, results),
+        }
+    else:
+        result = results[0]
+        report_sources = {
+            'alerts': (analyzer.write_alerts_csv, result['policies'], result['filtered_conditions'],
+                       result['account_id'], result['dataset']),
+            'audit': (analyzer.write_audit_csv, result['audit_events']),
+        }
+    data = {'datasets': datasets, 'report_sources': report_sources, 'owner': owner_id or job_id}
+    if not results_cache.put_job_data(job_id, data, size, parent_id=owner_id):
+        raise Exception("The fetched data has expired. Please run the analysis again.")
+    job.update(counts=counts, shown_window=(start_date, end_date), reports=tuple(report_sources))
+
+def _run_analysis_background(job_id, api_key, account_id, start_date, end_date, sliced_audit, cancel_event):
     """This function runs in a background thread to avoid blocking the UI."""
+    # Hold on to the status dict so the job keeps reporting even if the cache evicts it.
+    job = results_cache[job_id]
     try:
-        results_cache[job_id]['status'] = 'Fetching alert policies...'
-        policies = analyzer.fetch_all_data(api_key, account_id, analyzer.POLICIES_QUERY, "alerts.policiesSearch", "policies")
-        if policies is None:
-            raise Exception("Failed to fetch policies. Check API Key/Account ID.")
-        results_cache[job_id]['counts']['policies'] = len(policies)
-
-        results_cache[job_id]['status'] = f'Found {len(policies)} policies. Fetching conditions...'
-        conditions = analyzer.fetch_all_data(api_key, account_id, analyzer.CONDITIONS_QUERY, "alerts.nrqlConditionsSearch", "nrqlConditions")
-        if conditions is None:
-            raise Exception("Failed to fetch conditions.")
-        results_cache[job_id]['counts']['conditions'] = len(conditions)
-
-        results_cache[job_id]['status'] = f'Found {len(conditions)} conditions. Fetching audit events...'
-        audit_events = analyzer.fetch_audit_events(api_key, account_id, start_date, end_date)
-        if audit_events is None:
-            raise Exception("Failed to fetch audit events.")
-        results_cache[job_id]['counts']['audit_events'] = len(audit_events)
-        
-        results_cache[job_id]['status'] = 'Processing data and generating CSV files...'
-        filtered_conditions = analyzer.filter_conditions_by_date(conditions, start_date, end_date)
+        fetch_progress = {name: 'pending' for name in analyzer.FETCH_LABELS}
+        fetch_details = {name: {'state': 'pending'} for name in analyzer.FETCH_LABELS}
+        job.update(phase='fetching', fetches=dict(fetch_details))
+
+        def on_progress(name, message, details):
+            if cancel_event.is_set():
+                raise analyzer.FetchCancelled()
+            fetch_progress[name] = message
+            fetch_details[name] = details
+            job.update(fetches=dict(fetch_details), status=" | ".join(
+                f"{label.capitalize()}: {fetch_progress[name]}" for name, label in analyzer.FETCH_LABELS.items()
+            ))
+
+        try:
+            # Shares the per-key limit with the other jobs (single- or multi-account) using this API key.
+            policies, conditions, audit_events = analyzer.fetch_account_data_concurrently(
+                api_key, account_id, start_date, end_date, rate_limiter=analyzer.get_rate_limiter(api_key, ACCOUNT_RATE_LIMIT),
+                on_progress=on_progress, sliced_audit=sliced_audit, memoize=True
+            )
+        except analyzer.FetchError as e:
+            if 'policies' in e.errors:
+                raise Exception(f"{e} Check API Key/Account ID.")
+            raise
+        job['counts']['policies'] = len(policies)
+        job['counts']['conditions'] = len(conditions)
+        job['counts']['audit_events'] = len(audit_events)
         
-        # --- NEW: Calculate changed counts ---
-        results_cache[job_id]['counts']['conditions_changed'] = len(filtered_conditions)
-        changed_policy_ids = {int(cond['policyId']) for cond in filtered_conditions}
-        results_cache[job_id]['counts']['policies_changed'] = len(changed_policy_ids)
-        # --- End of new logic ---
+        if cancel_event.is_set():
+            raise analyzer.FetchCancelled()
+        job.update(phase='processing', status='Processing data and generating CSV files...')
+        datasets = {account_id: analyzer.build_dataset(policies, conditions, audit_events)}
+        _publish_reports(job_id, job, datasets, start_date, end_date)
+        job.update(phase='complete', status='complete')
 
-        alerts_csv = analyzer.generate_alerts_csv_data(policies, filtered_conditions, account_id)
-        audit_csv = analyzer.generate_audit_csv_data(audit_events)
+    except analyzer.FetchCancelled:
+        job.update(phase='cancelled', status='Cancelled.')
+    except Exception as e:
+        job.update(phase='error', status=f"Error: {e}")
+
+def _run_multi_account_background(job_id, api_key, account_ids, start_date, end_date, sliced_audit, cancel_event):
+    """Audits several accounts in parallel in a background thread and merges their reports."""
+    job = results_cache[job_id]
+    try:
+        counts = job['counts']
+        counts.update(accounts=len(account_ids), accounts_failed=0, policies=0, policies_changed=0,
+                      conditions=0, conditions_changed=0, audit_events=0)
+        job.update(phase='fetching', accounts={'done': 0, 'total': len(account_ids)},
+                   status=f'Auditing {len(account_ids)} accounts...')
+
+        def on_account_progress(account_id, name, message, details):
+            # Stops each account's fetches between pages (or while waiting on a shared fetch).
+            if cancel_event.is_set():
+                raise analyzer.FetchCancelled()
 
-        results_cache[job_id]['alerts'] = alerts_csv or "No alert data found for the selected range."
-        results_cache[job_id]['audit'] = audit_csv or "No audit event data found for the selected range."
-        results_cache[job_id]['status'] = 'complete'
+        def on_account_done(result, done_count, total):
+            if cancel_event.is_set():
+                raise analyzer.FetchCancelled()
+            if result['error']:
+                counts['accounts_failed'] += 1
+            else:
+                counts['policies'] += len(result['policies'])
+                counts['conditions'] += len(result['conditions'])
+                counts['conditions_changed'] += len(result['filtered_conditions'])
+                counts['policies_changed'] += len(result['dataset'].changed_policy_ids(result['filtered_conditions']))
+                counts['audit_events'] += len(result['audit_events'])
+            job.update(accounts={'done': done_count, 'total': total},
+                       status=f'Audited {done_count} of {total} accounts...')
 
+        results = analyzer.run_multi_account_audit(api_key, account_ids, start_date, end_date,
+                                                   max_workers=ACCOUNT_CONCURRENCY, requests_per_second=ACCOUNT_RATE_LIMIT,
+                                                   on_account_done=on_account_done, sliced_audit=sliced_audit, memoize=True,
+                                                   on_progress=on_account_progress)
+        if counts['accounts_failed'] == len(account_ids):
+            raise Exception(f"All accounts failed. First error: {results[0]['error']}")
+
+        job.update(phase='processing', status='Processing data and generating CSV files...')
+        datasets = {result['account_id']: result['dataset'] for result in results if not result['error']}
+        _publish_reports(job_id, job, datasets, start_date, end_date)
+        job.update(phase='complete', status='complete')
+
+    except analyzer.FetchCancelled:
+        job.update(phase='cancelled', status='Cancelled.')
     except Exception as e:
-        results_cache[job_id]['status'] = f"Error: {e}"
+        job.update(phase='error', status=f"Error: {e}")
+
+def _forget_job(job_key):
+    with active_jobs_lock:
+        active_jobs.pop(job_key, None)
+
+def _run_job(job_key, target, *args):
+    """Runs a background job on a scheduler worker and then removes it from the active jobs."""
+    try:
+        target(*args)
+    finally:
+        _forget_job(job_key)
 
 
 @app.route('/')
@@ -203,14 +653,17 @@ def run_analysis():
     account_id_str = request.form['account_id']
     start_date = request.form['start_date']
     end_date = request.form['end_date']
+    sliced_audit = request.form.get('sliced_audit') == '1'
 
     if (start_date and not end_date) or (not start_date and end_date):
         return "Error: Both start and end dates must be provided together.", 400
     
     try:
-        account_id = int(account_id_str)
+        account_ids = analyzer.parse_account_ids(account_id_str)
     except ValueError:
         return "Error: Account ID must be a number.", 400
+    if not account_ids:
+        return "Error: Account ID must be a number.", 400
 
     if not start_date and not end_date:
         end_dt = datetime.now()
@@ -218,13 +671,102 @@ def run_analysis():
         start_date = start_dt.strftime('%Y-%m-%d')
         end_date = end_dt.strftime('%Y-%m-%d')
 
-    job_id = str(uuid.uuid4())
-    results_cache[job_id] = {'status': 'Initializing...', 'counts': {}}
+    try:
+        job_id = _submit_job(api_key, account_ids, start_date, end_date, sliced_audit, _parse_filters(request.form))
+    except job_scheduler.QueueFull as e:
+        return f"Error: {e}", 503
+    return redirect(url_for('show_progress', job_id=job_id))
 
-    thread = threading.Thread(target=_run_analysis_background, args=(job_id, api_key, account_id, start_date, end_date))
-    thread.start()
+def _parse_filters(form):
+    """Reads the optional report filters (policy name glob, actor e-mails, action globs) from a form."""
+    return {
+        'policy_pattern': form.get('policy_pattern', '').strip() or None,
+        'actors': [actor.strip() for actor in form.get('actors', '').split(',') if actor.strip()] or None,
+        'actions': [action.strip() for action in form.get('actions', '').split(',') if action.strip()] or None,
+    }
 
-    return redirect(url_for('show_progress', job_id=job_id))
+def _submit_job(api_key, account_ids, start_date, end_date, sliced_audit, filters):
+    """Queues an audit job and returns its ID, or the ID of an identical job already queued or running.
+
+    Raises job_scheduler.QueueFull if the queue is at capacity.
+    """
+    job_key = analyzer.memo_key(api_key, tuple(account_ids), 'job', start_date, end_date, sliced_audit,
+                                json.dumps(filters, sort_keys=True))
+    with active_jobs_lock:
+        running_job_id = active_jobs.get(job_key)
+        if running_job_id and running_job_id in results_cache:
+            # An identical job is already queued or running: follow it instead of starting another.
+            return running_job_id
+        job_id = str(uuid.uuid4())
+        results_cache[job_id] = result_cache.JobState(
+            status='Queued...', phase='queued', counts={}, job_key=job_key, filters=filters,
+            window=(start_date, end_date), multi_account=len(account_ids) > 1,
+            source=(account_ids, sliced_audit)
+        )
+        active_jobs[job_key] = job_id
+
+    if len(account_ids) > 1:
+        args = (_run_multi_account_background, job_id, api_key, account_ids, start_date, end_date, sliced_audit)
+    else:
+        args = (_run_analysis_background, job_id, api_key, account_ids[0], start_date, end_date, sliced_audit)
+    try:
+        scheduler.submit(job_id, job_key[0], _run_job, job_key, *args)
+    except job_scheduler.QueueFull as e:
+        _forget_job(job_key)
+        results_cache[job_id].update(phase='error', status=f"Error: {e}")
+        raise
+    return job_id
+
+@app.route('/refilter/<job_id>', methods=['POST'])
+def refilter_results(job_id):
+    """Re-filters a finished job's data into a new set of reports.
+
+    Narrower date ranges and the policy/actor/action filters are applied to the data already
+    fetched, without any API calls. A range reaching outside the fetched window queues a
+    new job, as does any refilter once the cache has dropped the job's data. The API key
+    is not kept with the job, so a new job needs it entered in the form.
+    """
+    job = results_cache.get(job_id)
+    if not job or job.get('phase') != 'complete' or 'window' not in job:
+        return "Job not found or not complete.", 404
+    start_date = request.form.get('start_date') or job['window'][0]
+    end_date = request.form.get('end_date') or job['window'][1]
+    try:
+        analyzer.local_date_range_ms(start_date, end_date)
+    except ValueError:
+        return "Error: Invalid date format. Please use YYYY-MM-DD.", 400
+    if start_date > end_date:
+        return "Error: The start date must not be after the end date.", 400
+    filters = _parse_filters(request.form)
+
+    data = results_cache.get_job_data(job_id)
+    if data is None or not (job['window'][0] <= start_date and end_date <= job['window'][1]):
+        api_key = request.form.get('api_key', '').strip()
+        if not api_key:
+            reason = ("This range reaches outside the fetched data" if data is not None
+                      else "The fetched data has expired")
+            return f"Error: {reason}, so it has to be fetched again. Please enter your API key.", 400
+        account_ids, sliced_audit = job['source']
+        try:
+            new_job_id = _submit_job(api_key, account_ids, start_date, end_date, sliced_audit, filters)
+        except job_scheduler.QueueFull as e:
+            return f"Error: {e}", 503
+        return redirect(url_for('show_progress', job_id=new_job_id))
+
+    new_job_id = str(uuid.uuid4())
+    new_job = result_cache.JobState(
+        status='Filtering...', phase='processing', counts={'accounts_failed': job['counts'].get('accounts_failed', 0)},
+        filters=filters, window=job['window'], multi_account=job['multi_account'], source=job['source']
+    )
+    results_cache[new_job_id] = new_job
+    try:
+        # Refilters of a refilter share the datasets of the job that fetched them.
+        _publish_reports(new_job_id, new_job, data['datasets'], start_date, end_date, owner_id=data['owner'])
+    except Exception as e:
+        new_job.update(phase='error', status=f"Error: {e}")
+        return f"Error: {e}", 410
+    new_job.update(phase='complete', status='complete')
+    return redirect(url_for('show_results', job_id=new_job_id))
 
 @app.route('/progress/<job_id>')
 def show_progress(job_id):
@@ -232,32 +774,147 @@ def show_progress(job_id):
 
 @app.route('/status/<job_id>')
 def get_status(job_id):
-    status_info = results_cache.get(job_id, {'status': 'Job not found.'})
-    return jsonify(status=status_info.get('status'))
+    return jsonify(_job_snapshot(job_id, results_cache.get(job_id)))
+
+def _job_snapshot(job_id, job):
+    """Structured progress of a job, as sent by /status and /events."""
+    if job is None:
+        return {'status': 'Job not found.', 'phase': 'error'}
+    snapshot = {key: job[key] for key in ('status', 'phase', 'fetches', 'accounts', 'counts') if key in job}
+    snapshot['queue_position'] = scheduler.position(job_id)
+    return snapshot
+
+@app.route('/events/<job_id>')
+def stream_events(job_id):
+    """Server-Sent Events stream that pushes a job's progress whenever it changes."""
+    def generate():
+        last_sent = None
+        while True:
+            job = results_cache.get(job_id, count=False)
+            version = job.version if job is not None else None
+            snapshot = _job_snapshot(job_id, job)
+            if snapshot != last_sent:
+                last_sent = snapshot
+                yield f"data: {json.dumps(snapshot)}\n\n"
+            elif snapshot['phase'] != 'queued':
+                yield ": keep-alive\n\n"
+            if snapshot['phase'] in FINAL_PHASES:
+                return
+            timeout = EVENTS_QUEUED_POLL_SECONDS if snapshot['phase'] == 'queued' else EVENTS_KEEPALIVE_SECONDS
+            job.wait_for_change(version, timeout)
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=headers)
+
+@app.route('/cancel/<job_id>', methods=['POST'])
+def cancel_job(job_id):
+    job = results_cache.get(job_id)
+    if not job:
+        return jsonify(cancelled=False, status='Job not found.'), 404
+    outcome = scheduler.cancel(job_id)
+    if outcome == 'dequeued':
+        _forget_job(job['job_key'])
+        job.update(phase='cancelled', status='Cancelled.')
+    elif outcome == 'signalled':
+        job['status'] = 'Cancelling...'
+    return jsonify(cancelled=outcome is not None, status=job['status'])
 
 @app.route('/results/<job_id>')
 def show_results(job_id):
-    if job_id not in results_cache or results_cache[job_id]['status'] != 'complete':
+    job = results_cache.get(job_id)
+    if job and 'diff' in job:
+        return redirect(url_for('show_diff', job_id=job_id))
+    if not job or job['status'] != 'complete':
         return redirect(url_for('show_progress', job_id=job_id))
     
-    counts = results_cache[job_id].get('counts', {})
-    return render_template_string(RESULTS_TEMPLATE, job_id=job_id, counts=counts)
+    counts = job.get('counts', {})
+    return render_template_string(RESULTS_TEMPLATE, job_id=job_id, counts=counts, window=job['window'],
+                                  shown_window=job.get('shown_window', job['window']), filters=job['filters'])
 
 @app.route('/download/<file_type>/<job_id>')
 def download_file(file_type, job_id):
-    if job_id not in results_cache:
+    """Streams a report, compressed with zstd or gzip if the client accepts it.
+
+    Reports are generated on first download. Each job's reports never change, so the
+    ETag is derived from the job ID and encoding; conditional and Range requests are
+    answered by send_file.
+    """
+    job = results_cache.get(job_id)
+    if not job or 'reports' not in job:
         return "File not found or expired.", 404
+    if file_type not in job['reports']:
+        return f"No {file_type} data available.", 404
 
-    result_data = results_cache[job_id].get(file_type)
-    if not result_data:
+    encoding = _negotiate_encoding()
+    data = results_cache.get_job_data(job_id)
+    report_sources = data['report_sources'] if data else None
+    report_data, report_path = _report_variant(job_id, report_sources, file_type, encoding)
+    if report_data is None and not (report_path and os.path.exists(report_path)):
+        if report_sources is None:
+            return "This report has expired to free memory. Please run the analysis again.", 410
         return f"No {file_type} data available.", 404
 
     filename = f"new_relic_{file_type}.csv"
-    response = make_response(result_data)
-    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
-    response.headers["Content-Type"] = "text/csv"
-    
+    source = io.BytesIO(report_data) if report_data is not None else report_path
+    response = send_file(source, mimetype="text/csv", as_attachment=True, download_name=filename,
+                         etag=f"{job_id}-{file_type}-{encoding}", conditional=True, max_age=0)
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
     return response
 
+@app.route('/diff', methods=['GET', 'POST'])
+def compare_snapshots():
+    """Compares two uploaded snapshots. The diff is kept like a finished job so its report downloads the same way."""
+    if request.method == 'GET':
+        return render_template_string(DIFF_FORM_TEMPLATE, error=None)
+    by = request.form.get('diff_by', 'auto')
+    if by not in alert_snapshot.DIFF_BY:
+        return "Error: Unknown match mode.", 400
+    snapshots = []
+    for name in ('old_snapshot', 'new_snapshot'):
+        upload = request.files.get(name)
+        if not upload:
+            return render_template_string(DIFF_FORM_TEMPLATE, error="Please choose both snapshot files."), 400
+        try:
+            snapshots.append(alert_snapshot.load_snapshot(upload.read(), max_bytes=MAX_SNAPSHOT_BYTES))
+        except alert_snapshot.SnapshotError as e:
+            return render_template_string(DIFF_FORM_TEMPLATE, error=f"{upload.filename}: {e}"), 400
+    try:
+        diff = alert_snapshot.diff_snapshots(*snapshots, by=by)
+    except ValueError as e:
+        return render_template_string(DIFF_FORM_TEMPLATE, error=str(e)), 400
+
+    counts = alert_snapshot.diff_counts(diff)
+    job_id = str(uuid.uuid4())
+    results_cache[job_id] = result_cache.JobState(
+        status='complete', phase='complete', reports=('diff',),
+        diff={
+            'old': alert_snapshot.snapshot_summary(snapshots[0]), 'new': alert_snapshot.snapshot_summary(snapshots[1]),
+            'by': diff['by'], 'fields': len(diff['fields']), 'counts': counts, 'unchanged': diff['unchanged'],
+            'total': sum(counts.values()), 'preview': list(islice(alert_snapshot.iter_diff_changes(diff), DIFF_PREVIEW_ROWS)),
+        }
+    )
+    results_cache.put_job_data(job_id, {'report_sources': {'diff': (alert_snapshot.write_diff_csv, diff)}},
+                               alert_snapshot.diff_estimated_bytes(diff))
+    return redirect(url_for('show_diff', job_id=job_id))
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    limit_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    return render_template_string(DIFF_FORM_TEMPLATE, error=f"The uploaded files are larger than {limit_mb} MB."), 413
+
+@app.route('/diff/<job_id>')
+def show_diff(job_id):
+    job = results_cache.get(job_id)
+    if not job or 'diff' not in job:
+        return "Diff not found or expired.", 404
+    return render_template_string(DIFF_RESULTS_TEMPLATE, job_id=job_id, diff=job['diff'])
+
+@app.route('/metrics')
+def metrics():
+    return jsonify(cache=results_cache.metrics(), fetch_memo=analyzer.fetch_memo.metrics(), scheduler=scheduler.metrics(),
+                   requests=analyzer.get_client_stats(), phases=analyzer.get_phase_stats())
+
 if __name__ == '__main__':
     app.run(debug=True, port=5001)
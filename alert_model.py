@@ -0,0 +1,249 @@
+import sys
+from bisect import bisect_left, bisect_right
+from collections.abc import Mapping
+from fnmatch import fnmatchcase
+import alert_projection as projection
+
+class Record(Mapping):
+    """Compact, read-only stand-in for a policy, condition or audit event decoded from the API.
+
+    The fields in FIELDS live in slots rather than a per-object dict, and string values
+    of the INTERNED_FIELDS (actors, action names...) are interned so that repeats share
+    one object. Any other fields, such as extra projected ones, are kept in a small dict.
+    A record reads like the dict it was built from: [], get(), `in`, keys(), items()
+    and dict(record) all work. A field missing from the source is missing here too.
+    """
+
+    __slots__ = ('_extra',)
+    FIELDS = ()
+    INTERNED_FIELDS = frozenset()
+    _field_set = frozenset()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._field_set = frozenset(cls.FIELDS)
+
+    def __init__(self, data):
+        fields, interned, extra = self._field_set, self.INTERNED_FIELDS, None
+        for key, value in data.items():
+            if key in fields:
+                setattr(self, key, sys.intern(value) if key in interned and type(value) is str else value)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+        self._extra = extra
+
+    def __getitem__(self, key):
+        if key in self._field_set:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def get(self, key, default=None):
+        if key in self._field_set:
+            return getattr(self, key, default)
+        return self._extra.get(key, default) if self._extra else default
+
+    def __contains__(self, key):
+        if key in self._field_set:
+            return hasattr(self, key)
+        return bool(self._extra) and key in self._extra
+
+    def __iter__(self):
+        return iter(self.to_dict())
+
+    def __len__(self):
+        return len(self.to_dict())
+
+    def to_dict(self):
+        """Returns the record as a new plain dict."""
+        data = {}
+        for field in self.FIELDS:
+            try:
+                data[field] = getattr(self, field)
+            except AttributeError:
+                pass
+        if self._extra:
+            data.update(self._extra)
+        return data
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+class Policy(Record):
+    FIELDS = projection.POLICY_FIELDS
+    __slots__ = FIELDS
+
+class Condition(Record):
+    FIELDS = projection.CONDITION_FIELDS
+    INTERNED_FIELDS = frozenset({'policyId'})
+    __slots__ = FIELDS
+
+class AuditEvent(Record):
+    FIELDS = projection.AUDIT_FIELDS
+    INTERNED_FIELDS = frozenset({'actionIdentifier', 'actorEmail', 'targetId', 'targetType', 'targetName'})
+    __slots__ = FIELDS
+
+# Record type for each GraphQL entity key.
+RECORD_TYPES = {
+    'policies': Policy, 'policy': Policy,
+    'nrqlConditions': Condition, 'nrqlCondition': Condition,
+}
+
+def to_records(record_type, items):
+    """Converts decoded API objects into records of `record_type`."""
+    return [record_type(item) for item in items]
+
+def as_dict(entity):
+    """Returns a plain dict copy of a record or dict, e.g. for JSON serialisation."""
+    return entity.to_dict() if isinstance(entity, Record) else dict(entity)
+
+# Rough memory held per entity by an AlertDataset, index entries included (measured with
+# tracemalloc on the default fields; extra fields add to it).
+POLICY_BYTES = 250
+CONDITION_BYTES = 300
+AUDIT_EVENT_BYTES = 450
+RECORD_BYTES = {Policy: POLICY_BYTES, Condition: CONDITION_BYTES, AuditEvent: AUDIT_EVENT_BYTES}
+
+def estimated_bytes(records):
+    """Returns a rough estimate of the memory a list of records of one type holds, e.g. a fetch result."""
+    return len(records) * RECORD_BYTES.get(type(records[0]), AUDIT_EVENT_BYTES) if records else 0
+
+class AlertDataset:
+    """Indexed, read-only view of one account's policies, conditions and audit events.
+
+    Built once per fetch so that range queries and change lookups don't rescan the raw
+    lists: conditions are kept sorted by `updatedAt` for bisect range queries, audit
+    events are sorted by timestamp and indexed by `targetId` and `actorEmail`, and each
+    condition is joined to the audit events that changed it.
+    """
+
+    def __init__(self, policies, conditions, audit_events=None):
+        self.policies = policies
+        self.conditions = conditions
+        self.audit_events = audit_events or []
+        self.policy_names = {int(p['id']): p['name'] for p in policies}
+
+        # Conditions without an updatedAt can never match a date range, so they are not indexed.
+        dated = sorted((c for c in conditions if c.get('updatedAt')), key=lambda c: c['updatedAt'])
+        self._conditions_by_update = dated
+        self._update_times = [c['updatedAt'] for c in dated]
+
+        events = sorted(self.audit_events, key=lambda e: e.get('timestamp') or 0)
+        self._events_by_time = events
+        self._event_times = [e.get('timestamp') or 0 for e in events]
+        self._events_by_target = {}
+        self._events_by_actor = {}
+        self._condition_events = {}
+        for event in events:
+            target_id = event.get('targetId')
+            if target_id is not None:
+                self._events_by_target.setdefault(str(target_id), []).append(event)
+                if 'condition' in event.get('actionIdentifier', ''):
+                    self._condition_events.setdefault(str(target_id), []).append(event)
+            actor = event.get('actorEmail')
+            if actor:
+                self._events_by_actor.setdefault(actor, []).append(event)
+
+    def estimated_bytes(self):
+        """Returns a rough estimate of the memory the dataset holds, for cache budgeting."""
+        return (len(self.policies) * POLICY_BYTES + len(self.conditions) * CONDITION_BYTES
+                + len(self.audit_events) * AUDIT_EVENT_BYTES)
+
+    # --- Range Queries ---
+
+    def conditions_updated_between(self, since_ms, until_ms):
+        """Returns the conditions whose updatedAt lies in [since_ms, until_ms], oldest update first."""
+        return self._conditions_by_update[bisect_left(self._update_times, since_ms):bisect_right(self._update_times, until_ms)]
+
+    def events_between(self, since_ms, until_ms):
+        """Returns the audit events with a timestamp in [since_ms, until_ms), oldest first."""
+        return self._events_by_time[bisect_left(self._event_times, since_ms):bisect_left(self._event_times, until_ms)]
+
+    # --- Lookups ---
+
+    def policy_name(self, policy_id, default='Policy Not Found'):
+        return self.policy_names.get(int(policy_id), default)
+
+    def events_for_target(self, target_id):
+        """Returns every audit event whose targetId is `target_id`, oldest first."""
+        return self._events_by_target.get(str(target_id), [])
+
+    def events_by_actor(self, actor_email):
+        """Returns every audit event performed by `actor_email`, oldest first."""
+        return self._events_by_actor.get(actor_email, [])
+
+    def actors(self):
+        """Returns the e-mail addresses of everyone who appears in the audit events."""
+        return sorted(self._events_by_actor)
+
+    def condition_events(self, condition_id):
+        """Returns the audit events that changed a condition, oldest first."""
+        return self._condition_events.get(str(condition_id), [])
+
+    def condition_changes(self, condition_id):
+        """Summarises who changed a condition and how often, from the joined audit events.
+
+        Returns {'change_count', 'changed_by', 'last_changed_at'}; `changed_by` lists each
+        actor once, most recent first.
+        """
+        events = self.condition_events(condition_id)
+        changed_by = []
+        for event in reversed(events):
+            actor = event.get('actorEmail') or str(event.get('actorId') or '')
+            if actor and actor not in changed_by:
+                changed_by.append(actor)
+        return {
+            'change_count': len(events),
+            'changed_by': changed_by,
+            'last_changed_at': events[-1].get('timestamp') if events else None,
+        }
+
+    # --- Filtering ---
+
+    def select(self, conditions_since_ms, conditions_until_ms, events_window=None,
+               policy_pattern=None, actors=None, actions=None):
+        """Returns the (conditions, audit_events) that match every given criterion.
+
+        Conditions must have been updated in [conditions_since_ms, conditions_until_ms];
+        audit events must fall inside `events_window` (a [since_ms, until_ms) pair), if given.
+        `policy_pattern` is a case-insensitive glob on the policy name, which keeps conditions
+        of matching policies and the events that target them or their conditions. `actors`
+        (e-mail addresses) and `actions` (globs on actionIdentifier) filter the events, and
+        then keep only the conditions those events changed.
+        """
+        if actors:
+            wanted = {actor.lower() for actor in actors}
+            events = sorted((e for actor, actor_events in self._events_by_actor.items() if actor.lower() in wanted
+                             for e in actor_events), key=lambda e: e.get('timestamp') or 0)
+            if events_window:
+                events = [e for e in events if events_window[0] <= (e.get('timestamp') or 0) < events_window[1]]
+        elif events_window:
+            events = self.events_between(*events_window)
+        else:
+            events = self._events_by_time
+        if actions:
+            events = [e for e in events if any(fnmatchcase(e.get('actionIdentifier', ''), pattern) for pattern in actions)]
+
+        conditions = self.conditions_updated_between(conditions_since_ms, conditions_until_ms)
+        if policy_pattern:
+            pattern = policy_pattern.lower()
+            policy_ids = {policy_id for policy_id, name in self.policy_names.items() if fnmatchcase(name.lower(), pattern)}
+            policy_condition_ids = {str(c['id']) for c in self.conditions if int(c['policyId']) in policy_ids}
+            policy_id_strs = {str(policy_id) for policy_id in policy_ids}
+            conditions = [c for c in conditions if int(c['policyId']) in policy_ids]
+            events = [e for e in events if str(e.get('targetId')) in
+                      (policy_condition_ids if 'condition' in e.get('actionIdentifier', '') else policy_id_strs)]
+        if actors or actions:
+            changed_ids = {str(e.get('targetId')) for e in events if 'condition' in e.get('actionIdentifier', '')}
+            conditions = [c for c in conditions if str(c['id']) in changed_ids]
+        return conditions, list(events)
+
+    def changed_policy_ids(self, conditions):
+        """Returns the IDs of the policies the given conditions belong to."""
+        return {int(c['policyId']) for c in conditions}
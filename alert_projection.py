@@ -0,0 +1,76 @@
+import json
+import re
+from collections.abc import Mapping
+
+# Field lists behind the GraphQL selection sets and the NrAuditEvent SELECT list. Only
+# the fields the reports need are fetched by default; extra fields (e.g. a condition's
+# `nrql.query` or `terms.threshold`) can be added and end up as extra report columns.
+# Nested GraphQL fields are written as dotted paths.
+
+POLICY_FIELDS = ('id', 'name')
+CONDITION_FIELDS = ('policyId', 'id', 'name', 'updatedAt')
+AUDIT_FIELDS = (
+    'timestamp', 'actionIdentifier', 'actorEmail', 'actorId',
+    'targetId', 'targetType', 'targetName', 'description', 'changes'
+)
+
+GRAPHQL_FIELD_PATTERN = re.compile(r"^[_A-Za-z][_A-Za-z0-9]*(\.[_A-Za-z][_A-Za-z0-9]*)*$")
+NRQL_ATTRIBUTE_PATTERN = re.compile(r"^[^`,\s]+$")
+
+def parse_fields(text, base_fields=(), nrql=False):
+    """Parses a comma-separated field list into a tuple, dropping duplicates and fields in `base_fields`.
+
+    GraphQL fields are dotted paths of identifiers; NRQL attributes may be any name
+    without backticks, commas or whitespace. Raises ValueError for an invalid name.
+    """
+    pattern = NRQL_ATTRIBUTE_PATTERN if nrql else GRAPHQL_FIELD_PATTERN
+    fields = []
+    for field in (text or "").split(","):
+        field = field.strip()
+        if not field or field in base_fields or field in fields:
+            continue
+        if not pattern.match(field):
+            raise ValueError(f"Invalid field name '{field}'.")
+        fields.append(field)
+    return tuple(fields)
+
+def selection_set(fields):
+    """Returns the GraphQL selection set for a list of dotted field paths.
+
+    For example ('id', 'nrql.query', 'terms.threshold', 'terms.operator') becomes
+    "id nrql { query } terms { threshold operator }".
+    """
+    tree = {}
+    for field in fields:
+        node = tree
+        for part in field.split('.'):
+            node = node.setdefault(part, {})
+    return _render_selection(tree)
+
+def _render_selection(tree):
+    return " ".join(f"{name} {{ {_render_selection(children)} }}" if children else name
+                    for name, children in tree.items())
+
+def nrql_select(attributes):
+    """Returns the NRQL SELECT list for a list of attribute names, each quoted with backticks."""
+    return ", ".join(f"`{attribute}`" for attribute in attributes)
+
+def field_value(entity, path):
+    """Returns the value at a dotted path, collecting one value per item when the path crosses a list."""
+    value = entity
+    for part in path.split('.'):
+        if isinstance(value, list):
+            value = [item.get(part) if isinstance(item, Mapping) else None for item in value]
+        elif isinstance(value, Mapping):
+            value = value.get(part)
+        else:
+            return None
+    return value
+
+def format_value(value):
+    """Renders a field value for a CSV cell: lists, objects and booleans as JSON, None as an empty string."""
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list, bool)):
+        return json.dumps(value)
+    return value
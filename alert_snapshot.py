@@ -0,0 +1,299 @@
+import gzip
+import hashlib
+import io
+import json
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import alert_analyzer_lib as analyzer
+import alert_projection as projection
+
+# Snapshots of the alert configuration (policies and NRQL conditions) of one or more
+# accounts, and diffs between two snapshots: two points in time of the same account,
+# or two accounts that should match (e.g. staging and production).
+#
+# A snapshot is gzip-compressed JSON. Each condition is stored as
+# [id, policy_id, updated_at, hash, values], where `values` lines up with the
+# snapshot's `fields` (policy name, condition name, then the configuration fields) and
+# `hash` is a digest of those values. Two snapshots are compared hash by hash; values
+# are only compared field by field for conditions whose hash differs.
+
+SNAPSHOT_FORMAT = "nr-alert-snapshot"
+SNAPSHOT_VERSION = 1
+HASH_HEX_DIGITS = 16
+# gzip level 6 is about as small as 9 for snapshots, at less than half the time.
+SNAPSHOT_COMPRESS_LEVEL = 6
+# Largest snapshot JSON accepted when loading, after decompression (about 500,000 conditions).
+MAX_SNAPSHOT_BYTES = 256 * 1024 * 1024
+
+# Configuration fields of a NRQL condition that are compared, as dotted GraphQL paths.
+SNAPSHOT_CONDITION_FIELDS = (
+    'enabled', 'description', 'runbookUrl', 'type', 'violationTimeLimitSeconds', 'nrql.query',
+    'terms.operator', 'terms.priority', 'terms.threshold', 'terms.thresholdDuration', 'terms.thresholdOccurrences',
+    'signal.aggregationWindow', 'signal.aggregationMethod', 'signal.aggregationDelay', 'signal.fillOption', 'signal.fillValue',
+    'expiration.expirationDuration', 'expiration.closeViolationsOnExpiration', 'expiration.openViolationOnExpiration',
+)
+# Leading entries of every condition's values.
+IDENTITY_FIELDS = ('policy', 'name')
+
+DIFF_BY = ('auto', 'id', 'name')
+DIFF_CHANGES = ('added', 'removed', 'modified')
+# Rough memory held per change of a diff, the condition row it references included (measured with tracemalloc).
+DIFF_CHANGE_BYTES = 600
+DIFF_CSV_HEADER = [
+    'change', 'policy_name', 'condition_name', 'old_account_id', 'old_condition_id',
+    'new_account_id', 'new_condition_id', 'changed_fields', 'before', 'after'
+]
+
+class SnapshotError(ValueError):
+    """Raised when data is not a valid snapshot, or is too large to load."""
+
+# --- Snapshots ---
+
+def snapshot_fields():
+    """Returns the configuration fields a new snapshot records: the defaults plus any extra condition fields."""
+    return SNAPSHOT_CONDITION_FIELDS + tuple(f for f in analyzer.extra_condition_fields() if f not in SNAPSHOT_CONDITION_FIELDS)
+
+def content_hash(values):
+    """Returns a short, stable digest of a condition's values."""
+    text = json.dumps(values, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(text.encode()).hexdigest()[:HASH_HEX_DIGITS]
+
+def build_account_snapshot(account_id, policies, conditions, fields):
+    """Returns the snapshot entry for one account's policies and conditions.
+
+    `conditions` is only iterated once, so it can be a stream of fetched pages.
+    """
+    policy_names = {int(p['id']): p['name'] for p in policies}
+    rows = []
+    for condition in conditions:
+        policy_id = int(condition['policyId'])
+        values = [policy_names.get(policy_id), condition.get('name')]
+        values += [projection.field_value(condition, field) for field in fields]
+        rows.append([int(condition['id']), policy_id, condition.get('updatedAt'), content_hash(values), values])
+    return {'account_id': account_id, 'policies': [[policy_id, name] for policy_id, name in policy_names.items()],
+            'conditions': rows}
+
+def fetch_account_snapshot(api_key, account_id, fields, rate_limiter=None):
+    """Fetches one account's policies and conditions (with `fields`) and returns its snapshot entry.
+
+    Conditions are turned into snapshot rows page by page as they arrive, so the fetched
+    condition records are never all held at once. Returns a dict with `account_id` and
+    `error` set if a fetch failed.
+    """
+    with analyzer.phase_timer('fetch_snapshot') as timing:
+        policies = analyzer.fetch_all_data(api_key, account_id, analyzer.POLICIES_QUERY, "alerts.policiesSearch", "policies",
+                                           rate_limiter=rate_limiter)
+        if policies is None:
+            return {'account_id': account_id, 'error': "Failed to fetch policies."}
+        pages = analyzer.iter_all_data(api_key, account_id, analyzer.conditions_query(fields),
+                                       "alerts.nrqlConditionsSearch", "nrqlConditions", rate_limiter=rate_limiter)
+        try:
+            entry = build_account_snapshot(account_id, policies, (c for page in pages for c in page), fields)
+        except (analyzer.GraphQLError, requests.exceptions.RequestException) as e:
+            return {'account_id': account_id, 'error': f"Failed to fetch conditions: {e}"}
+        timing['entities'] = len(entry['conditions'])
+    return dict(entry, error=None)
+
+def take_snapshot(api_key, account_ids, max_workers=analyzer.DEFAULT_MAX_WORKERS,
+                  requests_per_second=analyzer.DEFAULT_REQUESTS_PER_SECOND):
+    """Snapshots several accounts in parallel. Returns (snapshot, failed) where `failed` maps account IDs to errors."""
+    fields = snapshot_fields()
+    rate_limiter = analyzer.get_rate_limiter(api_key, requests_per_second)
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(account_ids)))) as executor:
+        entries = list(executor.map(lambda account_id: fetch_account_snapshot(api_key, account_id, fields, rate_limiter),
+                                    account_ids))
+    failed = {entry['account_id']: entry['error'] for entry in entries if entry['error']}
+    accounts = [{key: value for key, value in entry.items() if key != 'error'} for entry in entries if not entry['error']]
+    return new_snapshot(accounts, fields), failed
+
+def new_snapshot(accounts, fields):
+    return {
+        'format': SNAPSHOT_FORMAT,
+        'version': SNAPSHOT_VERSION,
+        'created_at': int(time.time() * 1000),
+        'fields': list(IDENTITY_FIELDS) + list(fields),
+        'accounts': accounts,
+    }
+
+def write_snapshot(path, snapshot):
+    """Writes a snapshot as gzip-compressed JSON."""
+    data = json.dumps(snapshot, separators=(',', ':')).encode()
+    with open(path, "wb") as f:
+        f.write(gzip.compress(data, SNAPSHOT_COMPRESS_LEVEL))
+
+def load_snapshot(data, max_bytes=MAX_SNAPSHOT_BYTES):
+    """Parses a snapshot from bytes (gzip-compressed or plain JSON).
+
+    Raises SnapshotError if it is not one, or if its JSON is larger than `max_bytes`;
+    compressed data is never decompressed past that limit.
+    """
+    if data[:2] == b"\x1f\x8b":
+        try:
+            with gzip.GzipFile(fileobj=io.BytesIO(data)) as f:
+                data = f.read(max_bytes + 1)
+        except (OSError, EOFError, zlib.error) as e:
+            raise SnapshotError(f"Not a valid snapshot: {e}") from None
+    if len(data) > max_bytes:
+        raise SnapshotError(f"Snapshot is larger than {max_bytes // (1024 * 1024)} MB.")
+    try:
+        snapshot = analyzer.decode_json(data)
+    except ValueError as e:
+        raise SnapshotError(f"Not a valid snapshot: {e}") from None
+    if not isinstance(snapshot, dict) or snapshot.get('format') != SNAPSHOT_FORMAT:
+        raise SnapshotError("Not a valid snapshot: unknown file format.")
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        raise SnapshotError(f"Unsupported snapshot version {snapshot.get('version')}.")
+    _check_shape(snapshot)
+    return snapshot
+
+def _check_shape(snapshot):
+    """Raises SnapshotError unless the snapshot has the accounts, policies and condition rows diffs rely on."""
+    fields = snapshot.get('fields')
+    if not isinstance(fields, list) or fields[:len(IDENTITY_FIELDS)] != list(IDENTITY_FIELDS):
+        raise SnapshotError("Not a valid snapshot: missing or invalid field list.")
+    if not isinstance(snapshot.get('created_at'), (int, float)) or not isinstance(snapshot.get('accounts'), list):
+        raise SnapshotError("Not a valid snapshot: missing creation time or accounts.")
+    for account in snapshot['accounts']:
+        if (not isinstance(account, dict) or not isinstance(account.get('account_id'), int)
+                or not isinstance(account.get('policies'), list) or not isinstance(account.get('conditions'), list)):
+            raise SnapshotError("Not a valid snapshot: each account needs an account_id, policies and conditions.")
+        for row in account['conditions']:
+            if (not isinstance(row, list) or len(row) != 5 or not isinstance(row[0], int)
+                    or not isinstance(row[4], list) or len(row[4]) != len(fields)):
+                raise SnapshotError(f"Not a valid snapshot: malformed condition in account {account['account_id']}.")
+
+def read_snapshot(path):
+    with open(path, "rb") as f:
+        return load_snapshot(f.read())
+
+def snapshot_summary(snapshot):
+    """Describes a snapshot for display: its accounts, policy and condition counts and when it was taken."""
+    accounts = snapshot['accounts']
+    taken = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(snapshot['created_at'] / 1000))
+    return (f"account(s) {', '.join(str(a['account_id']) for a in accounts)}: "
+            f"{sum(len(a['policies']) for a in accounts)} policies, "
+            f"{sum(len(a['conditions']) for a in accounts)} conditions, taken {taken}")
+
+# --- Diff ---
+
+def _keyed_conditions(snapshot, by):
+    """Maps each condition's match key to (account_id, row).
+
+    By 'id' the key is (account_id, condition_id). By 'name' it is (policy name,
+    condition name, n), where n numbers conditions sharing both names in ID order.
+    """
+    keyed = {}
+    for account in snapshot['accounts']:
+        account_id = account['account_id']
+        for row in sorted(account['conditions'], key=lambda r: r[0]):
+            if by == 'id':
+                keyed[(account_id, row[0])] = (account_id, row)
+                continue
+            key = (row[4][0], row[4][1], 0)
+            while key in keyed:
+                key = key[:2] + (key[2] + 1,)
+            keyed[key] = (account_id, row)
+    return keyed
+
+def _comparable(snapshot, fields):
+    """Returns a function giving (hash, values) of a row restricted to `fields`, rehashing only if the field lists differ."""
+    if snapshot['fields'] == fields:
+        return lambda row: (row[3], row[4])
+    indexes = [snapshot['fields'].index(field) for field in fields]
+
+    def restrict(row):
+        values = [row[4][i] for i in indexes]
+        return content_hash(values), values
+    return restrict
+
+def diff_snapshots(old, new, by='auto'):
+    """Compares two snapshots and returns the added, removed and modified conditions.
+
+    `by` chooses how conditions are matched: 'id' matches the same condition ID in the
+    same account (a change over time); 'name' matches the policy and condition names
+    (drift between two accounts, each snapshot holding one account). 'auto' uses 'id'
+    when both snapshots cover the same accounts and 'name' otherwise. Only the fields
+    recorded by both snapshots are compared. Raises ValueError if 'name' is used with
+    snapshots of several accounts.
+    """
+    old_accounts = [a['account_id'] for a in old['accounts']]
+    new_accounts = [a['account_id'] for a in new['accounts']]
+    if by == 'auto':
+        by = 'id' if sorted(old_accounts) == sorted(new_accounts) else 'name'
+    if by == 'name' and (len(old_accounts) != 1 or len(new_accounts) != 1):
+        raise ValueError("Matching by name compares one account with another; each snapshot must hold exactly one account.")
+
+    with analyzer.phase_timer('diff') as timing:
+        fields = [field for field in old['fields'] if field in new['fields']]
+        old_comparable, new_comparable = _comparable(old, fields), _comparable(new, fields)
+        old_keyed, new_keyed = _keyed_conditions(old, by), _keyed_conditions(new, by)
+        changes = {change: [] for change in DIFF_CHANGES}
+        unchanged = 0
+        for key, (new_account_id, new_row) in new_keyed.items():
+            new_hash, new_values = new_comparable(new_row)
+            if key not in old_keyed:
+                changes['added'].append(_change('added', None, None, new_account_id, new_row, new_values))
+                continue
+            old_account_id, old_row = old_keyed[key]
+            old_hash, old_values = old_comparable(old_row)
+            if old_hash == new_hash:
+                unchanged += 1
+                continue
+            change = _change('modified', old_account_id, old_row, new_account_id, new_row, new_values)
+            changed = [i for i, (before, after) in enumerate(zip(old_values, new_values)) if before != after]
+            change['changed_fields'] = [fields[i] for i in changed]
+            change['before'] = {fields[i]: old_values[i] for i in changed}
+            change['after'] = {fields[i]: new_values[i] for i in changed}
+            changes['modified'].append(change)
+        for key, (old_account_id, old_row) in old_keyed.items():
+            if key not in new_keyed:
+                changes['removed'].append(_change('removed', old_account_id, old_row, None, None, old_comparable(old_row)[1]))
+        timing['entities'] = len(old_keyed) + len(new_keyed)
+
+    for change in DIFF_CHANGES:
+        changes[change].sort(key=lambda c: ((c['policy_name'] or '').lower(), (c['condition_name'] or '').lower()))
+    return dict(changes, by=by, unchanged=unchanged, fields=fields)
+
+def _change(change, old_account_id, old_row, new_account_id, new_row, values):
+    return {
+        'change': change,
+        'policy_name': values[0],
+        'condition_name': values[1],
+        'old_account_id': old_account_id,
+        'old_condition_id': old_row[0] if old_row else None,
+        'new_account_id': new_account_id,
+        'new_condition_id': new_row[0] if new_row else None,
+        'changed_fields': [],
+        'before': None,
+        'after': None,
+    }
+
+def diff_estimated_bytes(diff):
+    """Returns a rough estimate of the memory a diff holds, for cache budgeting."""
+    return sum(len(diff[change]) for change in DIFF_CHANGES) * DIFF_CHANGE_BYTES
+
+def diff_counts(diff):
+    return {change: len(diff[change]) for change in DIFF_CHANGES}
+
+def iter_diff_changes(diff):
+    """Yields every change of a diff: modified first, then added, then removed."""
+    for change in ('modified', 'added', 'removed'):
+        yield from diff[change]
+
+def _diff_rows(diff):
+    for change in iter_diff_changes(diff):
+        yield [
+            change['change'], change['policy_name'], change['condition_name'],
+            change['old_account_id'], change['old_condition_id'], change['new_account_id'], change['new_condition_id'],
+            "; ".join(change['changed_fields']),
+            json.dumps(change['before']) if change['before'] is not None else '',
+            json.dumps(change['after']) if change['after'] is not None else '',
+        ]
+
+def write_diff_csv(output, diff):
+    """Streams the diff report to a file object. Returns the number of data rows."""
+    stats = {'rows': 0}
+    output.writelines(analyzer.iter_csv(_diff_rows(diff), DIFF_CSV_HEADER, stats=stats))
+    return stats['rows']
@@ -0,0 +1,315 @@
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import alert_analyzer_lib as analyzer
+import alert_model
+
+DEFAULT_STORE_PATH = "nr_alert_audit.db"
+
+# Audit events can take a few minutes to become queryable, so each incremental
+# sync re-reads this much time before the high-water mark. Duplicates are ignored.
+SYNC_OVERLAP_MS = 5 * 60 * 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS policies (
+    account_id INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (account_id, id)
+);
+CREATE TABLE IF NOT EXISTS conditions (
+    account_id INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    policy_id INTEGER NOT NULL,
+    updated_at INTEGER,
+    data TEXT NOT NULL,
+    PRIMARY KEY (account_id, id)
+);
+CREATE TABLE IF NOT EXISTS audit_events (
+    account_id INTEGER NOT NULL,
+    event_key TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (account_id, event_key)
+);
+CREATE INDEX IF NOT EXISTS audit_events_by_time ON audit_events (account_id, timestamp);
+CREATE TABLE IF NOT EXISTS sync_state (
+    account_id INTEGER PRIMARY KEY,
+    audit_since INTEGER NOT NULL,
+    high_water_mark INTEGER NOT NULL,
+    last_full_sync INTEGER NOT NULL,
+    last_sync INTEGER NOT NULL
+);
+"""
+
+class AlertStore:
+    """SQLite snapshot of each account's policies, conditions and audit events.
+
+    `sync_state` records, per account, the audit event window already stored:
+    everything between `audit_since` and the `high_water_mark` (epoch ms).
+    """
+
+    def __init__(self, path=DEFAULT_STORE_PATH):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # --- Policies and Conditions ---
+
+    def replace_policies(self, account_id, policies):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM policies WHERE account_id = ?", (account_id,))
+            self._insert_policies(account_id, policies)
+
+    def upsert_policies(self, account_id, policies):
+        with self._lock, self._conn:
+            self._insert_policies(account_id, policies)
+
+    def _insert_policies(self, account_id, policies):
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO policies (account_id, id, data) VALUES (?, ?, ?)",
+            [(account_id, int(p['id']), json.dumps(alert_model.as_dict(p))) for p in policies]
+        )
+
+    def delete_policies(self, account_id, policy_ids):
+        """Deletes policies together with the conditions that belonged to them."""
+        with self._lock, self._conn:
+            for policy_id in policy_ids:
+                self._conn.execute("DELETE FROM policies WHERE account_id = ? AND id = ?", (account_id, int(policy_id)))
+                self._conn.execute("DELETE FROM conditions WHERE account_id = ? AND policy_id = ?", (account_id, int(policy_id)))
+
+    def get_policies(self, account_id):
+        with self._lock:
+            rows = self._conn.execute("SELECT data FROM policies WHERE account_id = ? ORDER BY id", (account_id,)).fetchall()
+        return [alert_model.Policy(analyzer.decode_json(data)) for (data,) in rows]
+
+    def replace_conditions(self, account_id, conditions):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM conditions WHERE account_id = ?", (account_id,))
+            self._insert_conditions(account_id, conditions)
+
+    def upsert_conditions(self, account_id, conditions):
+        with self._lock, self._conn:
+            self._insert_conditions(account_id, conditions)
+
+    def _insert_conditions(self, account_id, conditions):
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO conditions (account_id, id, policy_id, updated_at, data) VALUES (?, ?, ?, ?, ?)",
+            [(account_id, int(c['id']), int(c['policyId']), c.get('updatedAt'), json.dumps(alert_model.as_dict(c)))
+             for c in conditions]
+        )
+
+    def delete_conditions(self, account_id, condition_ids):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "DELETE FROM conditions WHERE account_id = ? AND id = ?",
+                [(account_id, int(condition_id)) for condition_id in condition_ids]
+            )
+
+    def get_conditions(self, account_id):
+        with self._lock:
+            rows = self._conn.execute("SELECT data FROM conditions WHERE account_id = ? ORDER BY id", (account_id,)).fetchall()
+        return [alert_model.Condition(analyzer.decode_json(data)) for (data,) in rows]
+
+    # --- Audit Events ---
+
+    def add_audit_events(self, account_id, events):
+        """Stores audit events, skipping ones already stored. Returns how many were new."""
+        with self._lock, self._conn:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO audit_events (account_id, event_key, timestamp, data) VALUES (?, ?, ?, ?)",
+                [(account_id, analyzer.audit_event_key(e), int(e.get('timestamp', 0)), json.dumps(alert_model.as_dict(e)))
+                 for e in events]
+            )
+            return self._conn.total_changes - before
+
+    def unseen_audit_events(self, account_id, events):
+        """Returns the audit events that are not stored yet, in their original order."""
+        with self._lock:
+            unseen = [
+                event for event in events if self._conn.execute(
+                    "SELECT 1 FROM audit_events WHERE account_id = ? AND event_key = ?",
+                    (account_id, analyzer.audit_event_key(event))
+                ).fetchone() is None
+            ]
+        return unseen
+
+    def get_audit_events(self, account_id, since_ms, until_ms):
+        """Returns stored audit events in [since_ms, until_ms), oldest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT data FROM audit_events WHERE account_id = ? AND timestamp >= ? AND timestamp < ? ORDER BY timestamp",
+                (account_id, since_ms, until_ms)
+            ).fetchall()
+        return [alert_model.AuditEvent(analyzer.decode_json(data)) for (data,) in rows]
+
+    # --- Sync State ---
+
+    def get_sync_state(self, account_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT audit_since, high_water_mark, last_full_sync, last_sync FROM sync_state WHERE account_id = ?",
+                (account_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('audit_since', 'high_water_mark', 'last_full_sync', 'last_sync'), row))
+
+    def set_sync_state(self, account_id, audit_since, high_water_mark, last_full_sync, last_sync):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sync_state (account_id, audit_since, high_water_mark, last_full_sync, last_sync) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (account_id, audit_since, high_water_mark, last_full_sync, last_sync)
+            )
+
+# --- Incremental Sync ---
+
+def touched_entity_ids(audit_events):
+    """Returns the (condition_ids, policy_ids) targeted by a list of alert audit events."""
+    condition_ids, policy_ids = set(), set()
+    for event in audit_events:
+        action = event.get('actionIdentifier', '')
+        target_id = event.get('targetId')
+        if not target_id or not str(target_id).isdigit():
+            continue
+        if 'condition' in action:
+            condition_ids.add(int(target_id))
+        elif 'policy' in action:
+            policy_ids.add(int(target_id))
+    return condition_ids, policy_ids
+
+def _refresh_entities(api_key, account_id, query, entity_key, entity_ids, rate_limiter):
+    """Re-fetches entities by ID. Returns (found, deleted_ids), or None if any fetch failed."""
+    ids = sorted(entity_ids)
+    with ThreadPoolExecutor(max_workers=analyzer.DEFAULT_AUDIT_SLICE_WORKERS) as executor:
+        fetched = list(executor.map(
+            lambda entity_id: analyzer.fetch_entity(api_key, account_id, query, entity_key, entity_id, rate_limiter), ids
+        ))
+    if any(entity is None for entity in fetched):
+        return None
+    found = [entity for entity in fetched if entity]
+    deleted_ids = [entity_id for entity_id, entity in zip(ids, fetched) if not entity]
+    return found, deleted_ids
+
+def _full_sync(store, api_key, account_id, start_date_str, end_date_str, rate_limiter):
+    since_ms, until_ms = analyzer.date_range_to_epoch_ms(start_date_str, end_date_str)
+    now_ms = int(time.time() * 1000)
+    policies, conditions, audit_events = analyzer.fetch_account_data_concurrently(
+        api_key, account_id, start_date_str, end_date_str, rate_limiter=rate_limiter, sliced_audit=True
+    )
+    store.replace_policies(account_id, policies)
+    store.replace_conditions(account_id, conditions)
+    store.add_audit_events(account_id, audit_events)
+    store.set_sync_state(account_id, since_ms, min(until_ms, now_ms), now_ms, now_ms)
+
+def _incremental_sync(store, api_key, account_id, state, since_ms, rate_limiter):
+    """Fetches and stores what changed since the high-water mark and returns the delta.
+
+    The delta dict holds the newly stored `audit_events`, the re-fetched `policies` and
+    `conditions`, the `deleted_policy_ids` and `deleted_condition_ids`, and the
+    [`since_ms`, `until_ms`) window that was polled.
+    """
+    now_ms = int(time.time() * 1000)
+    poll_since_ms = max(state['audit_since'], state['high_water_mark'] - SYNC_OVERLAP_MS)
+    new_events = analyzer.fetch_audit_events_between(
+        api_key, account_id, poll_since_ms, now_ms, slice_hours=None, rate_limiter=rate_limiter
+    )
+    if new_events is None:
+        raise analyzer.FetchError({'audit_events': "Failed to fetch new audit events."}, {})
+    # Events from the overlap that are already stored were handled by an earlier sync.
+    new_events = store.unseen_audit_events(account_id, new_events)
+    audit_since = state['audit_since']
+    if since_ms < audit_since:
+        older_events = analyzer.fetch_audit_events_between(api_key, account_id, since_ms, audit_since, rate_limiter=rate_limiter)
+        if older_events is None:
+            raise analyzer.FetchError({'audit_events': "Failed to fetch older audit events."}, {})
+        store.add_audit_events(account_id, older_events)
+        audit_since = since_ms
+
+    condition_ids, policy_ids = touched_entity_ids(new_events)
+    refreshed_policies = _refresh_entities(api_key, account_id, analyzer.POLICY_QUERY, "policy", policy_ids, rate_limiter)
+    if refreshed_policies is None:
+        raise analyzer.FetchError({'policies': "Failed to refresh changed policies."}, {})
+    refreshed_conditions = _refresh_entities(api_key, account_id, analyzer.condition_query(), "nrqlCondition", condition_ids, rate_limiter)
+    if refreshed_conditions is None:
+        raise analyzer.FetchError({'conditions': "Failed to refresh changed conditions."}, {})
+
+    store.upsert_policies(account_id, refreshed_policies[0])
+    store.delete_policies(account_id, refreshed_policies[1])
+    store.upsert_conditions(account_id, refreshed_conditions[0])
+    store.delete_conditions(account_id, refreshed_conditions[1])
+    store.add_audit_events(account_id, new_events)
+    # The high-water mark only moves once everything above has been stored.
+    store.set_sync_state(account_id, audit_since, now_ms, state['last_full_sync'], now_ms)
+    return {
+        'since_ms': poll_since_ms,
+        'until_ms': now_ms,
+        'audit_events': new_events,
+        'policies': refreshed_policies[0],
+        'deleted_policy_ids': refreshed_policies[1],
+        'conditions': refreshed_conditions[0],
+        'deleted_condition_ids': refreshed_conditions[1],
+    }
+
+def poll_account(store, api_key, account_id, rate_limiter=None):
+    """Fetches what changed in an already synced account since its last sync.
+
+    Unlike sync_account, nothing is read back from the store: the result is the delta
+    returned by _incremental_sync, plus `account_id` and `error`.
+    """
+    state = store.get_sync_state(account_id)
+    if state is None:
+        return {'account_id': account_id, 'error': "Account has not been synced yet."}
+    try:
+        delta = _incremental_sync(store, api_key, account_id, state, state['audit_since'], rate_limiter)
+    except analyzer.FetchError as e:
+        return {'account_id': account_id, 'error': str(e)}
+    return dict(delta, account_id=account_id, error=None)
+
+def sync_account(store, api_key, account_id, start_date_str, end_date_str, rate_limiter=None, full=False):
+    """Brings the store up to date for an account and returns its audit result.
+
+    The first sync (or any sync with `full`) fetches everything. Later syncs only fetch
+    audit events newer than the account's high-water mark and re-fetch the policies and
+    conditions those events touched. The returned dict has the same shape as
+    analyzer.run_account_audit, read back from the store.
+    """
+    result = {'account_id': account_id, 'error': None}
+    try:
+        since_ms, until_ms = analyzer.date_range_to_epoch_ms(start_date_str, end_date_str)
+    except ValueError as e:
+        result['error'] = f"Invalid date format. Please use YYYY-MM-DD. Details: {e}"
+        return result
+    try:
+        state = store.get_sync_state(account_id)
+        if state is None or full:
+            _full_sync(store, api_key, account_id, start_date_str, end_date_str, rate_limiter)
+            result['sync'] = 'full'
+        else:
+            delta = _incremental_sync(store, api_key, account_id, state, since_ms, rate_limiter)
+            refreshed_count = len(delta['conditions']) + len(delta['deleted_condition_ids'])
+            result['sync'] = f"incremental ({len(delta['audit_events'])} new audit events, {refreshed_count} conditions refreshed)"
+    except analyzer.FetchError as e:
+        result['error'] = str(e)
+        return result
+
+    policies = store.get_policies(account_id)
+    conditions = store.get_conditions(account_id)
+    audit_events = store.get_audit_events(account_id, since_ms, until_ms)
+    dataset = analyzer.build_dataset(policies, conditions, audit_events)
+    result['policies'] = policies
+    result['conditions'] = conditions
+    result['filtered_conditions'] = analyzer.filter_conditions_by_date(conditions, start_date_str, end_date_str, dataset)
+    result['audit_events'] = audit_events
+    result['dataset'] = dataset
+    return result
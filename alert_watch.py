@@ -0,0 +1,180 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import requests
+import alert_analyzer_lib as analyzer
+import alert_model
+import alert_store
+
+# Continuous ("watch") mode. After the initial sync, each account's audit log is polled
+# every `interval` seconds for the slice since its last poll. New audit events and the
+# conditions they changed are appended to the CSV reports and sent to the notification
+# sinks. The HTTP session, rate limiter, snapshot store and policy names stay warm in
+# the one long-running process.
+
+DEFAULT_WATCH_INTERVAL_SECONDS = 60
+MIN_WATCH_INTERVAL_SECONDS = 5
+WEBHOOK_TIMEOUT_SECONDS = 10
+
+# --- Notification Sinks ---
+
+def file_sink(path):
+    """Returns a sink that appends each notification to `path` as one JSON line."""
+    def send(notification):
+        with open(path, "a") as f:
+            f.write(json.dumps(notification) + "\n")
+    return send
+
+def webhook_sink(url):
+    """Returns a sink that POSTs each notification to `url` as JSON."""
+    def send(notification):
+        response = analyzer.get_session().post(url, json=notification, timeout=WEBHOOK_TIMEOUT_SECONDS)
+        response.raise_for_status()
+    return send
+
+def build_notification(delta, dataset):
+    """Summarises one account's poll: the window polled, the changed conditions and policies, and the new audit events."""
+    changed_conditions = []
+    for condition in delta['conditions']:
+        changes = dataset.condition_changes(condition['id'])
+        changed_conditions.append({
+            'id': int(condition['id']),
+            'name': condition.get('name'),
+            'policy_id': int(condition['policyId']),
+            'policy_name': dataset.policy_name(condition['policyId']),
+            'updated_at': condition.get('updatedAt'),
+            'changed_by': changes['changed_by'],
+            'change_count': changes['change_count'],
+        })
+    return {
+        'account_id': delta['account_id'],
+        'since': delta['since_ms'],
+        'until': delta['until_ms'],
+        'changed_conditions': changed_conditions,
+        'deleted_condition_ids': delta['deleted_condition_ids'],
+        'changed_policies': [{'id': int(p['id']), 'name': p.get('name')} for p in delta['policies']],
+        'deleted_policy_ids': delta['deleted_policy_ids'],
+        'audit_events': [
+            {field: event.get(field) for field in ('timestamp', 'actionIdentifier', 'actorEmail', 'targetId', 'targetName')}
+            for event in delta['audit_events']
+        ],
+    }
+
+def _notify(sinks, notification):
+    """Sends a notification to every sink. A failing sink is reported but does not stop the watch."""
+    delivered = 0
+    for send in sinks:
+        try:
+            send(notification)
+            delivered += 1
+        except (OSError, requests.RequestException) as e:
+            print(f"  ❌ Could not deliver notification for account {notification['account_id']}: {e}")
+    return delivered
+
+# --- Appending to the Reports ---
+
+def _append_csv(path, writer, *args):
+    """Appends rows to a CSV report, writing the header first if the file does not exist yet."""
+    header = not os.path.exists(path) or os.path.getsize(path) == 0
+    with open(path, "a", newline="") as f:
+        return writer(f, *args, header=header)
+
+def append_reports(changes, alerts_path, audit_path, multi_account):
+    """Appends the changed conditions and new audit events of one poll to the reports.
+
+    `changes` is a list of (delta, dataset) pairs. Multi-account reports get the
+    account_id column, like the ones written by the initial run.
+    """
+    if multi_account:
+        results = [{'account_id': delta['account_id'], 'error': None, 'policies': dataset.policies,
+                    'filtered_conditions': delta['conditions'], 'audit_events': delta['audit_events'], 'dataset': dataset}
+                   for delta, dataset in changes]
+        if any(result['filtered_conditions'] for result in results):
+            _append_csv(alerts_path, analyzer.write_multi_account_alerts_csv, results)
+        if any(result['audit_events'] for result in results):
+            _append_csv(audit_path, analyzer.write_multi_account_audit_csv, results)
+        return
+    for delta, dataset in changes:
+        if delta['conditions']:
+            _append_csv(alerts_path, analyzer.write_alerts_csv, dataset.policies, delta['conditions'],
+                        delta['account_id'], dataset)
+        if delta['audit_events']:
+            _append_csv(audit_path, analyzer.write_audit_csv, delta['audit_events'])
+
+# --- Watch Loop ---
+
+def _has_changes(delta):
+    return any(delta[key] for key in ('audit_events', 'conditions', 'deleted_condition_ids', 'policies', 'deleted_policy_ids'))
+
+def _apply_policy_changes(account_policies, delta):
+    for policy in delta['policies']:
+        account_policies[int(policy['id'])] = policy
+    for policy_id in delta['deleted_policy_ids']:
+        account_policies.pop(int(policy_id), None)
+
+def watch(store, api_key, account_ids, interval=DEFAULT_WATCH_INTERVAL_SECONDS, sinks=(), alerts_path=None, audit_path=None,
+          rate_limit=analyzer.DEFAULT_REQUESTS_PER_SECOND, concurrency=analyzer.DEFAULT_MAX_WORKERS,
+          max_polls=None, stop_event=None):
+    """Polls already synced accounts every `interval` seconds until interrupted.
+
+    Stops after `max_polls` polls or when `stop_event` is set, if given. Accounts that
+    have never been synced into `store` are skipped. Returns counters for the whole watch.
+    """
+    totals = {'polls': 0, 'audit_events': 0, 'conditions': 0, 'notifications': 0, 'errors': 0}
+    synced = [account_id for account_id in account_ids if store.get_sync_state(account_id)]
+    for account_id in sorted(set(account_ids) - set(synced)):
+        print(f"  Skipping account {account_id}: it has not been synced yet.")
+    if not synced:
+        return totals
+
+    multi_account = len(account_ids) > 1
+    stop_event = stop_event or threading.Event()
+    rate_limiter = analyzer.get_rate_limiter(api_key, rate_limit)
+    policies = {account_id: {int(p['id']): p for p in store.get_policies(account_id)} for account_id in synced}
+
+    def poll(account_id):
+        return alert_store.poll_account(store, api_key, account_id, rate_limiter)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(synced)))) as executor:
+        try:
+            while not stop_event.is_set():
+                started = time.monotonic()
+                with analyzer.phase_timer('watch_poll') as timing:
+                    deltas = list(executor.map(poll, synced))
+                    timing['entities'] = sum(len(d.get('audit_events', ())) for d in deltas)
+                totals['polls'] += 1
+
+                changes = []
+                polled_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                for delta in deltas:
+                    if delta['error']:
+                        totals['errors'] += 1
+                        print(f"[{polled_at}] ❌ Account {delta['account_id']}: {delta['error']}")
+                        continue
+                    account_policies = policies[delta['account_id']]
+                    _apply_policy_changes(account_policies, delta)
+                    if not _has_changes(delta):
+                        continue
+                    dataset = alert_model.AlertDataset(list(account_policies.values()), delta['conditions'], delta['audit_events'])
+                    changes.append((delta, dataset))
+                    totals['audit_events'] += len(delta['audit_events'])
+                    totals['conditions'] += len(delta['conditions']) + len(delta['deleted_condition_ids'])
+                    print(f"[{polled_at}] Account {delta['account_id']}: {len(delta['audit_events'])} new audit events, "
+                          f"{len(delta['conditions'])} conditions changed, {len(delta['deleted_condition_ids'])} deleted.")
+
+                if changes:
+                    if alerts_path and audit_path:
+                        append_reports(changes, alerts_path, audit_path, multi_account)
+                    for delta, dataset in changes:
+                        if sinks and _notify(sinks, build_notification(delta, dataset)):
+                            totals['notifications'] += 1
+
+                if max_polls is not None and totals['polls'] >= max_polls:
+                    break
+                stop_event.wait(max(0.0, interval - (time.monotonic() - started)))
+        except KeyboardInterrupt:
+            print("\nStopping watch...")
+    return totals
@@ -0,0 +1,168 @@
+import json
+import alert_analyzer_lib as analyzer
+import alert_model
+import alert_projection as projection
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Columnar (Parquet / Arrow IPC) versions of the alerts and audit reports. Columns keep
+# their native types: timestamps stay timestamps, IDs are integers and repetitive text
+# columns are dictionary-encoded, so downstream tools can load the files without
+# re-parsing CSV text. Requires the optional `pyarrow` package.
+
+FORMATS = ('parquet', 'arrow')
+FILE_EXTENSIONS = {'csv': '.csv', 'parquet': '.parquet', 'arrow': '.arrows'}
+DEFAULT_COMPRESSION = 'zstd'
+DEFAULT_BATCH_ROWS = 64 * 1024
+
+def is_available():
+    """Returns True if pyarrow is installed."""
+    return pa is not None
+
+def _alerts_schema(multi_account):
+    timestamp = pa.timestamp('ms', tz='UTC')
+    fields = [
+        ('condition_name', pa.string()), ('condition_id', pa.int64()),
+        ('policy_name', pa.string()), ('policy_id', pa.int64()),
+        ('condition_last_update', timestamp), ('policy_last_update', timestamp),
+        ('condition_url', pa.string()), ('policy_url', pa.string()),
+        ('changed_by', pa.list_(pa.string())), ('change_count', pa.int64()),
+    ]
+    # Extra fields can hold anything the API returns, so they are stored as text (JSON for lists and objects).
+    fields += [(field, pa.string()) for field in analyzer.extra_condition_fields()]
+    if multi_account:
+        fields.insert(0, ('account_id', pa.int64()))
+    return pa.schema(fields)
+
+def _audit_schema(multi_account):
+    # targetId stays a string: besides numeric policy/condition IDs it can hold entity GUIDs.
+    category = pa.dictionary(pa.int32(), pa.string())
+    fields = [
+        ('timestamp', pa.timestamp('ms', tz='UTC')), ('actionIdentifier', category),
+        ('actorEmail', category), ('actorId', pa.int64()),
+        ('targetId', pa.string()), ('targetType', category), ('targetName', pa.string()),
+        ('description', pa.string()), ('changes', pa.string()),
+    ]
+    fields += [(field, pa.string()) for field in analyzer.extra_audit_fields()]
+    if multi_account:
+        fields.insert(0, ('account_id', pa.int64()))
+    return pa.schema(fields)
+
+def _to_int(value):
+    text = str(value) if value is not None else ''
+    return int(text) if text.lstrip('-').isdigit() else None
+
+def _to_text(value):
+    if value is None:
+        return None
+    if isinstance(value, (dict, list, bool)):
+        return json.dumps(value)
+    return str(value)
+
+def _alert_records(policies, conditions, account_id, dataset=None):
+    """Yields one typed alerts row (a tuple in schema order) per condition, sorted by condition name."""
+    if dataset is None:
+        dataset = alert_model.AlertDataset(policies, ())
+    extra_fields = analyzer.extra_condition_fields()
+    for condition in sorted(conditions, key=lambda c: c.get('name', '').lower()):
+        policy_id = int(condition['policyId'])
+        condition_id = int(condition['id'])
+        updated_at = condition.get('updatedAt')
+        changes = dataset.condition_changes(condition_id)
+        yield (condition.get('name', 'N/A'), condition_id, dataset.policy_name(policy_id), policy_id,
+               updated_at, updated_at,
+               analyzer.condition_url(policy_id, condition_id, account_id), analyzer.policy_url(policy_id, account_id),
+               changes['changed_by'], changes['change_count']) + tuple(
+                  _to_text(projection.field_value(condition, field)) for field in extra_fields)
+
+def _audit_records(events):
+    """Yields one typed audit row (a tuple in schema order) per event."""
+    extra_fields = analyzer.extra_audit_fields()
+    for event in events:
+        yield (_to_int(event.get('timestamp')), event.get('actionIdentifier'), event.get('actorEmail'),
+               _to_int(event.get('actorId')), _to_text(event.get('targetId')), event.get('targetType'),
+               _to_text(event.get('targetName')), _to_text(event.get('description')), _to_text(event.get('changes'))
+               ) + tuple(_to_text(event.get(field)) for field in extra_fields)
+
+def _multi_account_alert_records(account_results):
+    for result in account_results:
+        if result['error']:
+            continue
+        account_id = result['account_id']
+        for record in _alert_records(result['policies'], result['filtered_conditions'], account_id, result.get('dataset')):
+            yield (account_id,) + record
+
+def _multi_account_audit_records(account_results):
+    for result in account_results:
+        if result['error']:
+            continue
+        for record in _audit_records(result['audit_events']):
+            yield (result['account_id'],) + record
+
+def _record_batch(rows, schema):
+    """Converts a list of row tuples into a RecordBatch with typed (and dictionary-encoded) columns."""
+    arrays = []
+    for field, values in zip(schema, zip(*rows)):
+        if pa.types.is_dictionary(field.type):
+            arrays.append(pa.array(values, type=field.type.value_type).dictionary_encode())
+        else:
+            arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+def write_columnar(path, records, schema, file_format='parquet', compression=DEFAULT_COMPRESSION,
+                   batch_rows=DEFAULT_BATCH_ROWS):
+    """Writes typed row tuples to a Parquet file or an Arrow IPC stream, `batch_rows` rows at a time.
+
+    Only one batch is held in memory. Returns the number of rows written.
+    """
+    if file_format == 'parquet':
+        writer = pq.ParquetWriter(path, schema, compression=compression)
+    elif file_format == 'arrow':
+        # The stream format (unlike the file format) allows each batch its own dictionaries.
+        writer = pa.ipc.new_stream(path, schema, options=pa.ipc.IpcWriteOptions(compression=compression))
+    else:
+        raise ValueError(f"Unknown columnar format '{file_format}'. Use one of: {', '.join(FORMATS)}.")
+    row_count = 0
+    with writer:
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= batch_rows:
+                writer.write_batch(_record_batch(batch, schema))
+                row_count += len(batch)
+                batch = []
+        if batch:
+            writer.write_batch(_record_batch(batch, schema))
+            row_count += len(batch)
+    return row_count
+
+def _write_report(phase, path, records, schema, file_format):
+    with analyzer.phase_timer(f"{file_format}_{phase}") as timing:
+        timing['entities'] = write_columnar(path, records, schema, file_format)
+    return timing['entities']
+
+def write_alerts(path, policies, conditions, account_id, dataset=None, file_format='parquet'):
+    """Writes the alerts report in a columnar format. Returns the number of rows."""
+    return _write_report('alerts', path, _alert_records(policies, conditions, account_id, dataset), _alerts_schema(False),
+                         file_format)
+
+def write_audit(path, events, file_format='parquet'):
+    """Writes the audit report in a columnar format. Returns the number of rows."""
+    return _write_report('audit', path, _audit_records(events), _audit_schema(False), file_format)
+
+def write_multi_account_alerts(path, account_results, file_format='parquet'):
+    """Writes the merged alerts report of several accounts, with an account_id column. Returns the number of rows."""
+    return _write_report('alerts', path, _multi_account_alert_records(account_results), _alerts_schema(True), file_format)
+
+def write_multi_account_audit(path, account_results, file_format='parquet'):
+    """Writes the merged audit report of several accounts, with an account_id column. Returns the number of rows."""
+    return _write_report('audit', path, _multi_account_audit_records(account_results), _audit_schema(True), file_format)
+
+def report_path(base_name, file_format):
+    """Returns the output file name for a report, e.g. new_relic_alerts.parquet."""
+    return base_name + FILE_EXTENSIONS[file_format]
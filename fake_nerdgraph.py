@@ -0,0 +1,261 @@
+import argparse
+import json
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# A stand-in for the NerdGraph endpoint that serves synthetic alert policies, NRQL
+# conditions and NrAuditEvent rows, for benchmarking without a New Relic account.
+# Every entity is derived from its index, so any page or time window can be served
+# without holding the whole data set in memory.
+
+DEFAULT_POLICIES = 10_000
+DEFAULT_CONDITIONS = 100_000
+DEFAULT_AUDIT_EVENTS = 1_000_000
+DEFAULT_PAGE_SIZE = 200
+
+# NRQL returns 100 rows without a LIMIT clause and at most 5000 with LIMIT MAX.
+NRQL_DEFAULT_LIMIT = 100
+NRQL_MAX_LIMIT = 5000
+
+ACTIONS = ('alerts_nrql_condition.update', 'alerts_nrql_condition.create', 'alerts_policy.update', 'alerts_nrql_condition.delete')
+
+class FakeDataSet:
+    """Synthetic account data spread evenly over [since_ms, until_ms)."""
+
+    def __init__(self, policies=DEFAULT_POLICIES, conditions=DEFAULT_CONDITIONS, audit_events=DEFAULT_AUDIT_EVENTS,
+                 since_ms=None, until_ms=None):
+        if until_ms is None:
+            until_ms = int(time.time() * 1000)
+        if since_ms is None:
+            since_ms = until_ms - 30 * 86400 * 1000
+        self.policy_count = policies
+        self.condition_count = conditions
+        self.audit_event_count = audit_events
+        self.since_ms = since_ms
+        self.until_ms = until_ms
+        self.event_step_ms = max(1, (until_ms - since_ms) // max(1, audit_events))
+
+    def policy(self, i):
+        return {"id": str(i), "name": f"Policy {i}"}
+
+    def condition(self, i):
+        # Spread updates over twice the audited span, so about half fall outside the date filter.
+        span_ms = 2 * (self.until_ms - self.since_ms)
+        return {"policyId": str(i % max(1, self.policy_count)), "id": str(i), "name": f"Condition {i}",
+                "updatedAt": self.until_ms - 1 - (i * 2654435761 % span_ms), "enabled": i % 7 != 0,
+                "description": f"Alerts when error rate of service {i} is high", "runbookUrl": f"https://runbooks.example.com/{i}",
+                "nrql": {"query": f"SELECT percentage(count(*), WHERE error IS true) FROM Transaction WHERE appId = {i}"},
+                "terms": [{"threshold": i % 100, "operator": "ABOVE", "priority": "CRITICAL",
+                           "thresholdDuration": 300, "thresholdOccurrences": "ALL"}],
+                "type": "STATIC", "violationTimeLimitSeconds": 86400,
+                "signal": {"aggregationWindow": 60, "aggregationMethod": "EVENT_FLOW", "aggregationDelay": 120,
+                           "fillOption": "NONE", "fillValue": None},
+                "expiration": {"expirationDuration": None, "closeViolationsOnExpiration": False,
+                               "openViolationOnExpiration": False}}
+
+    def audit_event(self, i):
+        condition_id = i % max(1, self.condition_count)
+        action = ACTIONS[i % len(ACTIONS)]
+        target_id = condition_id % max(1, self.policy_count) if 'policy' in action else condition_id
+        return {"timestamp": self.since_ms + i * self.event_step_ms, "actionIdentifier": action,
+                "actorEmail": f"user{i % 25}@example.com", "actorId": 1000 + i % 25,
+                "targetId": str(target_id), "targetType": action.split('.')[0][len('alerts_'):],
+                "targetName": f"Condition {condition_id}",
+                "description": f"Changed condition {condition_id}",
+                "changes": json.dumps([{"field": "threshold", "before": i % 10, "after": i % 10 + 1}]),
+                "id": f"{i:032x}", "actorType": "user", "actorIpAddress": f"10.{i % 256}.{i // 256 % 256}.{i % 200}",
+                "actorAPIKey": None, "scope": "account", "targetAccountId": 1}
+
+    def audit_events_between(self, since_ms, until_ms, limit):
+        """Returns up to `limit` events in [since_ms, until_ms), newest first like NRQL."""
+        first = max(0, -(-(since_ms - self.since_ms) // self.event_step_ms))
+        last = min(self.audit_event_count, -(-(until_ms - self.since_ms) // self.event_step_ms))
+        return [self.audit_event(i) for i in range(last - 1, max(first, last - limit) - 1, -1)]
+
+class FakeNerdGraph:
+    """Request handling and counters shared by every connection to the fake server."""
+
+    def __init__(self, data, page_size=DEFAULT_PAGE_SIZE, latency=0.0, throttle_every=0, retry_after=0.1):
+        self.data = data
+        self.page_size = page_size
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {'requests': 0, 'throttled': 0, 'bytes_sent': 0}
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def count_request(self):
+        """Counts a request and returns True if it should be answered with a 429."""
+        with self._lock:
+            self._stats['requests'] += 1
+            if self.throttle_every and self._stats['requests'] % self.throttle_every == 0:
+                self._stats['throttled'] += 1
+                return True
+            return False
+
+    def count_bytes(self, bytes_sent):
+        with self._lock:
+            self._stats['bytes_sent'] += bytes_sent
+
+    def handle(self, query, variables):
+        """Returns the `account` object of the GraphQL response for a query.
+
+        Entities are trimmed to the query's selection set, like the real API.
+        """
+        if "policiesSearch" in query:
+            items, cursor = self._page(self.data.policy, self.data.policy_count, variables.get("cursor"),
+                                       _selection(query, r"policies\s*\{"))
+            return {"alerts": {"policiesSearch": {"policies": items, "nextCursor": cursor}}}
+        if "nrqlConditionsSearch" in query:
+            items, cursor = self._page(self.data.condition, self.data.condition_count, variables.get("cursor"),
+                                       _selection(query, r"nrqlConditions\s*\{"))
+            return {"alerts": {"nrqlConditionsSearch": {"nrqlConditions": items, "nextCursor": cursor}}}
+        if "nrqlCondition(" in query:
+            i = int(variables["id"])
+            condition = self.data.condition(i) if i < self.data.condition_count else None
+            return {"alerts": {"nrqlCondition": _project(condition, _selection(query, r"nrqlCondition\([^)]*\)\s*\{"))}}
+        if "policy(" in query:
+            i = int(variables["id"])
+            policy = self.data.policy(i) if i < self.data.policy_count else None
+            return {"alerts": {"policy": _project(policy, _selection(query, r"policy\([^)]*\)\s*\{"))}}
+        return {"nrql": {"results": self._nrql(variables["nrqlQuery"])}}
+
+    def _page(self, make_entity, total, cursor, selection):
+        start = int(cursor or 0)
+        end = min(total, start + self.page_size)
+        return [_project(make_entity(i), selection) for i in range(start, end)], (str(end) if end < total else None)
+
+    def _nrql(self, nrql):
+        window = re.search(r"SINCE (\d+) UNTIL (\d+)", nrql)
+        if window:
+            since_ms, until_ms = int(window.group(1)), int(window.group(2))
+        else:
+            dates = re.search(r"SINCE '([^']+)' UNTIL '([^']+)'", nrql)
+            since_ms, until_ms = (_datetime_to_ms(dates.group(1)), _datetime_to_ms(dates.group(2)) + 1000) if dates else (0, 2**62)
+        limit = re.search(r"LIMIT (\w+)", nrql)
+        if not limit:
+            row_limit = NRQL_DEFAULT_LIMIT
+        elif limit.group(1) == "MAX":
+            row_limit = NRQL_MAX_LIMIT
+        else:
+            row_limit = min(NRQL_MAX_LIMIT, int(limit.group(1)))
+        events = self.data.audit_events_between(since_ms, until_ms, row_limit)
+        select = re.search(r"SELECT (.+?) WHERE", nrql)
+        if select and select.group(1).strip() != "*":
+            attributes = [attribute.strip().strip("`") for attribute in select.group(1).split(",")]
+            events = [{attribute: event.get(attribute) for attribute in attributes} for event in events]
+        return events
+
+def _selection(query, opening):
+    """Parses the selection set that follows the `opening` regex (which ends with its "{") into a nested dict."""
+    match = re.search(opening, query)
+    if not match:
+        return None
+    tokens = re.findall(r"[_A-Za-z][_A-Za-z0-9]*|[{}]", query[match.end():])
+
+    def parse(position):
+        fields = {}
+        while tokens[position] != "}":
+            name = tokens[position]
+            if tokens[position + 1] == "{":
+                fields[name], position = parse(position + 2)
+            else:
+                fields[name], position = None, position + 1
+        return fields, position + 1
+
+    return parse(0)[0]
+
+def _project(value, selection):
+    """Keeps only the selected fields of an entity (and of every item of a list)."""
+    if selection is None or value is None:
+        return value
+    if isinstance(value, list):
+        return [_project(item, selection) for item in value]
+    return {name: _project(value.get(name), fields) for name, fields in selection.items()}
+
+def _datetime_to_ms(text):
+    return int(datetime.strptime(text, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+def _make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            # GET /stats returns the request counters as JSON.
+            self._send(200, json.dumps(fake.stats()).encode())
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if fake.count_request():
+                self._send(429, b"", {"Retry-After": str(fake.retry_after)})
+                return
+            if fake.latency:
+                time.sleep(fake.latency)
+            account = fake.handle(body["query"], body.get("variables") or {})
+            payload = json.dumps({"data": {"actor": {"account": account}}}).encode()
+            fake.count_bytes(len(payload))
+            self._send(200, payload)
+
+        def _send(self, status, payload, headers=None):
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+    return Handler
+
+def make_server(fake, host="127.0.0.1", port=0):
+    """Returns a ThreadingHTTPServer serving `fake`. Port 0 picks a free port."""
+    server = ThreadingHTTPServer((host, port), _make_handler(fake))
+    server.daemon_threads = True
+    return server
+
+def date_range_to_ms(start_date_str, end_date_str):
+    """Converts a YYYY-MM-DD range to the [since, until) epoch ms window the CLI audits."""
+    since = datetime.strptime(start_date_str, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+    until = datetime.strptime(end_date_str, '%Y-%m-%d').replace(tzinfo=timezone.utc) + timedelta(days=1)
+    return int(since.timestamp() * 1000), int(until.timestamp() * 1000)
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve synthetic New Relic alert data on a local fake NerdGraph endpoint.")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--start', required=True, help="Start of the date range the audit events cover (YYYY-MM-DD).")
+    parser.add_argument('--end', required=True, help="End of the date range the audit events cover (YYYY-MM-DD).")
+    parser.add_argument('--policies', type=int, default=DEFAULT_POLICIES)
+    parser.add_argument('--conditions', type=int, default=DEFAULT_CONDITIONS)
+    parser.add_argument('--audit-events', type=int, default=DEFAULT_AUDIT_EVENTS)
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE, help="Entities per policies/conditions page.")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to every response.")
+    parser.add_argument('--throttle-every', type=int, default=0, help="Answer every Nth request with 429 Too Many Requests.")
+    args = parser.parse_args()
+
+    since_ms, until_ms = date_range_to_ms(args.start, args.end)
+    data = FakeDataSet(args.policies, args.conditions, args.audit_events, since_ms, until_ms)
+    fake = FakeNerdGraph(data, args.page_size, args.latency, args.throttle_every)
+    server = make_server(fake, args.host, args.port)
+    print(f"Fake NerdGraph listening on http://{args.host}:{server.server_port}/graphql", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
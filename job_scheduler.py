@@ -0,0 +1,111 @@
+import threading
+from collections import OrderedDict
+
+DEFAULT_WORKERS = 4
+DEFAULT_JOBS_PER_KEY = 2
+DEFAULT_MAX_QUEUE = 100
+
+class QueueFull(Exception):
+    """Raised by JobScheduler.submit when the queue already holds `max_queue` jobs."""
+
+class _QueuedJob:
+    __slots__ = ('job_id', 'key', 'target', 'args', 'cancel_event')
+
+    def __init__(self, job_id, key, target, args):
+        self.job_id = job_id
+        self.key = key
+        self.target = target
+        self.args = args
+        self.cancel_event = threading.Event()
+
+class JobScheduler:
+    """Runs background jobs on a fixed pool of worker threads, in FIFO order.
+
+    At most `jobs_per_key` jobs sharing a key (e.g. an API key) run at the same time; a
+    queued job whose key is at its limit is passed over, keeping its place, until one
+    of that key's jobs finishes. Each job's target is called as
+    `target(*args, cancel_event)` and should stop early once the event is set.
+    """
+
+    def __init__(self, num_workers=DEFAULT_WORKERS, jobs_per_key=DEFAULT_JOBS_PER_KEY, max_queue=DEFAULT_MAX_QUEUE):
+        self.num_workers = num_workers
+        self.jobs_per_key = jobs_per_key
+        self.max_queue = max_queue
+        self._queue = OrderedDict()
+        self._running = {}
+        self._running_per_key = {}
+        self._condition = threading.Condition()
+        self._stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'cancelled': 0}
+        for index in range(num_workers):
+            threading.Thread(target=self._worker, name=f"audit-worker-{index}", daemon=True).start()
+
+    def submit(self, job_id, key, target, *args):
+        """Queues a job. Raises QueueFull if the queue is at capacity."""
+        with self._condition:
+            if len(self._queue) >= self.max_queue:
+                raise QueueFull(f"The job queue is full ({self.max_queue} jobs). Please try again later.")
+            self._queue[job_id] = _QueuedJob(job_id, key, target, args)
+            self._stats['submitted'] += 1
+            self._condition.notify_all()
+
+    def position(self, job_id):
+        """Returns the job's 1-based place in the queue, 0 if it is running, or None if unknown."""
+        with self._condition:
+            if job_id in self._running:
+                return 0
+            for index, queued_id in enumerate(self._queue, 1):
+                if queued_id == job_id:
+                    return index
+            return None
+
+    def cancel(self, job_id):
+        """Cancels a job. Queued jobs are dropped; running jobs are asked to stop.
+
+        Returns 'dequeued', 'signalled' or None if the job is not queued or running.
+        """
+        with self._condition:
+            if job_id in self._queue:
+                del self._queue[job_id]
+                self._stats['cancelled'] += 1
+                return 'dequeued'
+            job = self._running.get(job_id)
+            if job:
+                job.cancel_event.set()
+                return 'signalled'
+            return None
+
+    def _next_runnable(self):
+        for job in self._queue.values():
+            if self._running_per_key.get(job.key, 0) < self.jobs_per_key:
+                return job
+        return None
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                job = self._next_runnable()
+                while job is None:
+                    self._condition.wait()
+                    job = self._next_runnable()
+                del self._queue[job.job_id]
+                self._running[job.job_id] = job
+                self._running_per_key[job.key] = self._running_per_key.get(job.key, 0) + 1
+            outcome = 'completed'
+            try:
+                job.target(*job.args, job.cancel_event)
+            except Exception:
+                outcome = 'failed'
+            if job.cancel_event.is_set():
+                outcome = 'cancelled'
+            with self._condition:
+                del self._running[job.job_id]
+                self._running_per_key[job.key] -= 1
+                if not self._running_per_key[job.key]:
+                    del self._running_per_key[job.key]
+                self._stats[outcome] += 1
+                self._condition.notify_all()
+
+    def metrics(self):
+        with self._condition:
+            return dict(self._stats, queued=len(self._queue), running=len(self._running),
+                        workers=self.num_workers, jobs_per_key=self.jobs_per_key)
@@ -0,0 +1,333 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+DEFAULT_DISK_BUDGET = 4 * 1024 * 1024 * 1024
+DEFAULT_SPILL_THRESHOLD = 8 * 1024 * 1024
+DEFAULT_TTL_SECONDS = 6 * 60 * 60
+DEFAULT_MAX_JOBS = 500
+
+class JobState(dict):
+    """A job's status dict that wakes up anyone waiting for it to change.
+
+    Every assignment or update() bumps `version`; wait_for_change() blocks until the
+    version moves past the one the caller last saw. Nested values that are mutated in
+    place (e.g. counters) should be followed by notify().
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.version = 0
+        self._changed = threading.Condition()
+
+    def __setitem__(self, key, value):
+        with self._changed:
+            super().__setitem__(key, value)
+            self._bump()
+
+    def update(self, *args, **kwargs):
+        with self._changed:
+            super().update(*args, **kwargs)
+            self._bump()
+
+    def notify(self):
+        with self._changed:
+            self._bump()
+
+    def _bump(self):
+        self.version += 1
+        self._changed.notify_all()
+
+    def wait_for_change(self, seen_version, timeout):
+        """Waits up to `timeout` seconds for a version newer than `seen_version` and returns the current version."""
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != seen_version, timeout)
+            return self.version
+
+class _Report:
+    """A generated report, held either as bytes in memory or as a file on disk."""
+
+    __slots__ = ('data', 'path', 'size')
+
+    def __init__(self, data=None, path=None, size=0):
+        self.data = data
+        self.path = path
+        self.size = size
+
+class _Job:
+    __slots__ = ('info', 'reports', 'build_locks', 'data', 'data_size', 'data_parent', 'last_access')
+
+    def __init__(self, info):
+        self.info = info
+        self.reports = {}
+        self.build_locks = {}
+        self.data = None
+        self.data_size = 0
+        self.data_parent = None
+        self.last_access = time.monotonic()
+
+class ResultCache:
+    """Thread-safe, bounded cache of web UI jobs and their generated reports.
+
+    Job status dicts are looked up like a dict (`cache[job_id]`). Reports are kept in
+    memory up to `memory_budget` bytes; reports larger than `spill_threshold`, and the
+    least recently used ones once the budget is exceeded, are spilled to temp files.
+    Jobs not accessed for `ttl_seconds` are evicted, as are the least recently used jobs
+    once there are more than `max_jobs` or the spilled files exceed `disk_budget`.
+
+    A job can also hold in-memory data (e.g. the fetched datasets its reports are built
+    from) with an estimated size. That size counts against `memory_budget` too; once
+    spilling reports is not enough, the data of the least recently used jobs is dropped,
+    except for the most recently used job's. Data that builds on another job's data (see
+    put_job_data) is only charged for what it adds, and is dropped along with its parent.
+    """
+
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET, disk_budget=DEFAULT_DISK_BUDGET,
+                 spill_threshold=DEFAULT_SPILL_THRESHOLD, ttl_seconds=DEFAULT_TTL_SECONDS,
+                 max_jobs=DEFAULT_MAX_JOBS, spill_dir=None):
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.spill_threshold = spill_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_jobs = max_jobs
+        self.spill_dir = spill_dir or tempfile.mkdtemp(prefix="nr_alert_audit_")
+        self._jobs = OrderedDict()
+        self._lock = threading.RLock()
+        self._memory_bytes = 0
+        self._data_bytes = 0
+        self._disk_bytes = 0
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'spills': 0, 'builds': 0, 'data_drops': 0}
+
+    # --- Job Status ---
+
+    def __setitem__(self, job_id, info):
+        with self._lock:
+            if job_id in self._jobs:
+                self._drop(job_id)
+            self._jobs[job_id] = _Job(info)
+            self._enforce_limits()
+
+    def __getitem__(self, job_id):
+        info = self.get(job_id)
+        if info is None:
+            raise KeyError(job_id)
+        return info
+
+    def __contains__(self, job_id):
+        return self.get(job_id, count=False) is not None
+
+    def get(self, job_id, default=None, count=True):
+        """Returns a job's status dict (marking it recently used), or `default` if unknown or expired."""
+        with self._lock:
+            self._expire()
+            job = self._jobs.get(job_id)
+            if job is None:
+                if count:
+                    self._stats['misses'] += 1
+                return default
+            if count:
+                self._stats['hits'] += 1
+            self._touch(job_id, job)
+            return job.info
+
+    # --- Job Data ---
+
+    def put_job_data(self, job_id, data, size, parent_id=None):
+        """Attaches in-memory data of an estimated `size` in bytes to a job, replacing any it had, and marks the job recently used.
+
+        With `parent_id`, the data shares objects held by that job's data (e.g. a refilter
+        of its datasets) and `size` should only cover what this job adds. The parent is then
+        kept at least as recently used as this job, and dropping its data drops this job's
+        too, since only then is the shared memory freed. Returns False, storing nothing, if
+        the job or the parent's data is gone.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            parent = self._jobs.get(parent_id) if parent_id is not None else None
+            if job is None or (parent_id is not None and (parent is None or parent.data is None)):
+                return False
+            self._release_data(job)
+            job.data, job.data_size, job.data_parent = data, size, parent_id
+            self._memory_bytes += size
+            self._data_bytes += size
+            # The job is about to be used (e.g. its results shown), so don't let this put drop its data.
+            self._touch(job_id, job)
+            self._enforce_limits()
+            return True
+
+    def get_job_data(self, job_id):
+        """Returns a job's data (marking the job recently used), or None if the job or its data was dropped."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.data is None:
+                self._stats['misses'] += 1
+                return None
+            self._stats['hits'] += 1
+            self._touch(job_id, job)
+            return job.data
+
+    def _touch(self, job_id, job):
+        """Marks a job, and the job its data builds on, as the most recently used."""
+        now = time.monotonic()
+        if job.data_parent in self._jobs:
+            self._jobs[job.data_parent].last_access = now
+            self._jobs.move_to_end(job.data_parent)
+        job.last_access = now
+        self._jobs.move_to_end(job_id)
+
+    # --- Reports ---
+
+    def new_report_path(self, job_id, file_type, suffix=".csv"):
+        """Returns a fresh temp file path inside the spill directory for a report to be written to."""
+        fd, path = tempfile.mkstemp(prefix=f"{file_type}_{job_id}_", suffix=suffix, dir=self.spill_dir)
+        os.close(fd)
+        return path
+
+    def put_report_file(self, job_id, file_type, path):
+        """Takes ownership of a written report file, loading it into memory if it is small enough."""
+        size = os.path.getsize(path)
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                _remove_file(path)
+                return
+            if file_type in job.reports:
+                self._release(job.reports.pop(file_type))
+            if size <= self.spill_threshold:
+                with open(path, "rb") as f:
+                    report = _Report(data=f.read(), size=size)
+                _remove_file(path)
+                self._memory_bytes += size
+            else:
+                report = _Report(path=path, size=size)
+                self._disk_bytes += size
+                self._stats['spills'] += 1
+            job.reports[file_type] = report
+            self._enforce_limits()
+
+    def get_report(self, job_id, file_type):
+        """Returns (bytes, None) for an in-memory report, (None, path) for a spilled one, or (None, None)."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            report = job.reports.get(file_type) if job else None
+            if report is None:
+                self._stats['misses'] += 1
+                return None, None
+            self._stats['hits'] += 1
+            self._touch(job_id, job)
+            return report.data, report.path
+
+    def get_or_build_report(self, job_id, file_type, build):
+        """Like get_report, but first calls `build()` if the report does not exist yet.
+
+        `build` should write the report and hand it over with put_report_file. Concurrent
+        callers asking for the same missing report wait for a single build.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                self._stats['misses'] += 1
+                return None, None
+            build_lock = job.build_locks.setdefault(file_type, threading.Lock())
+        with build_lock:
+            with self._lock:
+                built = file_type in job.reports
+                if not built:
+                    self._stats['builds'] += 1
+            if not built:
+                build()
+        return self.get_report(job_id, file_type)
+
+    # --- Eviction ---
+
+    def _expire(self):
+        now = time.monotonic()
+        expired = [job_id for job_id, job in self._jobs.items() if now - job.last_access > self.ttl_seconds]
+        for job_id in expired:
+            self._drop(job_id)
+            self._stats['expirations'] += 1
+
+    def _enforce_limits(self):
+        self._expire()
+        # Spill the least recently used in-memory reports until the memory budget is met.
+        for job in list(self._jobs.values()):
+            if self._memory_bytes <= self.memory_budget:
+                break
+            for file_type, report in job.reports.items():
+                if report.data is not None:
+                    self._spill(file_type, report)
+        # Then drop the data of the least recently used jobs, keeping the most recent job's (and its parent's).
+        if self._jobs:
+            newest = self._jobs[next(reversed(self._jobs))]
+            for job_id, job in list(self._jobs.items()):
+                if self._memory_bytes <= self.memory_budget:
+                    break
+                if job is not newest and job_id != newest.data_parent and job.data is not None:
+                    self._drop_data(job_id, job)
+        while self._jobs and (len(self._jobs) > self.max_jobs or self._disk_bytes > self.disk_budget):
+            oldest_job_id = next(iter(self._jobs))
+            self._drop(oldest_job_id)
+            self._stats['evictions'] += 1
+
+    def _spill(self, file_type, report):
+        fd, path = tempfile.mkstemp(prefix=f"{file_type}_", suffix=".report", dir=self.spill_dir)
+        with os.fdopen(fd, "wb") as f:
+            f.write(report.data)
+        self._memory_bytes -= report.size
+        self._disk_bytes += report.size
+        report.data, report.path = None, path
+        self._stats['spills'] += 1
+
+    def _release(self, report):
+        if report.data is not None:
+            self._memory_bytes -= report.size
+        else:
+            self._disk_bytes -= report.size
+            _remove_file(report.path)
+
+    def _release_data(self, job):
+        self._memory_bytes -= job.data_size
+        self._data_bytes -= job.data_size
+        job.data, job.data_size, job.data_parent = None, 0, None
+
+    def _drop_data(self, job_id, job):
+        """Drops a job's data and the data of the jobs that build on it."""
+        for child in self._jobs.values():
+            if child.data_parent == job_id:
+                self._release_data(child)
+                self._stats['data_drops'] += 1
+        if job.data is not None:
+            self._release_data(job)
+            self._stats['data_drops'] += 1
+
+    def _drop(self, job_id):
+        job = self._jobs.pop(job_id)
+        for report in job.reports.values():
+            self._release(report)
+        self._release_data(job)
+        self._drop_data(job_id, job)
+
+    def clear(self):
+        """Drops every job and deletes all spilled report files."""
+        with self._lock:
+            for job_id in list(self._jobs):
+                self._drop(job_id)
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            os.makedirs(self.spill_dir, exist_ok=True)
+
+    def metrics(self):
+        """Returns hit/miss counts, bytes held in memory (job data included) and on disk, and eviction counts."""
+        with self._lock:
+            self._expire()
+            return dict(self._stats, jobs=len(self._jobs), memory_bytes=self._memory_bytes, data_bytes=self._data_bytes,
+                        disk_bytes=self._disk_bytes, memory_budget=self.memory_budget, disk_budget=self.disk_budget)
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,268 @@
+import threading
+import time
+import pytest
+import alert_analyzer_lib as analyzer
+import fake_nerdgraph
+import job_scheduler
+import result_cache
+
+# Tests for the paths where jobs and fetches meet: per-key rate limiters, coalesced
+# fetches in FetchMemo, queueing and cancellation in JobScheduler, and the byte
+# accounting of ResultCache. Fetches go to a local fake NerdGraph server.
+
+POLICIES = 50
+CONDITIONS = 600
+PAGE_SIZE = 100
+WAIT_SECONDS = 10
+
+@pytest.fixture
+def fake_server(monkeypatch):
+    data = fake_nerdgraph.FakeDataSet(POLICIES, CONDITIONS, audit_events=0)
+    fake = fake_nerdgraph.FakeNerdGraph(data, page_size=PAGE_SIZE, latency=0.01)
+    server = fake_nerdgraph.make_server(fake)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(analyzer, 'NR_GRAPHQL_URL', f"http://127.0.0.1:{server.server_port}/graphql")
+    yield fake
+    server.shutdown()
+    server.server_close()
+
+def fetch_conditions(on_page=None):
+    return analyzer.fetch_all_data("test-key", 1, analyzer.CONDITIONS_QUERY, "alerts.nrqlConditionsSearch",
+                                   "nrqlConditions", on_page=on_page)
+
+def wait_until(predicate):
+    deadline = time.monotonic() + WAIT_SECONDS
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+# --- Rate Limiters ---
+
+def test_rate_limiters_are_keyed_by_digest_and_forgotten_when_idle(monkeypatch):
+    monkeypatch.setattr(analyzer, '_rate_limiters', {})
+    limiter = analyzer.get_rate_limiter("test-key")
+    assert analyzer.get_rate_limiter("test-key") is limiter
+    assert list(analyzer._rate_limiters) == [analyzer.key_digest("test-key")]
+
+    monkeypatch.setattr(analyzer, 'RATE_LIMITER_IDLE_SECONDS', 0)
+    time.sleep(0.01)
+    analyzer.get_rate_limiter("other-key")
+    assert list(analyzer._rate_limiters) == [analyzer.key_digest("other-key")]
+
+# --- FetchMemo ---
+
+def test_memo_coalesces_identical_fetches(fake_server):
+    memo = analyzer.FetchMemo()
+    key = analyzer.memo_key("test-key", 1, 'conditions')
+    results = [None, None]
+
+    def fetch(index):
+        results[index] = memo.get_or_fetch(key, fetch_conditions)
+
+    threads = [threading.Thread(target=fetch, args=(index,)) for index in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(WAIT_SECONDS)
+
+    assert len(results[0]) == CONDITIONS
+    assert results[1] is results[0]
+    assert fake_server.stats()['requests'] == CONDITIONS // PAGE_SIZE
+    assert memo.metrics()['misses'] == 1
+
+def test_memo_waiter_reruns_fetch_after_leader_cancels(fake_server):
+    memo = analyzer.FetchMemo()
+    key = analyzer.memo_key("test-key", 1, 'conditions')
+    waiter_attached = threading.Event()
+    outcome = {}
+
+    def cancel_after_first_page(page_count, entity_count):
+        # Give up only once the waiter is sharing this fetch.
+        assert waiter_attached.wait(WAIT_SECONDS)
+        raise analyzer.FetchCancelled()
+
+    def leader():
+        try:
+            memo.get_or_fetch(key, lambda: fetch_conditions(on_page=cancel_after_first_page))
+        except analyzer.FetchCancelled:
+            outcome['leader'] = 'cancelled'
+
+    def waiter():
+        outcome['waiter'] = memo.get_or_fetch(key, fetch_conditions, on_wait=waiter_attached.set)
+
+    leader_thread = threading.Thread(target=leader)
+    leader_thread.start()
+    wait_until(lambda: memo.metrics()['inflight'] == 1)
+    waiter_thread = threading.Thread(target=waiter)
+    waiter_thread.start()
+    leader_thread.join(WAIT_SECONDS)
+    waiter_thread.join(WAIT_SECONDS)
+
+    assert outcome['leader'] == 'cancelled'
+    assert len(outcome['waiter']) == CONDITIONS
+    # One page for the cancelled leader, then the waiter's own complete fetch.
+    assert fake_server.stats()['requests'] == 1 + CONDITIONS // PAGE_SIZE
+    assert memo.get_or_fetch(key, lambda: pytest.fail("should be remembered")) is outcome['waiter']
+
+def test_memo_waiter_can_give_up_while_leader_keeps_fetching(monkeypatch, fake_server):
+    monkeypatch.setattr(analyzer, 'MEMO_WAIT_POLL_SECONDS', 0.01)
+    memo = analyzer.FetchMemo()
+    key = analyzer.memo_key("test-key", 1, 'conditions')
+    release = threading.Event()
+    checks = []
+    outcome = {}
+
+    def give_up_on_second_check():
+        checks.append(True)
+        if len(checks) > 1:
+            raise analyzer.FetchCancelled()
+
+    def leader():
+        outcome['leader'] = memo.get_or_fetch(key, lambda: fetch_conditions(on_page=lambda *_: release.wait(WAIT_SECONDS)))
+
+    leader_thread = threading.Thread(target=leader)
+    leader_thread.start()
+    wait_until(lambda: memo.metrics()['inflight'] == 1)
+    with pytest.raises(analyzer.FetchCancelled):
+        memo.get_or_fetch(key, lambda: pytest.fail("should wait for the leader"), on_wait=give_up_on_second_check)
+    release.set()
+    leader_thread.join(WAIT_SECONDS)
+
+    assert len(outcome['leader']) == CONDITIONS
+    assert fake_server.stats()['requests'] == CONDITIONS // PAGE_SIZE
+
+def test_memo_forgets_least_recently_used_results_over_budget():
+    memo = analyzer.FetchMemo(max_bytes=10, size_of=len)
+    memo.get_or_fetch('a', lambda: [1] * 4)
+    memo.get_or_fetch('b', lambda: [2] * 4)
+    memo.get_or_fetch('a', lambda: pytest.fail("should be remembered"))
+    memo.get_or_fetch('c', lambda: [3] * 4)
+    memo.get_or_fetch('too large', lambda: [4] * 11)
+
+    metrics = memo.metrics()
+    assert (metrics['entries'], metrics['bytes'], metrics['evictions']) == (2, 8, 1)
+    assert memo.get_or_fetch('a', lambda: pytest.fail("should be remembered")) == [1] * 4
+    assert memo.get_or_fetch('b', lambda: 'fetched again') == 'fetched again'
+
+# --- JobScheduler ---
+
+def blocking_job(started, release):
+    """Returns a job target that records its start and then waits for `release` (or its cancel event)."""
+    def target(name, cancel_event):
+        started.append(name)
+        while not release.is_set() and not cancel_event.is_set():
+            time.sleep(0.005)
+    return target
+
+def test_scheduler_queued_job_keeps_its_place_while_key_is_at_limit():
+    scheduler = job_scheduler.JobScheduler(num_workers=2, jobs_per_key=1)
+    started, release = [], threading.Event()
+    target = blocking_job(started, release)
+    scheduler.submit('a1', 'key-a', target, 'a1')
+    wait_until(lambda: started == ['a1'])
+    scheduler.submit('a2', 'key-a', target, 'a2')
+    scheduler.submit('b1', 'key-b', target, 'b1')
+
+    # key-a is at its limit, so the free worker passes over a2 and runs b1.
+    wait_until(lambda: started == ['a1', 'b1'])
+    assert scheduler.position('a2') == 1
+    assert scheduler.position('a1') == scheduler.position('b1') == 0
+
+    release.set()
+    wait_until(lambda: started == ['a1', 'b1', 'a2'])
+    wait_until(lambda: scheduler.metrics()['completed'] == 3)
+
+def test_scheduler_cancel_dequeues_queued_and_signals_running_jobs():
+    scheduler = job_scheduler.JobScheduler(num_workers=1, jobs_per_key=1)
+    started, release = [], threading.Event()
+    target = blocking_job(started, release)
+    scheduler.submit('running', 'key', target, 'running')
+    wait_until(lambda: started == ['running'])
+    scheduler.submit('queued', 'key', target, 'queued')
+
+    assert scheduler.cancel('queued') == 'dequeued'
+    assert scheduler.position('queued') is None
+    assert scheduler.cancel('running') == 'signalled'
+    wait_until(lambda: scheduler.metrics()['running'] == 0)
+    assert scheduler.cancel('running') is None
+
+    release.set()
+    assert started == ['running']
+    metrics = scheduler.metrics()
+    assert (metrics['cancelled'], metrics['completed'], metrics['queued']) == (2, 0, 0)
+
+# --- ResultCache ---
+
+def filled_cache(tmp_path, **kwargs):
+    """Returns a cache holding one job with an in-memory report, a spilled report and job data."""
+    cache = result_cache.ResultCache(spill_threshold=1024, spill_dir=str(tmp_path), **kwargs)
+    cache['job'] = result_cache.JobState(status='complete')
+    for file_type, size in (('small', 100), ('large', 5000)):
+        path = cache.new_report_path('job', file_type)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        cache.put_report_file('job', file_type, path)
+    cache.put_job_data('job', {'datasets': {}}, 2000)
+    return cache
+
+def test_cache_accounts_reports_and_job_data(tmp_path):
+    metrics = filled_cache(tmp_path).metrics()
+    assert metrics['memory_bytes'] == 100 + 2000
+    assert metrics['data_bytes'] == 2000
+    assert metrics['disk_bytes'] == 5000
+
+def test_cache_releases_all_bytes_on_expiry(tmp_path):
+    cache = filled_cache(tmp_path, ttl_seconds=0.05)
+    time.sleep(0.1)
+    metrics = cache.metrics()
+    assert metrics['expirations'] == 1
+    assert (metrics['jobs'], metrics['memory_bytes'], metrics['data_bytes'], metrics['disk_bytes']) == (0, 0, 0, 0)
+    assert list(tmp_path.iterdir()) == []
+
+def test_cache_releases_all_bytes_on_clear(tmp_path):
+    cache = filled_cache(tmp_path)
+    cache.clear()
+    metrics = cache.metrics()
+    assert (metrics['jobs'], metrics['memory_bytes'], metrics['data_bytes'], metrics['disk_bytes']) == (0, 0, 0, 0)
+    assert list(tmp_path.iterdir()) == []
+
+def test_cache_drops_least_recently_used_job_data_over_budget(tmp_path):
+    cache = result_cache.ResultCache(memory_budget=3000, spill_dir=str(tmp_path))
+    for job_id in ('old', 'new'):
+        cache[job_id] = result_cache.JobState(status='complete')
+        cache.put_job_data(job_id, job_id, 2000)
+
+    assert cache.get_job_data('old') is None
+    assert cache.get_job_data('new') == 'new'
+    metrics = cache.metrics()
+    assert metrics['data_drops'] == 1
+    assert metrics['memory_bytes'] == metrics['data_bytes'] == 2000
+
+def test_cache_put_job_data_keeps_the_new_data_over_budget(tmp_path):
+    cache = result_cache.ResultCache(memory_budget=3000, spill_dir=str(tmp_path))
+    for job_id in ('finished', 'other'):
+        cache[job_id] = result_cache.JobState(status='complete')
+    cache.put_job_data('other', 'other', 2000)
+    # 'other' was used more recently than 'finished' got its data.
+    cache.get('other')
+    cache.put_job_data('finished', 'finished', 2000)
+
+    assert cache.get_job_data('finished') == 'finished'
+    assert cache.get_job_data('other') is None
+
+def test_cache_charges_shared_job_data_once_and_drops_it_with_its_parent(tmp_path):
+    cache = result_cache.ResultCache(memory_budget=3000, spill_dir=str(tmp_path))
+    for job_id in ('source', 'refilter', 'other'):
+        cache[job_id] = result_cache.JobState(status='complete')
+    cache.put_job_data('source', 'datasets', 2000)
+    assert cache.put_job_data('refilter', 'filtered', 500, parent_id='source')
+    assert cache.metrics()['data_bytes'] == 2500
+
+    # The source's data is the least recently used; the refilter's shares it, so both go.
+    cache.put_job_data('other', 'other', 1000)
+    assert cache.get_job_data('source') is None
+    assert cache.get_job_data('refilter') is None
+    metrics = cache.metrics()
+    assert metrics['data_drops'] == 2
+    assert metrics['data_bytes'] == 1000
+    assert not cache.put_job_data('refilter', 'filtered', 500, parent_id='source')